@@ -1,5 +1,23 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
 
 class BrowserConfig(AppConfig):
     name = 'browser'
+
+    def ready(self):
+        # keep the cached users and permissions up to date
+        from django.contrib.auth.models import Group, Permission
+        from .models import User
+        from . import auth_backend as ab
+
+        post_save.connect(ab.user_changed, sender=User)
+        post_delete.connect(ab.user_changed, sender=User)
+        m2m_changed.connect(ab.user_perms_changed,
+            sender=User.groups.through)
+        m2m_changed.connect(ab.user_perms_changed,
+            sender=User.user_permissions.through)
+        m2m_changed.connect(ab.group_perms_changed,
+            sender=Group.permissions.through)
+        post_delete.connect(ab.group_perms_changed, sender=Group)
+        post_delete.connect(ab.group_perms_changed, sender=Permission)
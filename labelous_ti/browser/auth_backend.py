@@ -0,0 +1,97 @@
+# the usual model authentication backend, but with users and their permissions
+# kept in the cache.
+
+# nearly every request (and the tool makes lots of them) needs the logged in
+# user, and most check a permission too. normally that's a query for the user
+# and two more for their permissions on each request. since the cache is shared
+# by all the workers, we keep them there instead and forget them whenever the
+# user, their groups or their permissions change (see the signal handlers
+# below, which are connected in apps.py). anything that changes them without
+# sending signals (e.g. QuerySet.update) is picked up once they time out.
+
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.db import transaction
+
+import functools
+import secrets
+
+# they have their own cache (see settings.py) shared with the sessions. it's
+# looked up each time, like django.core.cache.cache is, so it follows changes
+# to the settings (e.g. in the tests).
+def auth_cache():
+    return caches["auth"]
+
+# how long to keep users and permissions around
+AUTH_CACHE_TIME = 5*60
+
+def user_key(user_id):
+    return "auth_user:{}".format(user_id)
+
+# group permissions affect all the group's users, so changing them changes the
+# version and all the users' cached permissions are forgotten at once. the
+# version is a random token so that if it's lost (e.g. culled from the cache),
+# the new one can't match any permissions cached under an old one.
+PERMS_VERSION_KEY = "auth_perms_version"
+def perms_key(user_id):
+    version = auth_cache().get(PERMS_VERSION_KEY)
+    if version is None:
+        # someone else may be setting one at the same time, so use theirs if so
+        auth_cache().add(PERMS_VERSION_KEY, secrets.token_hex(8), None)
+        version = auth_cache().get(PERMS_VERSION_KEY)
+    return "auth_perms:{}:{}".format(version, user_id)
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        user = auth_cache().get(user_key(user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                auth_cache().set(user_key(user_id), user, AUTH_CACHE_TIME)
+        elif not self.user_can_authenticate(user):
+            user = None
+        return user
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        # same place ModelBackend remembers them for the rest of the request
+        if not hasattr(user_obj, "_perm_cache"):
+            key = perms_key(user_obj.pk)
+            perms = auth_cache().get(key)
+            if perms is None:
+                perms = super().get_all_permissions(user_obj)
+                auth_cache().set(key, perms, AUTH_CACHE_TIME)
+            user_obj._perm_cache = perms
+        return user_obj._perm_cache
+
+def forget_user(user_id):
+    auth_cache().delete_many([user_key(user_id), perms_key(user_id)])
+
+def forget_all_perms():
+    auth_cache().set(PERMS_VERSION_KEY, secrets.token_hex(8), None)
+
+# signal handlers. the signals are sent before the change is committed, and a
+# request in the meantime would load the old data and cache it again, so
+# everything is forgotten once the change is actually there.
+
+def user_changed(sender, instance, **kwargs):
+    transaction.on_commit(functools.partial(forget_user, instance.pk))
+
+# a user's groups or permissions were changed from either side
+def user_perms_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        transaction.on_commit(functools.partial(forget_user, instance.pk))
+    elif pk_set is not None:
+        for user_id in pk_set:
+            transaction.on_commit(functools.partial(forget_user, user_id))
+    else:
+        # cleared from the group or permission side, so we don't know who
+        transaction.on_commit(forget_all_perms)
+
+# a group's permissions were changed, or a group or permission went away
+def group_perms_changed(sender, action=None, **kwargs):
+    if action is None or action.startswith("post_"):
+        transaction.on_commit(forget_all_perms)
@@ -0,0 +1,118 @@
+# keep each user's UserScore up to date.
+
+# THEORY OF OPERATION
+
+# whenever something happens that changes a user's points (an annotation's score
+# changes, an annotation moves between states or is deleted, or an image is
+# approved), the code doing it calls one of the functions here in the same
+# transaction. they add the change onto the user's UserScore row with a single
+# UPDATE, so concurrent changes for the same user just queue up on that row and
+# nothing gets lost. a user without a row yet gets one.
+
+# everything else (e.g. images changed in the admin, rescore) uses
+# recompute_scores to add the points up from scratch. the reconcile_scores
+# command checks the whole ledger against that.
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum, Q, F
+
+from .models import User, UserScore, IMAGE_POINTS
+from image_mgr.models import Image
+from label_app.models import Annotation
+
+# which UserScore field the annotation's score counts towards
+def anno_points_field(annotation):
+    if annotation.finished:
+        return "finished_points"
+    elif annotation.locked:
+        return "pending_points"
+    else:
+        return "inprogress_points"
+
+# add the given amounts onto the user's UserScore fields
+def add_points(user_id, **amounts):
+    changes = {field: F(field)+amount for field, amount in amounts.items()}
+    total = (amounts.get("finished_points", 0) +
+        amounts.get("num_images", 0)*IMAGE_POINTS)
+    if total != 0:
+        changes["total_points"] = F("total_points")+total
+    if len(changes) == 0:
+        return
+
+    if UserScore.objects.filter(user_id=user_id).update(**changes) == 0:
+        # the user doesn't have a row yet. someone else might be creating it at
+        # the same time, so do it in a savepoint and just update theirs if so.
+        try:
+            with transaction.atomic():
+                UserScore.objects.create(user_id=user_id)
+        except IntegrityError:
+            pass
+        UserScore.objects.filter(user_id=user_id).update(**changes)
+
+# the annotation's score is changing to new_score
+def change_anno_score(annotation, new_score):
+    if new_score != annotation.score:
+        add_points(annotation.annotator_id, **{
+            anno_points_field(annotation): new_score-annotation.score})
+
+# the annotation's state is changing, so its score moves from old_field to
+# new_field (see anno_points_field). if new_field is None, e.g. because the
+# annotation is being deleted, the score is just taken away.
+def move_anno_points(annotation, old_field, new_field=None):
+    if annotation.score == 0 or old_field == new_field:
+        return
+    amounts = {old_field: -annotation.score}
+    if new_field is not None:
+        amounts[new_field] = annotation.score
+    add_points(annotation.annotator_id, **amounts)
+
+# the images were just approved
+def approve_images(images):
+    counts = {}
+    for image in images:
+        counts[image.uploader_id] = counts.get(image.uploader_id, 0) + 1
+    for uploader_id, count in counts.items():
+        add_points(uploader_id, num_images=count)
+
+# add up the points of the given users (or everyone) from scratch. returns a
+# dict of user ID to unsaved UserScore.
+def recompute_scores(user_ids=None):
+    users = User.objects.all()
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+    scores = {pk: UserScore(user_id=pk)
+        for pk in users.values_list("pk", flat=True)}
+
+    annos = Annotation.objects.filter(deleted=False, image__deleted=False,
+        annotator__in=users)
+    for points in annos.values("annotator").annotate(
+            inprogress=Sum("score", filter=Q(locked=False, finished=False)),
+            pending=Sum("score", filter=Q(locked=True, finished=False)),
+            finished=Sum("score", filter=Q(finished=True))).order_by():
+        score = scores[points["annotator"]]
+        # aggregates return None if there are no objects
+        score.inprogress_points = points["inprogress"] or 0
+        score.pending_points = points["pending"] or 0
+        score.finished_points = points["finished"] or 0
+
+    images = Image.objects.filter(available=True, deleted=False,
+        uploader__in=users)
+    for uploader_id, num_images in images.values("uploader").annotate(
+            count=Count("pk")).values_list("uploader", "count").order_by():
+        scores[uploader_id].num_images = num_images
+
+    for score in scores.values():
+        score.total_points = score.finished_points + score.image_points
+    return scores
+
+# recompute and save the points of the given users (or everyone)
+def rebuild_scores(user_ids=None):
+    scores = recompute_scores(user_ids)
+    with transaction.atomic():
+        # make sure everyone has a row to update
+        UserScore.objects.bulk_create(
+            [UserScore(user_id=pk) for pk in scores.keys()],
+            batch_size=2000, ignore_conflicts=True)
+        UserScore.objects.bulk_update(scores.values(),
+            ["inprogress_points", "pending_points", "finished_points",
+                "num_images", "total_points"], batch_size=2000)
@@ -0,0 +1,103 @@
+# count the queries the tool's endpoints make per request, first with the plain
+# database sessions and model backend, then with the cached sessions and cached
+# users and permissions we actually use. each endpoint is requested once to warm
+# things up before it's measured. everything happens in a transaction that's
+# rolled back, so it's safe to run on the live database.
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+import time
+
+from label_app.models import Annotation
+from label_app.filename_smuggler import encode_filename
+from browser.auth_backend import forget_user
+
+class Rollback(Exception):
+    pass
+
+# settings for the way things were before caching
+UNCACHED_SETTINGS = {
+    "AUTHENTICATION_BACKENDS": ["django.contrib.auth.backends.ModelBackend"],
+    "SESSION_ENGINE": "django.contrib.sessions.backends.db",
+}
+
+class Command(BaseCommand):
+    help = "Compare per-request query counts with and without auth caching."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--anno", type=int,
+            help="ID of the annotation to request. Defaults to the most "
+                "recently edited one.")
+        parser.add_argument("--repeat", type=int, default=20,
+            help="Number of times to request each endpoint.")
+
+    def handle(self, *args, **options):
+        repeat = options["repeat"]
+        if repeat < 1:
+            raise CommandError("--repeat must be at least 1")
+        annotations = Annotation.objects.filter(deleted=False,
+            image__deleted=False).select_related("annotator")
+        try:
+            if options["anno"] is not None:
+                annotation = annotations.get(pk=options["anno"])
+            else:
+                annotation = annotations.latest("last_edit_time")
+        except Annotation.DoesNotExist as e:
+            raise CommandError("annotation not found") from e
+        user = annotation.annotator
+
+        # view only, so none of them change anything
+        filename = encode_filename(image_id=annotation.image_id,
+            anno_id=annotation.pk, view=True)
+        endpoints = (
+            ("anno xml", reverse("label_app:anno_xml", args=(filename,))),
+            ("anno svg", reverse("label_app:anno_svg", args=(filename,))),
+            ("next", "/label/annotationTools/perl/fetch_image.cgi?image="
+                +filename+".jpg"),
+            ("prev", "/label/annotationTools/perl/fetch_prev_image.cgi?image="
+                +filename+".jpg"),
+        )
+
+        def measure():
+            # settings like the session engine are read when the client is made
+            client = Client()
+            client.force_login(user)
+            results = []
+            for name, url in endpoints:
+                resp = client.get(url)
+                if resp.status_code != 200:
+                    raise CommandError("{} returned status {}".format(
+                        name, resp.status_code))
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        client.get(url)
+                    elapsed = time.perf_counter()-start
+                results.append((len(queries)/repeat, elapsed*1000/repeat))
+            # get rid of the session and whatever the cache remembered about
+            # the user, since the database changes are about to be rolled back
+            client.logout()
+            forget_user(user.pk)
+            return results
+
+        try:
+            with transaction.atomic(), \
+                    override_settings(ALLOWED_HOSTS=["testserver"]):
+                with override_settings(**UNCACHED_SETTINGS):
+                    before = measure()
+                after = measure()
+                raise Rollback()
+        except Rollback:
+            pass
+
+        print("user {}, annotation {}, {} requests each".format(
+            user.email, annotation.pk, repeat))
+        print("{:<10} {:>15} {:>15}".format(
+            "endpoint", "before", "after"))
+        for (name, url), (bq, bt), (aq, at) in zip(endpoints, before, after):
+            print("{:<10} {:>4.1f}q {:>6.1f}ms {:>4.1f}q {:>6.1f}ms".format(
+                name, bq, bt, aq, at))
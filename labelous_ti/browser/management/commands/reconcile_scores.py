@@ -0,0 +1,43 @@
+# check every user's points in the ledger (see browser/ledger.py) against the
+# points added up from scratch and report the ones that don't match. with --fix,
+# the ledger is rewritten with the recomputed points.
+
+from django.core.management.base import BaseCommand
+
+from browser.models import UserScore
+from browser.ledger import recompute_scores, rebuild_scores
+
+# the ledger adds up floats in a different order than the database, so allow
+# for a little rounding error
+TOLERANCE = 0.01
+
+FIELDS = ("inprogress_points", "pending_points", "finished_points",
+    "num_images", "total_points")
+
+class Command(BaseCommand):
+    help = "Verify users' points against a full recompute."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true",
+            help="Rewrite the points of all users from the recompute.")
+
+    def handle(self, *args, **options):
+        expected = recompute_scores()
+        ledger = UserScore.objects.in_bulk()
+
+        num_wrong = 0
+        for user_id, score in sorted(expected.items()):
+            current = ledger.get(user_id, UserScore(user_id=user_id))
+            wrong = [field for field in FIELDS
+                if abs(getattr(current, field)-getattr(score, field)) >
+                    TOLERANCE]
+            if len(wrong) > 0:
+                num_wrong += 1
+                print("user {}: {}".format(user_id, ", ".join(
+                    "{} {:.1f}->{:.1f}".format(field, getattr(current, field),
+                        getattr(score, field)) for field in wrong)))
+
+        print("{} of {} users don't match".format(num_wrong, len(expected)))
+        if options["fix"]:
+            rebuild_scores()
+            print("Rebuilt all users' points")
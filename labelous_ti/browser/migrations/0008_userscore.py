@@ -0,0 +1,62 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:45
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum, Q
+import django.db.models.deletion
+
+
+# add up everyone's points, the same way ledger.recompute_scores does
+def fill_scores(apps, schema_editor):
+    User = apps.get_model("browser", "User")
+    UserScore = apps.get_model("browser", "UserScore")
+    Annotation = apps.get_model("label_app", "Annotation")
+    Image = apps.get_model("image_mgr", "Image")
+
+    scores = {pk: UserScore(user_id=pk)
+        for pk in User.objects.values_list("pk", flat=True)}
+    for points in Annotation.objects.filter(deleted=False,
+            image__deleted=False).values("annotator").annotate(
+                inprogress=Sum("score", filter=Q(locked=False, finished=False)),
+                pending=Sum("score", filter=Q(locked=True, finished=False)),
+                finished=Sum("score", filter=Q(finished=True))).order_by():
+        score = scores[points["annotator"]]
+        score.inprogress_points = points["inprogress"] or 0
+        score.pending_points = points["pending"] or 0
+        score.finished_points = points["finished"] or 0
+    for uploader_id, num_images in Image.objects.filter(available=True,
+            deleted=False).values("uploader").annotate(
+                count=Count("pk")).values_list("uploader", "count").order_by():
+        scores[uploader_id].num_images = num_images
+    for score in scores.values():
+        score.total_points = score.finished_points + score.num_images*2
+
+    UserScore.objects.bulk_create(scores.values(), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('browser', '0007_remove_user_username'),
+        ('image_mgr', '0009_image_queue'),
+        ('label_app', '0007_anno_user_image_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserScore',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='score', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('inprogress_points', models.FloatField(default=0)),
+                ('pending_points', models.FloatField(default=0)),
+                ('finished_points', models.FloatField(default=0)),
+                ('num_images', models.IntegerField(default=0)),
+                ('total_points', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_scores, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='userscore',
+            index=models.Index(fields=['-total_points', 'user'], name='leaderboard_idx'),
+        ),
+    ]
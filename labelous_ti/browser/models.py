@@ -59,3 +59,37 @@ class User(AbstractUser):
             return True
         else:
             return contest_info.has_opened(when)
+
+# how many points an approved image upload is worth
+IMAGE_POINTS = 2
+
+# each user's points, kept up to date as annotations and images change (see
+# ledger.py) so the account page and the leaderboard don't have to add up all
+# of the user's annotations every time.
+class UserScore(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+        primary_key=True, related_name="score")
+    # points from the user's annotations in each state. annotations on deleted
+    # images don't count.
+    inprogress_points = models.FloatField(default=0)
+    pending_points = models.FloatField(default=0)
+    finished_points = models.FloatField(default=0)
+    # how many of the user's uploaded images were approved
+    num_images = models.IntegerField(default=0)
+    # finished_points + IMAGE_POINTS*num_images, stored so the leaderboard can
+    # be sorted with an index
+    total_points = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-total_points", "user"],
+                name="leaderboard_idx"),
+        ]
+
+    @property
+    def image_points(self):
+        return self.num_images * IMAGE_POINTS
+
+    @property
+    def total_prelim_points(self):
+        return self.inprogress_points + self.pending_points
@@ -1,3 +1,179 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.urls import reverse
+from django.utils import timezone
 
-# Create your tests here.
+from unittest import mock
+import datetime
+import time
+
+from labelous import contest_info
+from .models import User
+from .auth_backend import CachedModelBackend, user_key
+from image_mgr.models import Image, calculate_thumb_size
+from label_app.models import (Annotation, Label, Polygon, pack_points,
+    get_labels)
+from label_app.overlay import sprite_url
+
+# the browse, review and account pages, and the overlay sprite they load, should
+# take the same number of queries however many annotations there are, and
+# shouldn't get slow as they pile up. each is checked with this many
+# annotations, in seconds of render time.
+PAGE_SIZES = {10: 1, 100: 2, 1000: 5}
+
+# separate local caches, so the tests don't share the real one
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_default',
+    },
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_auth',
+    },
+}
+
+@override_settings(CACHES=TEST_CACHES, COMPRESS_ENABLED=False,
+    COMPRESS_OFFLINE=False)
+class ListPageTests(TestCase):
+    def setUp(self):
+        for alias in TEST_CACHES.keys():
+            caches[alias].clear()
+        # the contest is long over, and nothing but the finished annotations
+        # can be browsed once it is
+        patcher = mock.patch.object(contest_info, "_real_close_date",
+            timezone.now()+datetime.timedelta(days=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user("annotator@example.com")
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="reviewer"))
+        self.client.force_login(self.user)
+        self.label = Label.objects.create(name="car", score=1, choice=True)
+        # every process has the labels loaded nearly all the time
+        get_labels()
+        self.num_images = 0
+
+    # give the user num more annotations in each state, each on its own image
+    def add_annotations(self, num):
+        images = []
+        for i in range(self.num_images, self.num_images+num):
+            image_x, image_y = 4000, 3000-i
+            thumb_x, thumb_y = calculate_thumb_size((image_x, image_y))
+            images.append(Image(file_path="image_{}".format(i),
+                available=True, uploaded=True,
+                original_hash=i.to_bytes(32, "big"),
+                image_x=image_x, image_y=image_y,
+                thumb_x=thumb_x, thumb_y=thumb_y, uploader=self.user))
+        self.num_images += num
+        Image.objects.bulk_create(images)
+        images = Image.objects.filter(
+            file_path__in=[image.file_path for image in images])
+
+        now = timezone.now()
+        annotations = []
+        for image in images:
+            for locked, finished in ((False, False), (True, False),
+                    (True, True)):
+                annotations.append(Annotation(annotator=self.user,
+                    image=image, locked=locked, finished=finished,
+                    edit_key=b"", last_edit_time=now, score=1))
+        Annotation.objects.bulk_create(annotations)
+
+        # and give each one a polygon to draw. bulk_create doesn't call save,
+        # so the points have to be packed here.
+        points = [10, 20, 3000, 20, 3000, 2000]
+        Polygon.objects.bulk_create(Polygon(annotation=annotation,
+                label=self.label, points=points,
+                packed_points=pack_points(points), last_edit_time=now)
+            for annotation in Annotation.objects.filter(
+                image__file_path__in=[image.file_path for image in images]))
+
+    # request the url given by get_url() at each size and make sure it takes
+    # num_queries queries and renders quickly enough
+    def check_requests(self, get_url, num_queries):
+        # the first request loads the user and their permissions into the
+        # cache, which isn't what we're measuring
+        self.assertEqual(self.client.get(get_url()).status_code, 200)
+
+        for num, time_limit in PAGE_SIZES.items():
+            self.add_annotations(num-self.num_images)
+            url = get_url()
+            with self.subTest(annotations=num):
+                start = time.perf_counter()
+                with self.assertNumQueries(num_queries):
+                    resp = self.client.get(url)
+                elapsed = time.perf_counter()-start
+                self.assertEqual(resp.status_code, 200)
+                self.assertLess(elapsed, time_limit)
+
+    def check_page(self, url_name, num_queries):
+        url = reverse(url_name)
+        self.check_requests(lambda: url, num_queries)
+
+    def test_browse_in_progress(self):
+        self.check_page("annos_in_progress", 1)
+
+    def test_browse_pending_review(self):
+        self.check_page("annos_pending_review", 1)
+
+    def test_browse_finished(self):
+        self.check_page("annos_finished", 1)
+
+    def test_review_annotations(self):
+        self.check_page("anno_review", 1)
+
+    def test_account_stats(self):
+        self.check_page("account_stats", 1)
+
+    def test_annotation_sprite(self):
+        # the sprite of the finished annotations, like the finished page shows.
+        # it can't be empty, so start off with one.
+        self.add_annotations(1)
+        def get_url():
+            return sprite_url(list(Annotation.objects.filter(
+                annotator=self.user, finished=True)))
+        self.check_requests(get_url, 2)
+
+@override_settings(CACHES=TEST_CACHES)
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        for alias in TEST_CACHES.keys():
+            caches[alias].clear()
+        self.user = User.objects.create_user("annotator@example.com")
+        self.backend = CachedModelBackend()
+        # load the user and their permissions into the cache
+        self.backend.get_user(self.user.pk)
+        self.backend.has_perm(self.backend.get_user(self.user.pk),
+            "browser.reviewer")
+
+    # run func, and return the functions it left to run after the commit
+    def commit_callbacks(self, func):
+        with mock.patch("browser.auth_backend.transaction.on_commit") \
+                as on_commit:
+            func()
+        return [call[0][0] for call in on_commit.call_args_list]
+
+    def test_user_forgotten_after_commit(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        callbacks = self.commit_callbacks(user.save)
+        # nothing is forgotten before the commit, since someone could just
+        # cache the old user again
+        self.assertIsNotNone(caches["auth"].get(user_key(user.pk)))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(self.backend.get_user(user.pk))
+
+    def test_perms_forgotten_after_commit(self):
+        callbacks = self.commit_callbacks(
+            lambda: self.user.user_permissions.add(
+                Permission.objects.get(codename="reviewer")))
+        user = self.backend.get_user(self.user.pk)
+        self.assertFalse(self.backend.has_perm(user, "browser.reviewer"))
+        for callback in callbacks:
+            callback()
+        user = self.backend.get_user(self.user.pk)
+        self.assertTrue(self.backend.has_perm(user, "browser.reviewer"))
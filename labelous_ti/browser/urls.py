@@ -29,6 +29,11 @@ urlpatterns = [
         name="account_stats"),
     path('account/changepw/', views.account_changepw,
         name="account_changepw"),
+    path('account/leaderboard/', login_required(views.account_leaderboard),
+        name="account_leaderboard"),
+    path('account/leaderboard.csv',
+        login_required(views.account_leaderboard_csv),
+        name="account_leaderboard_csv"),
     path('account/create/', login_required(views.account_create),
         name="account_create"),
     path('account/make_token/', login_required(views.account_maketoken),
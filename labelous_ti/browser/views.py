@@ -1,8 +1,7 @@
 from django.shortcuts import render, redirect, reverse
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from django.core.exceptions import SuspiciousOperation, ValidationError
 from django.contrib import messages
-from django.db.models import OuterRef, Exists, Sum
 from django.db import IntegrityError, transaction
 from django.contrib.auth.models import BaseUserManager
 from django.contrib.auth.decorators import permission_required
@@ -11,15 +10,26 @@ from django.contrib.auth.password_validation import (
 from django.contrib.auth import authenticate
 
 import secrets
+import csv
+import io
 
 from labelous import contest_info
-from .models import User
-from image_mgr.models import Image
+from .models import User, UserScore
+from .ledger import anno_points_field, move_anno_points, approve_images
+from image_mgr.models import Image, ImageQueueEntry
+from image_mgr.assignment import start_annotation, release_image, add_images
 from label_app.models import Annotation
+from label_app.overlay import set_sprite_urls
 
 def credits_page(request):
     return render(request, "browser/credits.html")
 
+# the fields of each annotation (and its image) that the browse and review
+# pages actually show, so we only load those
+BROWSE_ANNO_FIELDS = ("pk", "score", "comment", "last_edit_time",
+    "image", "image__thumb_x", "image__thumb_y",
+    "image__image_x", "image__image_y")
+
 # show all the annotations the user has and give them options to edit the
 # annotation or otherwise modify them
 def browse_view(request):
@@ -52,10 +62,14 @@ def browse_view(request):
         locked = True
         finished = True
 
-    annotations = Annotation.objects.order_by('pk').filter(
+    annotations = list(Annotation.objects.order_by('pk').filter(
         annotator=request.user, deleted=False, locked=locked, finished=finished,
-        image__deleted=False)
+        image__deleted=False).select_related("image").only(
+            *BROWSE_ANNO_FIELDS))
 
+    # the overlays come from a few big sprites so the page doesn't have to make
+    # a request for each one
+    set_sprite_urls(annotations)
     return render(request, "browser/browse.html", 
         {"annotations": annotations})
 
@@ -79,31 +93,10 @@ def handle_browse_modify(request):
     if action == "new":
         try:
             with transaction.atomic():
-                # get all the annotations the user is already working on or has
-                # completed
-                existing_annos = Annotation.objects.filter(
-                    annotator=request.user, deleted=False)
-                # then look for an image that the user doesn't already have an
-                # annotation for. we select for update so that another process
-                # can't turn the same image into another annotation, but we skip
-                # locked so that that process can choose another image.
-                not_on_existing_anno = ~Exists(existing_annos.filter(
-                    image__pk=OuterRef("pk")))
-                # we pick the image with the least number of existing
-                # annotations so that no image gets left behind
-                new_image = Image.objects.select_for_update(
-                    skip_locked=True).filter(not_on_existing_anno).filter(
-                        available=True, deleted=False).order_by(
-                            "num_annotations")[0:1].get()
-                # now we can create an annotation for that image
-                new_anno = Annotation(
-                    annotator=request.user, image=new_image,
-                    edit_key=b"", last_edit_time=request.when)
-                new_anno.save()
-                # mark that the image has another annotation attached
-                new_image.num_annotations += 1
-                new_image.save()
-        except Image.DoesNotExist:
+                # take the image with the least annotations that the user
+                # doesn't already have one for and make an annotation for it
+                new_anno = start_annotation(request.user, request.when)
+        except ImageQueueEntry.DoesNotExist:
             messages.add_message(request, messages.ERROR,
                 "There are no more images to annotate. Good job!")
             return redirect("annos_in_progress")
@@ -123,15 +116,13 @@ def handle_browse_modify(request):
             # while we're changing it and put us in a weird state
             annotation = Annotation.objects.select_for_update().get(pk=anno_id,
                 annotator=request.user, deleted=False, finished=False)
+            old_points_field = anno_points_field(annotation)
 
             if action == "delete":
                 annotation.deleted = True
                 # subtract 1 from the associated image's annotation count
                 # because one less annotation exists
-                image = Image.objects.select_for_update().get(
-                    pk=annotation.image.pk)
-                image.num_annotations -= 1
-                image.save()
+                release_image(annotation.image_id)
                 messages.add_message(request, messages.SUCCESS,
                     "Annotation deleted.")
             elif action == "review":
@@ -150,6 +141,9 @@ def handle_browse_modify(request):
                     "Annotation review cancelled.")
                 destination = "annos_in_progress"
 
+            # move the annotation's points to go with its new state
+            move_anno_points(annotation, old_points_field,
+                None if annotation.deleted else anno_points_field(annotation))
             annotation.save()
     except (Annotation.DoesNotExist, ModificationFailure):
         # these might happen if the user changes something in one tab and then
@@ -164,6 +158,33 @@ def handle_browse_modify(request):
     return redirect(destination)
 
 
+# how many items to show on each page of the review queues
+REVIEW_PAGE_SIZE = 50
+
+# get a page of a review queue. pages are keyed on the pk of the last item on
+# the previous page, so getting any page is just an index lookup no matter how
+# long the queue is. returns (items, next page's key or None if it's the last).
+def get_review_page(request, queryset):
+    try:
+        after = int(request.GET.get("after", 0))
+    except ValueError as e:
+        raise SuspiciousOperation("bad page") from e
+
+    # get one extra so we know if there's another page after this one
+    items = list(queryset.filter(pk__gt=after).order_by(
+        'pk')[:REVIEW_PAGE_SIZE+1])
+    if len(items) > REVIEW_PAGE_SIZE:
+        items = items[:REVIEW_PAGE_SIZE]
+        return items, items[-1].pk
+    return items, None
+
+# send the reviewer back to the page of the queue they were looking at
+def redirect_review_page(request, destination):
+    url = reverse(destination)
+    if "after" in request.GET:
+        url += "?"+request.GET.urlencode()
+    return redirect(url)
+
 # let reviewers review others' annotations
 @permission_required("browser.reviewer", raise_exception=True)
 def review_annotations(request):
@@ -184,6 +205,7 @@ def review_annotations(request):
                 # state
                 annotation = Annotation.objects.select_for_update().get(
                     pk=anno_id, deleted=False, finished=False)
+                old_points_field = anno_points_field(annotation)
 
                 annotation.comment = comment
                 if action == "accept_anno":
@@ -201,6 +223,8 @@ def review_annotations(request):
                     messages.add_message(request, messages.SUCCESS,
                         "Annotation rejected and sent back to user.")
 
+                move_anno_points(annotation, old_points_field,
+                    anno_points_field(annotation))
                 annotation.save()
         except (Annotation.DoesNotExist, ModificationFailure):
             # these might happen if the user tries to change something while the
@@ -212,14 +236,18 @@ def review_annotations(request):
                 "operations on the same annotation are attempted in multiple "
                 "tabs. Please retry the operation.")
 
-        return redirect("anno_review")
+        return redirect_review_page(request, "anno_review")
 
-    annotations = Annotation.objects.order_by('pk').filter(
-        deleted=False, locked=True, finished=False,
-        image__deleted=False).select_related("annotator")
+    annotations, next_after = get_review_page(request,
+        Annotation.objects.filter(
+            deleted=False, locked=True, finished=False,
+            image__deleted=False).select_related("image", "annotator").only(
+                *BROWSE_ANNO_FIELDS, "annotator", "annotator__email"))
 
+    set_sprite_urls(annotations)
     return render(request, "browser/review.html", 
-        {"annotations": annotations})
+        {"annotations": annotations,
+         "next_after": next_after})
 
 # and newly uploaded images
 @permission_required("browser.reviewer", raise_exception=True)
@@ -242,6 +270,10 @@ def review_images(request):
 
                 if action == "accept_image":
                     image.available = True
+                    # users can start annotating it now
+                    add_images([image.pk])
+                    # and the uploader gets points for it
+                    approve_images([image])
                     messages.add_message(request, messages.SUCCESS,
                         "Image now available for users to annotate.")
                 elif action == "delete_image":
@@ -260,13 +292,17 @@ def review_images(request):
                 "operations on the same annotation are attempted in multiple "
                 "tabs. Please retry the operation.")
 
-        return redirect("image_review")
+        return redirect_review_page(request, "image_review")
 
-    images = Image.objects.order_by('pk').filter(
-        available=False, deleted=False).select_related("uploader")
+    images, next_after = get_review_page(request,
+        Image.objects.filter(
+            available=False, deleted=False).select_related("uploader").only(
+                "pk", "thumb_x", "thumb_y", "image_x", "image_y",
+                "uploader", "uploader__email"))
 
     return render(request, "browser/review.html", 
-        {"images": images})
+        {"images": images,
+         "next_after": next_after})
 
 
 def account_stats(request):
@@ -285,35 +321,79 @@ def account_stats(request):
             messages.add_message(request, messages.ERROR,
                 "Mind your own business.")
 
-    annos = Annotation.objects.filter(
-        annotator=user, deleted=False, image__deleted=False)
-    inprogress_points = annos.filter(locked=False, finished=False).aggregate(
-        points=Sum('score'))["points"]
-    pending_points = annos.filter(locked=True, finished=False).aggregate(
-        points=Sum('score'))["points"]
-    finished_points = annos.filter(finished=True).aggregate(
-        points=Sum('score'))["points"]
-    # for some reason, aggregates return None if there are no objects
-    if inprogress_points is None: inprogress_points = 0
-    if pending_points is None: pending_points = 0
-    if finished_points is None: finished_points = 0
-
-    images = Image.objects.filter(uploader=user, available=True, deleted=False)
-    image_points = images.count() * 2
-
-    total_prelim_points = inprogress_points + pending_points
-    total_points = finished_points + image_points
+    # the points are kept up to date in the user's score. users who haven't
+    # done anything yet don't have one.
+    try:
+        score = user.score
+    except UserScore.DoesNotExist:
+        score = UserScore(user=user)
 
     return render(request, "browser/account.html",
         {"info_email": user.email,
 
-         "inprogress_points": inprogress_points,
-         "pending_points": pending_points,
-         "total_prelim_points": total_prelim_points,
+         "inprogress_points": score.inprogress_points,
+         "pending_points": score.pending_points,
+         "total_prelim_points": score.total_prelim_points,
+
+         "finished_points": score.finished_points,
+         "image_points": score.image_points,
+         "total_points": score.total_points})
 
-         "finished_points": finished_points,
-         "image_points": image_points,
-         "total_points": total_points})
+# how many users to show on each page of the leaderboard
+LEADERBOARD_PAGE_SIZE = 50
+
+# the users' scores in leaderboard order
+def leaderboard_scores():
+    return UserScore.objects.select_related("user").only(
+        "user__email", "inprogress_points", "pending_points",
+        "finished_points", "num_images", "total_points").order_by(
+            "-total_points", "user")
+
+# show everyone's points, best first. unlike the review queues, this is paged by
+# number so each user's rank can be shown; there's one row per user so it never
+# gets that long.
+@permission_required("browser.account_manager", raise_exception=True)
+def account_leaderboard(request):
+    try:
+        page = int(request.GET.get("page", 1))
+        if page < 1:
+            raise ValueError("bad page")
+    except ValueError as e:
+        raise SuspiciousOperation("bad page") from e
+
+    first = (page-1)*LEADERBOARD_PAGE_SIZE
+    # get one extra so we know if there's another page after this one
+    scores = list(leaderboard_scores()[first:first+LEADERBOARD_PAGE_SIZE+1])
+    has_next = len(scores) > LEADERBOARD_PAGE_SIZE
+
+    return render(request, "browser/account.html",
+        {"scores": scores[:LEADERBOARD_PAGE_SIZE],
+         "first_rank": first+1,
+         "prev_page": page-1 if page > 1 else None,
+         "next_page": page+1 if has_next else None})
+
+# the whole leaderboard as a CSV file. it's generated as it's sent so it doesn't
+# have to all be in memory at once.
+@permission_required("browser.account_manager", raise_exception=True)
+def account_leaderboard_csv(request):
+    def rows():
+        yield csv_row(("rank", "email", "total_points", "finished_points",
+            "image_points", "pending_points", "inprogress_points"))
+        for rank, score in enumerate(leaderboard_scores().iterator(), 1):
+            yield csv_row((rank, score.user.email, score.total_points,
+                score.finished_points, score.image_points,
+                score.pending_points, score.inprogress_points))
+
+    response = StreamingHttpResponse(rows(), content_type="text/csv")
+    response["Content-Disposition"] = \
+        'attachment; filename="leaderboard.csv"'
+    return response
+
+# format one row of a CSV file
+def csv_row(row):
+    out = io.StringIO()
+    csv.writer(out).writerow(row)
+    return out.getvalue()
 
 def do_changepw(request):
     if request.user.is_authenticated:
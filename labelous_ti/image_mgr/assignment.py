@@ -0,0 +1,69 @@
+# hand out images for users to annotate.
+
+# THEORY OF OPERATION
+
+# when a user starts a new annotation, we give them the available image with the
+# least annotations that they don't already have an annotation for, so that no
+# image gets left behind. lots of users tend to do this at the same time (e.g.
+# when a class starts), so it has to be quick and must not make users wait on
+# each other.
+
+# every available image has an ImageQueueEntry with its annotation count. the
+# entries are indexed by (count, image), so walking that index from the start
+# visits the emptiest bucket first, and the first entry that works is the one we
+# want. an entry works if the user has no annotation for its image, which is a
+# single lookup in the (annotator, image) index on annotations.
+
+# the entry is locked until the new annotation is committed so that nobody else
+# gets the same image at the same time. other users skip locked entries instead
+# of waiting for them and just take the next one. only the entry is locked and
+# updated, not the (big and often read) image row.
+
+# the queue has to be kept in sync with the images: add_images when images
+# become available and remove_images when they are deleted. if it gets out of
+# sync anyway, the rebuild_assign_queue command fixes it up.
+
+from django.db.models import OuterRef, Exists, Count, Q, F
+
+from .models import Image, ImageQueueEntry
+from label_app.models import Annotation
+
+# start a new annotation for the given user on the next image from the queue and
+# return it. must be called in a transaction. raises
+# ImageQueueEntry.DoesNotExist if there's no image left for the user.
+def start_annotation(user, when):
+    users_annos = Annotation.objects.filter(annotator=user, deleted=False,
+        image_id=OuterRef("image_id"))
+    entry = ImageQueueEntry.objects.select_for_update(
+        skip_locked=True).filter(~Exists(users_annos)).order_by(
+            "num_annotations", "image_id")[0:1].get()
+
+    annotation = Annotation(annotator=user, image_id=entry.image_id,
+        edit_key=b"", last_edit_time=when)
+    annotation.save()
+    # count it while we still have the lock
+    entry.num_annotations += 1
+    entry.save(update_fields=["num_annotations"])
+
+    return annotation
+
+# note that an annotation on the given image was deleted
+def release_image(image_id):
+    ImageQueueEntry.objects.filter(image_id=image_id).update(
+        num_annotations=F("num_annotations")-1)
+
+# put the images with the given IDs in the queue. they should be available and
+# not deleted. images already in the queue are left alone.
+def add_images(image_ids):
+    counts = Image.objects.filter(pk__in=image_ids).annotate(
+        num_annotations=Count("annotations",
+            filter=Q(annotations__deleted=False))).values_list(
+                "pk", "num_annotations")
+    ImageQueueEntry.objects.bulk_create(
+        [ImageQueueEntry(image_id=pk, num_annotations=num_annotations)
+            for pk, num_annotations in counts],
+        batch_size=2000, ignore_conflicts=True)
+
+# take the images with the given IDs out of the queue
+def remove_images(image_ids):
+    ImageQueueEntry.objects.filter(image_id__in=image_ids).delete()
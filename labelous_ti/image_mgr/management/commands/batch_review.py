@@ -8,6 +8,8 @@ from django.core.management.base import BaseCommand, CommandError
 import pathlib
 
 from image_mgr.models import Image
+from image_mgr.assignment import add_images
+from browser.ledger import approve_images
 
 class Command(BaseCommand):
     help = "Regenerate thumbnails for all images in the database."
@@ -40,7 +42,16 @@ class Command(BaseCommand):
             uploaded=True, deleted=False, available=False)
 
         if options["review_action"] == "accept":
-            num_accepted = images.update(available=True)
+            with transaction.atomic():
+                accepted_ids = list(images.select_for_update().values_list(
+                    "pk", flat=True))
+                num_accepted = Image.objects.filter(
+                    pk__in=accepted_ids).update(available=True)
+                # users can start annotating them now
+                add_images(accepted_ids)
+                # and the uploaders get points for them
+                approve_images(Image.objects.filter(
+                    pk__in=accepted_ids).only("uploader"))
             print("Accepted {} images".format(num_accepted))
         elif options["review_action"] == "delete":
             num_deleted = images.update(deleted=True)
@@ -1,30 +1,46 @@
 # upload a pile of images from the given list. the given list has one path per
 # line, where each path points to a specific image to upload. it outputs the
 # uploaded image info into a comma separated list, where each line is
-# image_pk,status,path. 
+# image_pk,status,path.
+
+# with --jobs, the slow part of processing (jpegtran and thumbnailing) is done
+# in a pool of processes (see transcode_pool.py). the database is only touched
+# from this process, and the output list is still written in the same order as
+# the input list.
 
 from django.db import transaction
 from django.core.management.base import BaseCommand, CommandError
 
+import collections
 import pathlib
+import time
 
 from browser.models import User
 from image_mgr.models import Image
-from image_mgr.process_image import (process_image, MAX_IMAGE_SIZE,
-    ProcessingFailure, UnacceptableImage)
+from image_mgr.process_image import (start_image, transcode_image,
+    finish_image, MAX_IMAGE_SIZE, ProcessingFailure, UnacceptableImage)
+from image_mgr.transcode_pool import TranscodePool
+
+# how often to report progress, in files
+PROGRESS_INTERVAL = 100
 
 class Command(BaseCommand):
-    help = "Regenerate thumbnails for all images in the database."
+    help = "Upload all the images in the given list."
 
     def add_arguments(self, parser):
         parser.add_argument("file_list", type=str)
         parser.add_argument("output_list", type=str)
+        parser.add_argument("--jobs", type=int, default=1,
+            help="Number of processes to process images with.")
 
     def handle(self, *args, **options):
         file_list = pathlib.Path(options["file_list"]).resolve(strict=True)
         output_list = pathlib.Path(options["output_list"])
         if output_list.exists():
             raise Exception("output list already exists")
+        jobs = options["jobs"]
+        if jobs < 1:
+            raise CommandError("--jobs must be at least 1")
 
         file_list = open(file_list, "r")
         output_list = open(output_list, "w")
@@ -35,44 +51,88 @@ class Command(BaseCommand):
             is_superuser=True).order_by('pk')[:1].get()
         print("Uploading as '{}'".format(uploader))
 
-        for file_name in file_list:
-            try:
-                file_name = pathlib.Path(file_name.replace("\n", ""))
-                image_file = open(file_name, "rb")
-                image_data = image_file.read(MAX_IMAGE_SIZE+1)
-                image_file.close()
-            except Exception as e:
-                msg = ",read_error:{},{}\n".format(
-                    str(e).replace(","," "), file_name)
-                print(msg, end="")
-                output_list.write(msg)
-                continue
-
-            if len(image_data) > MAX_IMAGE_SIZE:
-                msg = ",too_big,{}\n".format(file_name)
-                print(msg, end="")
-                output_list.write(msg)
-                continue
+        pool = TranscodePool(jobs)
 
-            try:
-                new_image = process_image(uploader=uploader,
-                    name=file_name.name, orig_data=image_data)
-            except ProcessingFailure as e:
-                msg = ",corrupt:{},{}\n".format(
-                    str(e).replace(","," "), file_name)
-                print(msg, end="")
-                output_list.write(msg)
-            except UnacceptableImage as e:
-                msg = ",unacceptable:{},{}\n".format(
-                    str(e).replace(","," "), file_name)
-                print(msg, end="")
-                output_list.write(msg)
-            else:
-                msg = "{},ok,{}\n".format(
-                    new_image.pk, file_name)
-                print(msg, end="")
-                output_list.write(msg)
+        # files that have been started, in order. we keep a few more than the
+        # number of jobs in flight so the pool never runs dry waiting for us.
+        pending = collections.deque()
+        start_time = time.monotonic()
+        num_done = 0
+        try:
+            for file_name in file_list:
+                pending.append(self.start_file(uploader, pool, file_name))
+                while len(pending) > jobs*2:
+                    self.finish_file(output_list, *pending.popleft())
+                    num_done += 1
+                    self.report_progress(pool, num_done, start_time)
+            while len(pending) > 0:
+                self.finish_file(output_list, *pending.popleft())
+                num_done += 1
+                self.report_progress(pool, num_done, start_time)
+        finally:
+            pool.shutdown()
 
         file_list.close()
         output_list.close()
+        self.report_progress(pool, num_done, start_time, force=True)
         print("Complete")
+
+    # read the file and claim it in the database, then start processing it.
+    # returns (file_name, message, image, future). if message isn't None,
+    # the file is already done with and message is its output line.
+    def start_file(self, uploader, pool, file_name):
+        try:
+            file_name = pathlib.Path(file_name.replace("\n", ""))
+            image_file = open(file_name, "rb")
+            image_data = image_file.read(MAX_IMAGE_SIZE+1)
+            image_file.close()
+        except Exception as e:
+            msg = ",read_error:{},{}\n".format(
+                str(e).replace(","," "), file_name)
+            return (file_name, msg, None, None)
+
+        if len(image_data) > MAX_IMAGE_SIZE:
+            msg = ",too_big,{}\n".format(file_name)
+            return (file_name, msg, None, None)
+
+        try:
+            image = start_image(uploader, image_data)
+        except Exception as e:
+            return (file_name, self.error_message(e, file_name), None, None)
+        if image is None:
+            msg = ",duplicate,{}\n".format(file_name)
+            return (file_name, msg, None, None)
+
+        future = pool.submit(transcode_image, image_data)
+
+        return (file_name, None, image, future)
+
+    # wait for the file to be processed, then save it and write out its result
+    def finish_file(self, output_list, file_name, msg, image, future):
+        if msg is None:
+            try:
+                new_image = finish_image(image, file_name.name, future.result())
+            except Exception as e:
+                msg = self.error_message(e, file_name)
+            else:
+                msg = "{},ok,{}\n".format(new_image.pk, file_name)
+
+        print(msg, end="")
+        output_list.write(msg)
+
+    def error_message(self, e, file_name):
+        if isinstance(e, ProcessingFailure):
+            status = "corrupt"
+        elif isinstance(e, UnacceptableImage):
+            status = "unacceptable"
+        else:
+            raise e
+        return ",{}:{},{}\n".format(status, str(e).replace(","," "), file_name)
+
+    def report_progress(self, pool, num_done, start_time, force=False):
+        if num_done % PROGRESS_INTERVAL != 0 and not force:
+            return
+        elapsed = time.monotonic() - start_time
+        self.stderr.write("{} files in {:.1f}s ({:.2f} files/s)".format(
+            num_done, elapsed, num_done/elapsed if elapsed > 0 else 0))
+        self.stderr.write(pool.stats())
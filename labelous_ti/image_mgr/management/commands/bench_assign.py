@@ -0,0 +1,83 @@
+# simulate a bunch of users clicking "Start a New Annotation" at the same moment
+# and time how long each of them takes to get an image. each simulated user is a
+# thread with its own database connection. they all start together and hold on
+# to their transactions until everyone has an image, which is the worst case for
+# lock contention. the transactions are then rolled back, so nothing is changed
+# and it's safe to run on the live database (though the users it picks will
+# briefly be unable to start annotations).
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import threading
+import time
+
+from browser.models import User
+from image_mgr.models import ImageQueueEntry
+from image_mgr.assignment import start_annotation
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = "Benchmark many users starting annotations at the same time."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--starters", type=int, default=50,
+            help="Number of users starting at once. Each needs a database "
+                "connection.")
+
+    def handle(self, *args, **options):
+        starters = options["starters"]
+        if starters < 1:
+            raise CommandError("--starters must be at least 1")
+        users = list(User.objects.order_by("?")[:starters])
+        if len(users) < starters:
+            raise CommandError("only {} users exist".format(len(users)))
+
+        start_barrier = threading.Barrier(starters)
+        end_barrier = threading.Barrier(starters)
+        # (seconds, image id or None if there was nothing left) for each user
+        results = [None]*starters
+
+        def starter(index):
+            user = users[index]
+            try:
+                with transaction.atomic():
+                    start_barrier.wait()
+                    start = time.perf_counter()
+                    try:
+                        image_id = start_annotation(user,
+                            timezone.now()).image_id
+                    except ImageQueueEntry.DoesNotExist:
+                        image_id = None
+                    results[index] = (time.perf_counter()-start, image_id)
+                    end_barrier.wait()
+                    raise Rollback()
+            except Rollback:
+                pass
+            except Exception:
+                # don't leave everyone else waiting for us
+                start_barrier.abort()
+                end_barrier.abort()
+                raise
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=starter, args=(i,))
+            for i in range(starters)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if None in results:
+            raise CommandError("some starters failed")
+        times = sorted(r[0]*1000 for r in results)
+        image_ids = [r[1] for r in results if r[1] is not None]
+        print("{} starters, {} got images, {} distinct".format(
+            starters, len(image_ids), len(set(image_ids))))
+        print("avg {:.1f}ms, median {:.1f}ms, 95% {:.1f}ms, max {:.1f}ms".format(
+            sum(times)/len(times), times[len(times)//2],
+            times[min(len(times)-1, len(times)*95//100)], times[-1]))
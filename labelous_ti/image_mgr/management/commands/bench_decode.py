@@ -0,0 +1,95 @@
+# compare the time and peak memory of making a thumbnail by decoding the whole
+# image (how it used to be done) against having the JPEG decoder scale the image
+# down while decoding (how make_thumbnail does it). also times all of
+# make_thumbnail, which encodes the thumbnail in several formats, and reading
+# just the size from the header. it doesn't change anything, so it's safe to
+# run on the live store. the images come from the database, or from a directory
+# of JPEGs with --dir.
+
+from django.core.management.base import BaseCommand, CommandError
+
+import multiprocessing
+import resource
+import pathlib
+import time
+
+import PIL.Image
+
+from image_mgr.models import Image, calculate_thumb_size
+from image_mgr.process_image import make_thumbnail, jpeg_size
+
+def full_thumbnail(path):
+    image = PIL.Image.open(path)
+    image.load() # decode the whole thing
+    image.resize(calculate_thumb_size(image.size), PIL.Image.BICUBIC)
+
+# the decoding part of make_thumbnail
+def draft_thumbnail(path):
+    image = PIL.Image.open(path)
+    thumb_size = calculate_thumb_size(image.size)
+    image.draft(image.mode, thumb_size)
+    image.resize(thumb_size, PIL.Image.BICUBIC)
+
+# all of make_thumbnail, including encoding the thumbnail and its variants
+def whole_thumbnail(path):
+    make_thumbnail(path)
+
+def probe_size(path):
+    f = open(path, "rb")
+    jpeg_size(f)
+    f.close()
+
+METHODS = (
+    ("full", full_thumbnail),
+    ("draft", draft_thumbnail),
+    ("make_thumbnail", whole_thumbnail),
+    ("probe", probe_size),
+)
+
+# run the method on the image at path and return (seconds, peak memory in KiB).
+# each call runs in a fresh process, so the peak is only from this image.
+def measure(method, path):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    method(path)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (elapsed, peak_rss - start_rss)
+
+class Command(BaseCommand):
+    help = "Benchmark time and memory of thumbnail decoding on sample images."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=20,
+            help="Number of images to sample.")
+        parser.add_argument("--dir", type=str,
+            help="Sample JPEGs from this directory instead of the database.")
+
+    def handle(self, *args, **options):
+        if options["dir"] is not None:
+            paths = sorted(pathlib.Path(options["dir"]).glob("*.jpg"))
+            paths = paths[:options["count"]]
+        else:
+            paths = [image.image_path for image in Image.objects.filter(
+                uploaded=True, deleted=False).order_by("?").only(
+                    "file_path")[:options["count"]]]
+        if len(paths) == 0:
+            raise CommandError("no images to sample")
+
+        # a new process for every measurement so earlier images don't affect the
+        # memory peak of later ones
+        pool = multiprocessing.get_context("fork").Pool(1, maxtasksperchild=1)
+        print("{} images".format(len(paths)))
+        print("method,avg_ms,max_ms,avg_peak_mib,max_peak_mib")
+        try:
+            for name, method in METHODS:
+                results = [pool.apply(measure, (method, path))
+                    for path in paths]
+                times = [r[0]*1000 for r in results]
+                peaks = [r[1]/1024 for r in results]
+                print("{},{:.1f},{:.1f},{:.1f},{:.1f}".format(name,
+                    sum(times)/len(times), max(times),
+                    sum(peaks)/len(peaks), max(peaks)))
+        finally:
+            pool.close()
+            pool.join()
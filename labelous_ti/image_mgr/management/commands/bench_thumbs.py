@@ -0,0 +1,84 @@
+# compare the size and speed of the JPEG thumbnails with the other formats in
+# THUMB_VARIANTS on a sample of images. it doesn't change anything, so it's safe
+# to run on the live store. the images come from the database, or from a
+# directory of JPEGs with --dir.
+
+from django.core.management.base import BaseCommand, CommandError
+
+import pathlib
+import time
+import io
+
+import PIL.Image
+
+from image_mgr.models import Image, THUMBNAIL_SIZE, THUMB_VARIANTS
+from image_mgr.process_image import THUMB_VARIANT_FORMATS
+
+class Command(BaseCommand):
+    help = "Benchmark the thumbnail formats on a sample of images."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=100,
+            help="Number of images to sample.")
+        parser.add_argument("--dir", type=str,
+            help="Sample JPEGs from this directory instead of the database.")
+        parser.add_argument("--mbps", type=float, default=5,
+            help="Link speed in megabits per second to estimate transfer time.")
+
+    def handle(self, *args, **options):
+        if options["dir"] is not None:
+            paths = sorted(pathlib.Path(options["dir"]).glob("*.jpg"))
+            paths = paths[:options["count"]]
+        else:
+            paths = [image.image_path for image in Image.objects.filter(
+                uploaded=True, deleted=False).order_by("?").only(
+                    "file_path")[:options["count"]]]
+        if len(paths) == 0:
+            raise CommandError("no images to sample")
+
+        # the JPEG is encoded the same way as make_thumbnail does
+        formats = [("_thumb.jpg", "JPEG", {"quality": 75})]
+        PIL.Image.init()
+        for suffix, _ in THUMB_VARIANTS:
+            format, format_options = THUMB_VARIANT_FORMATS[suffix]
+            if format in PIL.Image.SAVE:
+                formats.append((suffix, format, format_options))
+            else:
+                self.stderr.write("{} not supported, skipping".format(format))
+
+        # total (bytes, encode seconds, decode seconds) for each format
+        totals = {suffix: [0, 0, 0] for suffix, _, _ in formats}
+        for path in paths:
+            thumb = PIL.Image.open(path)
+            thumb.thumbnail(THUMBNAIL_SIZE)
+            if thumb.mode not in ("RGB", "L"):
+                thumb = thumb.convert("RGB")
+
+            for suffix, format, format_options in formats:
+                out_file = io.BytesIO()
+                start = time.perf_counter()
+                thumb.save(out_file, format=format, **format_options)
+                encode_time = time.perf_counter() - start
+
+                out_file.seek(0)
+                start = time.perf_counter()
+                PIL.Image.open(out_file).load()
+                decode_time = time.perf_counter() - start
+
+                total = totals[suffix]
+                total[0] += len(out_file.getbuffer())
+                total[1] += encode_time
+                total[2] += decode_time
+
+        n = len(paths)
+        jpeg_bytes = totals["_thumb.jpg"][0]
+        bytes_per_sec = options["mbps"]*1e6/8
+        print("{} images, transfer at {} Mbit/s".format(n, options["mbps"]))
+        print("format,avg_bytes,vs_jpeg,avg_encode_ms,avg_decode_ms,"
+            "avg_transfer_ms")
+        for suffix, format, _ in formats:
+            total_bytes, encode_time, decode_time = totals[suffix]
+            print("{},{:.0f},{:.1f}%,{:.2f},{:.2f},{:.1f}".format(
+                format, total_bytes/n, 100*total_bytes/jpeg_bytes,
+                1000*encode_time/n, 1000*decode_time/n,
+                1000*total_bytes/n/bytes_per_sec))
@@ -0,0 +1,39 @@
+# make the image pyramid levels (and tiles, if enabled) for all the images.
+# useful for images uploaded before levels existed, or if the settings changed.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from image_mgr.models import Image
+from image_mgr.process_image import make_levels, save_files
+
+class Command(BaseCommand):
+    help = "Make the pyramid levels and tiles for all images in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--missing", action="store_true",
+            help="Only make levels for images that don't have them yet.")
+
+    def handle(self, *args, **options):
+        images = Image.objects.filter(uploaded=True, deleted=False)
+        for image in images.iterator():
+            if options["missing"] and self.has_levels(image):
+                continue
+            self.stdout.write(image.file_path+"... ", ending="")
+            try:
+                levels = make_levels(image.image_path, image.image_size)
+                save_files(image.file_path, levels, [])
+            except Exception as e:
+                self.stdout.write(str(e))
+            else:
+                self.stdout.write("OK!")
+
+    # check if the image's smallest level (and first tile, if tiles are enabled)
+    # exist
+    def has_levels(self, image):
+        num_levels = image.num_levels
+        if num_levels > 0 and not image.level_path(num_levels).exists():
+            return False
+        if settings.L_IMAGE_TILES and not image.tile_path(0, 0).exists():
+            return False
+        return True
@@ -0,0 +1,167 @@
+# process images uploaded through the website. the upload view only stores the
+# image and queues an UploadJob; this command works through the queue. it
+# should be kept running alongside the web server.
+
+from django.db import transaction
+from django.db.models import Q
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import datetime
+import hashlib
+import traceback
+import time
+
+from image_mgr.models import UploadJob
+from image_mgr.process_image import (claim_image_hash, transcode_image_file,
+    finish_image, ProcessingFailure, UnacceptableImage)
+from image_mgr.transcode_pool import TranscodePool, JobTimeout
+
+# if a job has been processing for this long, the worker processing it probably
+# died, so it's given to another one
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+# how often to print the pool statistics, in seconds
+STATS_INTERVAL = 600
+
+class Command(BaseCommand):
+    help = "Process images waiting in the upload queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--jobs", type=int, default=1,
+            help="Number of images to process at once.")
+        parser.add_argument("--once", action="store_true",
+            help="Exit once the queue is empty instead of waiting for more.")
+        parser.add_argument("--poll", type=float, default=2,
+            help="Seconds to wait before checking an empty queue again.")
+
+    def handle(self, *args, **options):
+        num_jobs = options["jobs"]
+        if num_jobs < 1:
+            raise CommandError("--jobs must be at least 1")
+
+        # each process can use several hundred MiB while processing, so the
+        # number of them bounds how much memory we use
+        pool = TranscodePool(num_jobs)
+
+        last_stats = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() - last_stats >= STATS_INTERVAL:
+                    self.stderr.write(pool.stats())
+                    last_stats = time.monotonic()
+
+                jobs = self.claim_jobs(num_jobs)
+                if len(jobs) == 0:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll"])
+                    continue
+
+                started = [self.start_job(pool, job) for job in jobs]
+                for job, image, future in started:
+                    self.finish_job(job, image, future)
+        finally:
+            pool.shutdown()
+            self.stderr.write(pool.stats())
+
+    # mark up to num_jobs jobs as being processed by us and return them
+    def claim_jobs(self, num_jobs):
+        now = timezone.now()
+        with transaction.atomic():
+            # skip locked jobs so multiple workers can claim at once
+            jobs = list(UploadJob.objects.select_for_update(
+                skip_locked=True).filter(Q(state=UploadJob.PENDING) |
+                    Q(state=UploadJob.PROCESSING,
+                        claim_time__lt=now-CLAIM_TIMEOUT)).select_related(
+                            "uploader", "image").order_by("pk")[:num_jobs])
+            for job in jobs:
+                job.state = UploadJob.PROCESSING
+                job.claim_time = now
+                job.save()
+        return jobs
+
+    # claim the image's hash and start processing it. returns (job, image,
+    # future of transcode result). image is None if the job is already done.
+    def start_job(self, pool, job):
+        try:
+            if job.image is not None and not job.image.uploaded:
+                # we got this far before and then the worker died, so this
+                # image's hash is already ours
+                image = job.image
+            else:
+                image = claim_image_hash(job.uploader, self.job_hash(job))
+                if image is None:
+                    self.complete_job(job, False,
+                        "Unfortunately, this image has already been "
+                        "submitted. Please try a different image.",
+                        "duplicate")
+                    return (job, None, None)
+                # remember we claimed it in case we die
+                job.image = image
+                job.save()
+
+            # the image is processed from and to files so that we don't need to
+            # keep it in memory
+            future = pool.submit(transcode_image_file,
+                job.data_path, job.rebuilt_path)
+        except Exception as e:
+            self.fail_job(job, e)
+            return (job, None, None)
+
+        return (job, image, future)
+
+    # return the hash of the job's image. the upload view calculates it as the
+    # image is received, but jobs queued before that have to be hashed here.
+    def job_hash(self, job):
+        if job.original_hash is not None:
+            return bytes(job.original_hash)
+        hasher = hashlib.sha256()
+        f = open(job.data_path, "rb")
+        while True:
+            chunk = f.read(1024*1024)
+            if len(chunk) == 0: break
+            hasher.update(chunk)
+        f.close()
+        return hasher.digest()
+
+    def finish_job(self, job, image, future):
+        if image is None:
+            return # already done with
+        try:
+            finish_image(image, job.name, future.result())
+        except Exception as e:
+            self.fail_job(job, e)
+        else:
+            self.complete_job(job, True,
+                "Thank you for your submission. The image will be reviewed"
+                " by a moderator before it is available for annotation.")
+
+    def fail_job(self, job, e):
+        if isinstance(e, ProcessingFailure):
+            message = "The image appears corrupt. Please try a different image."
+        elif isinstance(e, UnacceptableImage):
+            # we stopped liking it in the middle of processing
+            message = str(e)+" Please mind the upload guidelines."
+        elif isinstance(e, (JobTimeout, MemoryError)):
+            message = ("The image is too large to process. Please try a "
+                "different image.")
+        else:
+            # something we didn't expect. don't let it stop the other jobs.
+            traceback.print_exc()
+            message = ("Something went wrong while processing the image. "
+                "Please try again later.")
+        self.complete_job(job, False, message, str(e))
+
+    # mark the job as done and get rid of its data
+    def complete_job(self, job, succeeded, message, status="OK!"):
+        job.state = UploadJob.DONE
+        job.succeeded = succeeded
+        job.message = "{}: {}".format(job.name, message)[:255]
+        job.save()
+        for path in (job.data_path, job.rebuilt_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        self.stdout.write("job {} ({})... {}".format(job.pk, job.name, status))
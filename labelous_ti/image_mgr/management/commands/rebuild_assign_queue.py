@@ -0,0 +1,40 @@
+# bring the assignment queue (see image_mgr/assignment.py) back in sync with the
+# images: every available, non-deleted image gets an entry, other entries are
+# removed, and every entry's annotation count is recounted. useful if images
+# were changed by hand in the admin.
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.core.management.base import BaseCommand
+
+from image_mgr.models import Image, ImageQueueEntry
+from image_mgr.assignment import add_images, remove_images
+
+class Command(BaseCommand):
+    help = "Rebuild the queue of images users are assigned from."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # lock the queue so nobody starts an annotation while the counts are
+            # redone
+            queued = dict(ImageQueueEntry.objects.select_for_update(
+                ).values_list("image_id", "num_annotations"))
+            available = set(Image.objects.filter(available=True,
+                deleted=False).values_list("pk", flat=True))
+
+            removed = queued.keys()-available
+            remove_images(removed)
+            added = available-queued.keys()
+            add_images(added)
+
+            counts = Image.objects.filter(pk__in=available-added).annotate(
+                count=Count("annotations",
+                    filter=Q(annotations__deleted=False))).values_list(
+                        "pk", "count")
+            recounted = [ImageQueueEntry(image_id=pk, num_annotations=count)
+                for pk, count in counts.iterator() if count != queued[pk]]
+            ImageQueueEntry.objects.bulk_update(recounted, ["num_annotations"],
+                batch_size=2000)
+
+        print("Added {}, removed {}, recounted {} images".format(
+            len(added), len(removed), len(recounted)))
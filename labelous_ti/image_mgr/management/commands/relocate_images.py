@@ -0,0 +1,39 @@
+# move image files stored by older versions, which put everything directly in
+# L_IMAGE_PATH, into the directories described in storage.py. the server should
+# be stopped while this runs, since files aren't where it looks for them until
+# they're moved. it's safe to stop and run again.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+import os
+
+from image_mgr.storage import image_store
+
+class Command(BaseCommand):
+    help = "Move image files into the sharded directory layout."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+            help="Only print what would be moved.")
+
+    def handle(self, *args, **options):
+        # list the directory once instead of looking for each image's files,
+        # since there could be hundreds of thousands of them
+        num_moved = 0
+        for entry in os.scandir(settings.L_IMAGE_PATH):
+            if not entry.is_file(follow_symlinks=False):
+                continue # the new directories and the upload queue
+            dest = image_store.relocated_path(entry.name)
+            if dest is None:
+                self.stdout.write("skipping {}".format(entry.name))
+                continue
+
+            if options["dry_run"]:
+                self.stdout.write("{} -> {}".format(entry.name, dest))
+            else:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(entry.path, dest)
+            num_moved += 1
+
+        self.stdout.write("moved {} files".format(num_moved))
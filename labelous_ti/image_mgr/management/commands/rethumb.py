@@ -1,31 +1,96 @@
-# regenerate thumbnails for all the images.
-# useful if the settings changed.
+# regenerate thumbnails for all the images whose thumbnails were made with older
+# settings (see THUMB_VERSION). useful if the settings changed.
+
+# each image's thumb_version is updated as soon as its thumbnails are written,
+# so if the command is interrupted, running it again picks up where it left off.
+# with --jobs, the thumbnails are made in a pool of processes.
 
 from django.core.management.base import BaseCommand, CommandError
 
-from image_mgr.models import Image
-from image_mgr.process_image import make_thumbnail
+import collections
+import time
+
+from image_mgr.models import Image, THUMB_VERSION
+from image_mgr.process_image import make_thumbnail, save_files
+from image_mgr.transcode_pool import TranscodePool
+
+# how often to report progress, in images
+PROGRESS_INTERVAL = 100
+
+# make and save the thumbnails of the image at image_path, which has the given
+# file_path. returns the thumbnail size. runs in the pool, so it doesn't touch
+# the database.
+def rethumb_file(image_path, file_path, thumb_path):
+    _, thumb_data, thumb_size, variants = make_thumbnail(image_path)
+
+    f = open(thumb_path, "wb")
+    f.write(thumb_data)
+    f.close()
+    save_files(file_path, variants, [])
+
+    return thumb_size
 
 class Command(BaseCommand):
-    help = "Regenerate thumbnails for all images in the database."
+    help = "Regenerate outdated thumbnails for all images in the database."
 
     def add_arguments(self, parser):
-        pass # no arguments
+        parser.add_argument("--jobs", type=int, default=1,
+            help="Number of processes to make thumbnails with.")
+        parser.add_argument("--force", action="store_true",
+            help="Regenerate thumbnails even if they are up to date.")
 
     def handle(self, *args, **options):
-        for image in Image.objects.filter(uploaded=True, deleted=False).all():
-            self.stdout.write(image.file_path+"... ", ending="")
-            try:
-                f = open(image.image_path, "rb")
-                image_data = f.read()
-                f.close()
-
-                _, thumb_data, _ = make_thumbnail(image_data)
-
-                f = open(image.thumb_path, "wb")
-                f.write(thumb_data)
-                f.close()
-            except Exception as e:
-                self.stdout.write(str(e))
-            else:
-                self.stdout.write("OK!")
+        jobs = options["jobs"]
+        if jobs < 1:
+            raise CommandError("--jobs must be at least 1")
+
+        images = Image.objects.filter(uploaded=True, deleted=False)
+        if not options["force"]:
+            images = images.exclude(thumb_version=THUMB_VERSION)
+        images = images.only("pk", "file_path").order_by("pk")
+        total = images.count()
+        self.stderr.write("{} images to do".format(total))
+
+        pool = TranscodePool(jobs)
+        # images that have been started, in order. like batch_upload, we keep a
+        # few more than the number of jobs in flight.
+        pending = collections.deque()
+        start_time = time.monotonic()
+        num_done = 0
+        try:
+            for image in images.iterator():
+                pending.append((image, pool.submit(rethumb_file,
+                    image.image_path, image.file_path, image.thumb_path)))
+                while len(pending) > jobs*2:
+                    self.finish_image(*pending.popleft())
+                    num_done += 1
+                    self.report_progress(pool, num_done, total, start_time)
+            while len(pending) > 0:
+                self.finish_image(*pending.popleft())
+                num_done += 1
+                self.report_progress(pool, num_done, total, start_time)
+        finally:
+            pool.shutdown()
+
+        self.report_progress(pool, num_done, total, start_time, force=True)
+
+    # wait for the thumbnails to be made, then record that they're up to date
+    def finish_image(self, image, future):
+        self.stdout.write(image.file_path+"... ", ending="")
+        try:
+            # the size might have changed with the settings
+            image.thumb_x, image.thumb_y = future.result()
+            image.thumb_version = THUMB_VERSION
+            image.save(update_fields=["thumb_x", "thumb_y", "thumb_version"])
+        except Exception as e:
+            self.stdout.write(str(e))
+        else:
+            self.stdout.write("OK!")
+
+    def report_progress(self, pool, num_done, total, start_time, force=False):
+        if num_done % PROGRESS_INTERVAL != 0 and not force:
+            return
+        elapsed = time.monotonic() - start_time
+        self.stderr.write("{}/{} images in {:.1f}s ({:.2f} images/s)".format(
+            num_done, total, elapsed, num_done/elapsed if elapsed > 0 else 0))
+        self.stderr.write(pool.stats())
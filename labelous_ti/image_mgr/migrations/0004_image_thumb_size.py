@@ -0,0 +1,55 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:24
+
+from django.db import migrations, models
+
+import math
+
+
+# copy of image_mgr.models.calculate_thumb_size as of this migration, so later
+# changes to it don't change what this migration does
+def calculate_thumb_size(image_size):
+    x, y = (576, 192)
+    image_x, image_y = image_size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    # preserve aspect ratio
+    aspect = image_x / image_y
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: abs(aspect - x / n))
+
+    return (x, y)
+
+def fill_thumb_size(apps, schema_editor):
+    Image = apps.get_model("image_mgr", "Image")
+    images = []
+    for image in Image.objects.filter(uploaded=True).only(
+            "pk", "image_x", "image_y").iterator():
+        image.thumb_x, image.thumb_y = calculate_thumb_size(
+            (image.image_x, image.image_y))
+        images.append(image)
+    Image.objects.bulk_update(images, ["thumb_x", "thumb_y"], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_mgr', '0003_auto_20200319_1420'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='thumb_x',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='thumb_y',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_thumb_size, migrations.RunPython.noop),
+    ]
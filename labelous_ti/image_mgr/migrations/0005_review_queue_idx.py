@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_mgr', '0004_image_thumb_size'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('available', False), ('deleted', False)), fields=['id'], name='image_review_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('image_mgr', '0005_review_queue_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('upload_time', models.DateTimeField(auto_now_add=True)),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('done', 'done')], default='pending', max_length=16)),
+                ('claim_time', models.DateTimeField(blank=True, null=True)),
+                ('succeeded', models.BooleanField(default=False)),
+                ('message', models.CharField(blank=True, max_length=255)),
+                ('reported', models.BooleanField(default=False)),
+                ('image', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='image_mgr.Image')),
+                ('uploader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
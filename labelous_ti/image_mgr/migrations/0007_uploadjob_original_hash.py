@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_mgr', '0006_uploadjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadjob',
+            name='original_hash',
+            field=models.BinaryField(max_length=32, null=True),
+        ),
+    ]
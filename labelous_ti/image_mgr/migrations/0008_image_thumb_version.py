@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_mgr', '0007_uploadjob_original_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='thumb_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# move each available image's annotation count into its queue entry
+def fill_queue(apps, schema_editor):
+    Image = apps.get_model("image_mgr", "Image")
+    ImageQueueEntry = apps.get_model("image_mgr", "ImageQueueEntry")
+    entries = [ImageQueueEntry(image_id=pk, num_annotations=num_annotations)
+        for pk, num_annotations in Image.objects.filter(
+            available=True, deleted=False).values_list(
+                "pk", "num_annotations").iterator()]
+    ImageQueueEntry.objects.bulk_create(entries, batch_size=2000)
+
+def empty_queue(apps, schema_editor):
+    Image = apps.get_model("image_mgr", "Image")
+    ImageQueueEntry = apps.get_model("image_mgr", "ImageQueueEntry")
+    images = [Image(pk=image_id, num_annotations=num_annotations)
+        for image_id, num_annotations in ImageQueueEntry.objects.values_list(
+            "image_id", "num_annotations").iterator()]
+    Image.objects.bulk_update(images, ["num_annotations"], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_mgr', '0008_image_thumb_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageQueueEntry',
+            fields=[
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='queue_entry', serialize=False, to='image_mgr.Image')),
+                ('num_annotations', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_queue, empty_queue),
+        migrations.RemoveField(
+            model_name='image',
+            name='num_annotations',
+        ),
+        migrations.AddIndex(
+            model_name='imagequeueentry',
+            index=models.Index(fields=['num_annotations', 'image'], name='image_queue_bucket_idx'),
+        ),
+    ]
@@ -7,11 +7,71 @@ import math
 
 from browser.models import User
 from label_app.filename_smuggler import encode_filename
+from .storage import image_store
 
 # maximum size of thumbnail in each dimension. we want thumbnails to all be the
 # same height, so we allow a 3:1 aspect ratio. images that wide probably won't
 # ever be uploaded (but it's okay if they are, we will pad the box)
 THUMBNAIL_SIZE = (576, 192)
+# other formats the thumbnail is stored in, as (filename suffix, content type),
+# in order of preference. they're a good deal smaller than the JPEG, so browsers
+# that accept one get it instead.
+THUMB_VARIANTS = (
+    ("_thumb.avif", "image/avif"),
+    ("_thumb.webp", "image/webp"),
+)
+# version of the thumbnail settings above (and the encoding settings in
+# process_image.py). increase it when they change, then run rethumb to remake
+# the thumbnails that were made with older settings.
+THUMB_VERSION = 1
+
+# calculate the (width, height) of the thumbnail of an image with the given
+# size. since we use PIL to generate the thumbnails, we borrow PIL's math
+def calculate_thumb_size(image_size):
+    x, y = THUMBNAIL_SIZE
+    image_x, image_y = image_size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    # preserve aspect ratio
+    aspect = image_x / image_y
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: abs(aspect - x / n))
+
+    return (x, y)
+
+# the image pyramid: smaller copies of the image stored next to it so the tool
+# can show something screen sized first and only fetch the whole image when the
+# user zooms in. level n is the image scaled down by 2**n, and levels are made
+# until the image fits within this size. level 0 is the image itself.
+LEVEL_MAX_SIZE = 1024
+# if the L_IMAGE_TILES setting is on, the full size image is also cut up into
+# tiles of this size so the tool can fetch just the part being looked at
+TILE_SIZE = 512
+
+# calculate the (width, height) of the given pyramid level of an image with the
+# given size. each halving rounds up, which is also how PIL and libjpeg do it.
+def calculate_level_size(image_size, level):
+    scale = 2**level
+    return (-(-image_size[0]//scale), -(-image_size[1]//scale))
+
+# calculate how many levels (not counting level 0) an image of the given size
+# has
+def calculate_num_levels(image_size):
+    level = 0
+    while max(calculate_level_size(image_size, level)) > LEVEL_MAX_SIZE:
+        level += 1
+    return level
+
+# the part of the filename that's added on to the image's file_path for the
+# level and tile files
+def level_suffix(level):
+    return "_l{}".format(level)
+def tile_suffix(col, row):
+    return "_t{}_{}".format(col, row)
 
 # hold data about a particular image in the system
 class Image(models.Model):
@@ -36,15 +96,19 @@ class Image(models.Model):
     # the annotation SVGs.
     image_x = models.IntegerField()
     image_y = models.IntegerField()
+    # dimensions of the thumbnail. these can be calculated from the above, but
+    # the browser pages need them for every image they show, so we store them.
+    # 0 if they haven't been calculated yet.
+    thumb_x = models.IntegerField(default=0)
+    thumb_y = models.IntegerField(default=0)
+    # the THUMB_VERSION the thumbnails were made with. 0 if they were made
+    # before there were versions.
+    thumb_version = models.IntegerField(default=0)
     # uploader: user who uploaded this image
     uploader = models.ForeignKey(User, on_delete=models.CASCADE)
     # upload_time: time when this image was uploaded. automatically set when
     # this object is created.
     upload_time = models.DateTimeField(auto_now_add=True)
-    # num_annotations: how many annotations there are for this image. not
-    # necessarily 100% accurate. used to give users the image with the least
-    # annotations.
-    num_annotations = models.IntegerField(default=0)
 
     class Meta:
         # enforce that non-uploaded images are always deleted. the rest of the
@@ -55,6 +119,12 @@ class Image(models.Model):
                 (Q(uploaded=True) | (Q(uploaded=False) & Q(deleted=True))),
                 name='not_uploaded_must_delete')
         ]
+        indexes = [
+            # the image review queue only looks at images awaiting review, in
+            # pk order. a partial index keeps it quick to page through.
+            models.Index(fields=["id"], name="image_review_queue_idx",
+                condition=Q(available=False, deleted=False)),
+        ]
 
     # return the url of this image
     @property
@@ -71,22 +141,72 @@ class Image(models.Model):
     # path to the image file on disk
     @property
     def image_path(self):
-        return settings.L_IMAGE_PATH/(self.file_path+".jpg")
+        return image_store.path(self.file_path, ".jpg")
 
     # path to the image thumbnail file on disk
     @property
     def thumb_path(self):
-        return settings.L_IMAGE_PATH/(self.file_path+"_thumb.jpg")
+        return image_store.path(self.file_path, "_thumb.jpg")
 
     # path to x-accel-redirect version of image
     @property
     def image_redir_path(self):
-        return "/image_real/{}.jpg".format(self.file_path)
+        return image_store.redir_path(self.file_path, ".jpg")
 
     # path to x-accel-redirect version of thumbnail
     @property
     def thumb_redir_path(self):
-        return "/image_real/{}_thumb.jpg".format(self.file_path)
+        return image_store.redir_path(self.file_path, "_thumb.jpg")
+
+    # path to the thumbnail variant with the given suffix on disk
+    def thumb_variant_path(self, suffix):
+        return image_store.path(self.file_path, suffix)
+
+    # path to x-accel-redirect version of the thumbnail variant
+    def thumb_variant_redir_path(self, suffix):
+        return image_store.redir_path(self.file_path, suffix)
+
+    # number of pyramid levels the image has, not counting the image itself
+    @property
+    def num_levels(self):
+        return calculate_num_levels(self.image_size)
+
+    # url of the given pyramid level of the image
+    def level_url(self, level):
+        return reverse("label_app:label_image_level", current_app="label_app",
+            args=(level, encode_filename(image_id=self.pk)))
+
+    # path to the given pyramid level of the image on disk
+    def level_path(self, level):
+        if level == 0:
+            return self.image_path
+        return image_store.path(self.file_path, level_suffix(level)+".jpg")
+
+    # path to x-accel-redirect version of the given level
+    def level_redir_path(self, level):
+        if level == 0:
+            return self.image_redir_path
+        return image_store.redir_path(self.file_path,
+            level_suffix(level)+".jpg")
+
+    # number of (columns, rows) of tiles the image is cut into
+    @property
+    def tile_grid(self):
+        return (-(-self.image_x//TILE_SIZE), -(-self.image_y//TILE_SIZE))
+
+    # url of the given tile of the image
+    def tile_url(self, col, row):
+        return reverse("label_app:label_image_tile", current_app="label_app",
+            args=(col, row, encode_filename(image_id=self.pk)))
+
+    # path to the given tile of the image on disk
+    def tile_path(self, col, row):
+        return image_store.path(self.file_path, tile_suffix(col, row)+".jpg")
+
+    # path to x-accel-redirect version of the given tile
+    def tile_redir_path(self, col, row):
+        return image_store.redir_path(self.file_path,
+            tile_suffix(col, row)+".jpg")
 
     # tuple of image (width, height)
     @property
@@ -94,19 +214,72 @@ class Image(models.Model):
         return (self.image_x, self.image_y)
 
     # tuple of thumbnail (width, height)
-    # since we use PIL to generate the thumbnails, we borrow PIL's math
     @property
     def thumb_size(self):
-        x, y = THUMBNAIL_SIZE
+        if self.thumb_x == 0 or self.thumb_y == 0:
+            # not stored yet, so work it out
+            return calculate_thumb_size(self.image_size)
+        return (self.thumb_x, self.thumb_y)
 
-        def round_aspect(number, key):
-            return max(min(math.floor(number), math.ceil(number), key=key), 1)
+# the queue of images users can start annotating: there is one of these for each
+# available, non-deleted image. it's kept separate from the image so that
+# handing out images only locks and updates these small rows, and the index puts
+# the images in buckets by annotation count so the next image is found without
+# sorting. see assignment.py for how it's used and kept up to date.
+class ImageQueueEntry(models.Model):
+    image = models.OneToOneField(Image, on_delete=models.CASCADE,
+        primary_key=True, related_name="queue_entry")
+    # how many annotations there are for this image. not necessarily 100%
+    # accurate (rebuild_assign_queue recounts it). used to give users the image
+    # with the least annotations.
+    num_annotations = models.IntegerField(default=0)
 
-        # preserve aspect ratio
-        aspect = self.image_x / self.image_y
-        if x / y >= aspect:
-            x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
-        else:
-            y = round_aspect(x / aspect, key=lambda n: abs(aspect - x / n))
+    class Meta:
+        indexes = [
+            models.Index(fields=["num_annotations", "image"],
+                name="image_queue_bucket_idx"),
+        ]
+
+# an uploaded image waiting to be processed. processing an image can tie up a
+# web worker for several seconds and hundreds of MiB, so the upload view just
+# stores the data and creates one of these. the process_uploads command then
+# picks them up and processes them a few at a time.
+class UploadJob(models.Model):
+    # states a job goes through
+    PENDING = "pending" # waiting for a worker
+    PROCESSING = "processing" # a worker is working on it
+    DONE = "done" # processing finished; message says how it went
+    STATES = [(s, s) for s in (PENDING, PROCESSING, DONE)]
+
+    # who uploaded it and what they called it
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE,
+        related_name="upload_jobs")
+    name = models.CharField(max_length=255)
+    # SHA-256 hash of the uploaded data, calculated as it was received. null if
+    # it hasn't been calculated.
+    original_hash = models.BinaryField(max_length=32, null=True)
+    # when it was uploaded
+    upload_time = models.DateTimeField(auto_now_add=True)
+    state = models.CharField(max_length=16, choices=STATES, default=PENDING)
+    # when a worker started processing it. if a worker dies in the middle, the
+    # job gets picked up again once this is long enough ago.
+    claim_time = models.DateTimeField(null=True, blank=True)
+    # the result of processing: the new image (if there was one), whether it
+    # went okay, and the message to show the uploader
+    image = models.ForeignKey(Image, on_delete=models.SET_NULL,
+        null=True, blank=True)
+    succeeded = models.BooleanField(default=False)
+    message = models.CharField(max_length=255, blank=True)
+    # if the uploader has been shown the message yet
+    reported = models.BooleanField(default=False)
 
-        return (x, y)
+    # path to the uploaded data while it waits to be processed
+    @property
+    def data_path(self):
+        return settings.L_IMAGE_PATH/"upload_queue"/"{}.jpg".format(self.pk)
+
+    # path to the rebuilt image while it's being processed
+    @property
+    def rebuilt_path(self):
+        return settings.L_IMAGE_PATH/"upload_queue"/"{}_rebuilt.jpg".format(
+            self.pk)
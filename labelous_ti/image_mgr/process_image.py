@@ -3,19 +3,50 @@
 
 from django.db import IntegrityError, transaction
 from django.conf import settings
+from django.core.files.move import file_move_safe
 
 import hashlib
 import subprocess
+import resource
+import struct
+import pathlib
 import re
 import io
+import os
 
 import PIL.Image
 import piexif
+try:
+    import pillow_avif # adds AVIF support to Pillow versions before 11.2
+except ImportError:
+    pass
 
-from .models import Image, THUMBNAIL_SIZE
+from .storage import image_store
+from .models import (Image, UploadJob, THUMBNAIL_SIZE, THUMB_VARIANTS,
+    THUMB_VERSION, TILE_SIZE, calculate_thumb_size,
+    calculate_level_size, calculate_num_levels, level_suffix, tile_suffix)
 
 # maximum size of JPEG, before processing, that we bother with
 MAX_IMAGE_SIZE = 10*1024*1024 # 10MiB
+# minimum width and height of an image we accept. we want some decent resolution
+# to get actual detail out of the image.
+MIN_IMAGE_DIMENSION = 720
+
+# limits on each jpegtran process. see below for discussion.
+JPEGTRAN_TIMEOUT = 5 # seconds of wall clock time
+JPEGTRAN_CPU_LIMIT = 5 # seconds of CPU time
+JPEGTRAN_MEMORY_LIMIT = 768*1024*1024 # bytes of address space
+
+# JPEG quality of the pyramid levels and tiles. these are what the user looks at
+# while labeling, so they get better quality than the thumbnails.
+LEVEL_QUALITY = 85
+
+# how the thumbnail variants from models.py are encoded, by suffix. the
+# qualities are picked to look about the same as the quality 75 JPEG.
+THUMB_VARIANT_FORMATS = {
+    "_thumb.avif": ("AVIF", {"quality": 55, "speed": 6}),
+    "_thumb.webp": ("WEBP", {"quality": 75, "method": 4}),
+}
 
 # SECURITY CONCERNS
 
@@ -72,26 +103,34 @@ MAX_IMAGE_SIZE = 10*1024*1024 # 10MiB
 # let users upload a wide variety of images and ensure the original quality is
 # preserved. But processing them can be costly.
 
-# To simplify the code and eliminate disk storage related problems, image data
-# is always stored in memory until it's finally written to disk; there are no
-# temporary files. But this means there can be four or five copies of the image
-# floating around in memory during various stages of processing, hogging 40 or
-# 50MiB. This doesn't count the several hundred MiB that might be used during
-# jpegtran optimization or thumbnail generation.
+# Images uploaded through the website are streamed to a file as they arrive,
+# and their hash is calculated along the way (see upload_views.py). jpegtran
+# then reads that file directly and writes its result to another file, which is
+# eventually moved into place. So, no copy of the image is ever held in memory,
+# and it doesn't matter much how many images are in flight. This doesn't count
+# the several hundred MiB that might be used during jpegtran optimization or
+# thumbnail generation. Images from batch_upload are still processed in memory
+# for simplicity, which can mean four or five copies of the image floating
+# around, hogging 40 or 50MiB.
 
 # jpegtran's optimization process is slow and uses lots of memory. For a 10MiB
 # image that needs to be transformed, it takes about 2 seconds and at most
 # 512MiB of memory on my machine, but mine is pretty fast. However, jpegtran
 # will be killed if it takes longer than 5 seconds to prevent truly ridiculous
-# time wastage.
-
-# It's probably not hard to DoS the system through image uploads if each image
-# ties up the web server for several seconds and several hundred MiB of memory.
-# We will accept that possibility here because we don't expect especially
-# frequent image uploads, and any offenders could be easily identified and have
-# their accounts disabled. But keep this problem in mind for other situations.
-# It may be appropriate to reduce maximum file size, processing time, and memory
-# usage thresholds.
+# time wastage. The kernel also enforces limits on each jpegtran process (see
+# limit_jpegtran): it's killed if it uses more than 5 seconds of CPU time or
+# tries to use more than 768MiB of memory, which leaves some room over the
+# 512MiB we tell it to use. It also can't write more than the maximum image size
+# to a file or leave a core dump behind.
+
+# It would not be hard to DoS the system through image uploads if each image
+# tied up a web server process for several seconds and several hundred MiB of
+# memory. So, the upload view doesn't process images itself. It just stores the
+# data and queues an UploadJob (see queue_image), then the process_uploads
+# command works through the queue with a fixed number of processes. A flood of
+# uploads then only makes the queue longer; the web server and the machine's
+# memory are unaffected. Any offenders could still be easily identified and have
+# their accounts disabled.
 
 
 # thrown when something goes wrong during processing
@@ -102,7 +141,8 @@ class UnacceptableImage(Exception):
     pass
 
 # read EXIF orientation from the image. orientation test images are available at
-# https://github.com/recurser/exif-orientation-examples
+# https://github.com/recurser/exif-orientation-examples. data can be the image
+# data or a path to it as a str, in which case piexif reads only what it needs.
 def get_exif_orientation(data):
     # we use piexif to process the original, potentially evil, image data.
     # theoretically this is safer because piexif is a pure python library and so
@@ -124,7 +164,71 @@ def get_exif_orientation(data):
     return orientation
 
 
-def jpegtran(in_data, orientation):
+# JPEG markers that start a frame (SOF0-15, except DHT, JPG, and DAC). the
+# frame header has the image's dimensions.
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# read the (width, height) of the JPEG in the open file f from its frame header,
+# without decoding anything. this works on evil data, since it only reads a few
+# lengths and numbers, and so can be used to reject images before they're
+# processed. the size is before the EXIF orientation is applied.
+def jpeg_size(f):
+    if f.read(2) != b"\xff\xd8":
+        raise ProcessingFailure("missing JPEG SOI")
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ProcessingFailure("bad JPEG marker")
+        marker = marker[1]
+        while marker == 0xFF: # markers can be padded with any number of FFs
+            marker = f.read(1)
+            if len(marker) == 0:
+                raise ProcessingFailure("bad JPEG marker")
+            marker = marker[0]
+
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue # these markers don't have any data
+        if marker in (0xD9, 0xDA):
+            # end of image or start of the image data
+            raise ProcessingFailure("no JPEG SOF")
+
+        length = f.read(2)
+        if len(length) < 2 or struct.unpack(">H", length)[0] < 2:
+            raise ProcessingFailure("bad JPEG segment length")
+        length = struct.unpack(">H", length)[0]
+        if marker in SOF_MARKERS:
+            header = f.read(5)
+            if len(header) < 5:
+                raise ProcessingFailure("bad JPEG SOF")
+            _, height, width = struct.unpack(">BHH", header)
+            return (width, height)
+        # skip to the next marker
+        f.seek(length-2, io.SEEK_CUR)
+
+# make sure the image isn't too small. image_size can be from before or after
+# applying the orientation, since it only matters that both dimensions are big
+# enough.
+def check_dimensions(image_size):
+    if min(image_size) < MIN_IMAGE_DIMENSION:
+        raise UnacceptableImage("Image dimensions are too small.")
+
+# called in the jpegtran process just before it starts to set the limits on it.
+# the limits are inherited by anything it starts, though it shouldn't start
+# anything.
+def limit_jpegtran():
+    resource.setrlimit(resource.RLIMIT_CPU,
+        (JPEGTRAN_CPU_LIMIT, JPEGTRAN_CPU_LIMIT+1))
+    resource.setrlimit(resource.RLIMIT_AS,
+        (JPEGTRAN_MEMORY_LIMIT, JPEGTRAN_MEMORY_LIMIT))
+    # only matters if it's writing to a file, but then it will be killed
+    # instead of filling up the disk
+    resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_IMAGE_SIZE+1,)*2)
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+# run the image through jpegtran. in_data can be the image data or an open file
+# containing it. if out_file is given, the result is written to that open file
+# and None is returned, otherwise the resulting data is returned.
+def jpegtran(in_data, orientation, out_file=None):
     # convert the orientation number to jpegtran command.
     # from http://sylvana.net/jpegcrop/exif_orientation.html
 
@@ -163,22 +267,42 @@ def jpegtran(in_data, orientation):
         # data is passed through stdin and stdout so no files are specified
     ]
 
+    if isinstance(in_data, (bytes, bytearray)):
+        stdin = {"input": in_data} # pipe image data into jpegtran
+    else:
+        stdin = {"stdin": in_data} # jpegtran reads straight from the file
+    if out_file is None:
+        # retrive image data piped out of jpegtran
+        stdout = subprocess.PIPE
+    else:
+        # jpegtran writes straight to the file
+        stdout = out_file
+
     try:
         result = subprocess.run(args,
-            input=in_data, # pipe image data into jpegtran
-            capture_output=True, # retrive image data piped out of jpegtran
+            **stdin,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
             check=True, # throw exception if jpegtran didn't return success
-            timeout=5, # kill jpegtran if it doesn't finish after 5 seconds in
-                       # case it gets stuck or is doing evil things
+            timeout=JPEGTRAN_TIMEOUT, # kill jpegtran if it doesn't finish in
+                # time in case it gets stuck or is doing evil things
+            preexec_fn=limit_jpegtran, # and let the kernel make sure it
+                # doesn't use too much of anything
         )
     except subprocess.CalledProcessError as e:
-        # return code was nonzero
+        # return code was nonzero, or it was killed for going over a limit
         raise ProcessingFailure("jpegtran didn't return success") from e
-    except subprocess.TimeoutExpored as e:
+    except subprocess.TimeoutExpired as e:
         raise ProcessingFailure("jpegtran took too long") from e
 
-    out_data = result.stdout
-    if len(out_data) > MAX_IMAGE_SIZE:
+    if out_file is None:
+        out_data = result.stdout
+        out_size = len(out_data)
+    else:
+        out_size = os.fstat(out_file.fileno()).st_size
+        out_file.seek(0)
+        out_data = out_file.read(2)
+    if out_size > MAX_IMAGE_SIZE:
         # shouldn't ever happen, but maybe jpegtran got stuck in a loop and
         # spewed garbage or something
         raise ProcessingFailure("jpegtran result too big")
@@ -189,45 +313,131 @@ def jpegtran(in_data, orientation):
         # this also shouldn't ever happen.
         raise ProcessingFailure("jpegtran didn't return a JPEG")
 
-    return out_data
-
+    if out_file is None:
+        return out_data
+
+
+# encode the thumbnail (as a PIL image) in each format in THUMB_VARIANTS that
+# this PIL can write. returns a list of (filename suffix, data).
+def make_thumb_variants(thumb):
+    PIL.Image.init() # make sure all the formats are registered
+    if thumb.mode not in ("RGB", "L"):
+        thumb = thumb.convert("RGB") # e.g. CMYK, which the formats can't do
+    variants = []
+    for suffix, _ in THUMB_VARIANTS:
+        format, options = THUMB_VARIANT_FORMATS[suffix]
+        if format not in PIL.Image.SAVE:
+            continue
+        variant_file = io.BytesIO()
+        try:
+            thumb.save(variant_file, format=format, **options)
+        except Exception:
+            # the JPEG is always there, so the image is still fine without
+            # this one
+            continue
+        variants.append((suffix, bytes(variant_file.getbuffer())))
+    return variants
 
 # use PIL to make a thumbnail according to the various settings. must not be
-# passed evil image data! returns (orig_size, thumb_data, thumb_size)
+# passed evil image data! image_data can also be a path to the image. returns
+# (orig_size, thumb_data, thumb_size, variants), where variants is from
+# make_thumb_variants.
 def make_thumbnail(image_data):
-    image_file = io.BytesIO(image_data)
+    if isinstance(image_data, (bytes, bytearray)):
+        image_file = io.BytesIO(image_data)
+    else:
+        image_file = open(image_data, "rb")
     thumb_file = io.BytesIO()
 
     thumb = PIL.Image.open(image_file)
     orig_size = thumb.size
-    thumb.thumbnail(THUMBNAIL_SIZE)
+    thumb_size = calculate_thumb_size(orig_size)
+    # have the JPEG decoder scale the image down as much as it can while
+    # decoding (by up to 8x). this is much faster and uses far less memory than
+    # decoding the whole thing and then scaling it. the size is worked out
+    # from the original, so it always matches calculate_thumb_size.
+    thumb.draft(thumb.mode, thumb_size)
+    thumb = thumb.resize(thumb_size, PIL.Image.BICUBIC)
     thumb.save(thumb_file, format="JPEG", quality=75)
+    variants = make_thumb_variants(thumb)
 
     thumb_data = bytes(thumb_file.getbuffer())
     image_file.close()
     thumb_file.close()
 
-    return (orig_size, thumb_data, thumb.size)
+    return (orig_size, thumb_data, thumb.size, variants)
 
 
-# returns the created Image if the image was new, None if it's already in the
-# database (ignoring whether or not it was ever processed), or raises an
-# exception if it could not be processed
-def process_image(uploader, name, orig_data):
-    # perofrm basic sanity and validity checks
+# use PIL to make the image pyramid levels and (if enabled) tiles described in
+# models.py. must not be passed evil image data! image_data can also be a path
+# to the image. returns a list of (filename suffix, data) for each file, where
+# the suffix includes the extension.
+def make_levels(image_data, image_size):
+    num_levels = calculate_num_levels(image_size)
+    make_tiles = settings.L_IMAGE_TILES
+    if num_levels == 0 and not make_tiles:
+        return []
 
-    # re-check size since this function may not have been called from the view
-    if len(orig_data) > MAX_IMAGE_SIZE:
-        raise UnacceptableImage("Image filesize is too large.")
-    # make sure the file starts like a JPEG
-    if len(orig_data) < 2 or orig_data[:2] != b"\xff\xd8":
-        raise ProcessingFailure("missing JPEG SOI")
+    if isinstance(image_data, (bytes, bytearray)):
+        image_file = io.BytesIO(image_data)
+    else:
+        image_file = open(image_data, "rb")
+    image = PIL.Image.open(image_file)
+
+    def save(image):
+        out_file = io.BytesIO()
+        image.save(out_file, format="JPEG", quality=LEVEL_QUALITY)
+        return bytes(out_file.getbuffer())
+
+    files = []
+    if make_tiles:
+        # tiles need the whole image
+        cols = -(-image_size[0]//TILE_SIZE)
+        rows = -(-image_size[1]//TILE_SIZE)
+        for col in range(cols):
+            for row in range(rows):
+                tile = image.crop((col*TILE_SIZE, row*TILE_SIZE,
+                    min((col+1)*TILE_SIZE, image_size[0]),
+                    min((row+1)*TILE_SIZE, image_size[1])))
+                files.append((tile_suffix(col, row)+".jpg", save(tile)))
+    elif num_levels > 0:
+        # otherwise, the JPEG decoder can do the first halving for us while
+        # decoding, which is much faster and uses a quarter of the memory
+        image.draft(image.mode, calculate_level_size(image_size, 1))
+
+    # each level is made by halving the one before it
+    level = image
+    for level_num in range(1, num_levels+1):
+        level_size = calculate_level_size(image_size, level_num)
+        if level.size != level_size:
+            level = level.resize(level_size, PIL.Image.BOX)
+        files.append((level_suffix(level_num)+".jpg", save(level)))
 
-    # compute the SHA-256 of the image data so we can deduplicate images
-    image_hash = hashlib.sha256(orig_data).digest()
-    
-    # make a hidden image record with the given hash. we expect images to be
-    # unique, so we try and create it first.
+    image_file.close()
+
+    return files
+
+# write the files from make_levels or make_thumb_variants next to the image with
+# the given file_path. the path of each file is appended to written as it's
+# written.
+def save_files(file_path, files, written):
+    for suffix, data in files:
+        path = image_store.path(file_path, suffix)
+        written.append(path)
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+
+
+# processing is split into three stages so that the slow middle one can be run
+# somewhere else (e.g. in a process pool by batch_upload). process_image just
+# runs them all in order.
+
+# make a hidden image record with the given hash. returns the record if the
+# image is new, or None if it's already in the database (ignoring whether or not
+# it was ever processed).
+def claim_image_hash(uploader, image_hash):
+    # we expect images to be unique, so we try and create it first.
     try:
         image = Image(file_path='', uploader=uploader,
             available=False, deleted=True, uploaded=False,
@@ -238,6 +448,31 @@ def process_image(uploader, name, orig_data):
         # guess it wasn't unique... we have no new image to return
         return None
 
+    return image
+
+# first stage: basic checks and claiming the image's hash in the database.
+# returns the hidden Image record if the image is new, or None if it's already in
+# the database (ignoring whether or not it was ever processed).
+def start_image(uploader, orig_data):
+    # perofrm basic sanity and validity checks
+
+    # re-check size since this function may not have been called from the view
+    if len(orig_data) > MAX_IMAGE_SIZE:
+        raise UnacceptableImage("Image filesize is too large.")
+    # make sure the file starts like a JPEG. we also read its size so we don't
+    # waste time processing an image that's too small anyway.
+    check_dimensions(jpeg_size(io.BytesIO(orig_data)))
+
+    # compute the SHA-256 of the image data so we can deduplicate images
+    image_hash = hashlib.sha256(orig_data).digest()
+    
+    return claim_image_hash(uploader, image_hash)
+
+# second stage: the actual image processing. doesn't touch the database or the
+# disk, so it's safe to run in another process. returns (rebuilt_data,
+# image_size, thumb_data, thumb_size, files), where files are the other files to
+# store next to the image.
+def transcode_image(orig_data):
     # try and read the EXIF orientation from the image. some cameras produce a
     # sideways image, then set the tag to tell the viewer to rotate it
     # accordingly. since we throw away the EXIF data, such an image would end up
@@ -248,12 +483,41 @@ def process_image(uploader, name, orig_data):
     # discussed earlier. jpegtran also losslessly applies the EXIF orientation.
     rebuilt_data = jpegtran(orig_data, orientation)
 
-    # from that data, we can more safely use Pillow to create a thumbnail
-    image_size, thumb_data, thumb_size = make_thumbnail(rebuilt_data)
-    # make sure the image wasn't a thumbnail to begin with... we want some
-    # decent resolution to get actual detail out of the image.
-    if image_size[0] < 720 or image_size[1] < 720:
-        raise UnacceptableImage("Image dimensions are too small.")
+    # from that data, we can more safely use Pillow to create a thumbnail and
+    # the pyramid levels
+    image_size, thumb_data, thumb_size, variants = make_thumbnail(rebuilt_data)
+    files = variants + make_levels(rebuilt_data, image_size)
+
+    return (rebuilt_data, image_size, thumb_data, thumb_size, files)
+
+# same as above, but the image is read from orig_path and the rebuilt image is
+# written to rebuilt_path instead of being returned. the rebuilt_path is
+# returned in its place, which finish_image will move into place.
+def transcode_image_file(orig_path, rebuilt_path):
+    orientation = get_exif_orientation(str(orig_path))
+
+    orig_file = open(orig_path, "rb")
+    rebuilt_file = open(rebuilt_path, "w+b")
+    try:
+        jpegtran(orig_file, orientation, out_file=rebuilt_file)
+    finally:
+        orig_file.close()
+        rebuilt_file.close()
+
+    image_size, thumb_data, thumb_size, variants = make_thumbnail(rebuilt_path)
+    files = variants + make_levels(rebuilt_path, image_size)
+
+    return (rebuilt_path, image_size, thumb_data, thumb_size, files)
+
+# third stage: check the processed image is acceptable, then save it to disk and
+# update the image record from the first stage. returns the finished Image.
+def finish_image(image, name, transcoded):
+    rebuilt_data, image_size, thumb_data, thumb_size, files = transcoded
+    image_hash = bytes(image.original_hash)
+
+    # make sure the image wasn't a thumbnail to begin with (jpegtran could
+    # also have trimmed it a little)
+    check_dimensions(image_size)
 
     # calculate an appropriate filename. we take all the nice characters from
     # the original, but not so many that we don't have room for the rest of the
@@ -269,8 +533,10 @@ def process_image(uploader, name, orig_data):
     # the same hash
 
     # finally, we can save the file to disk and update the database record
-    image_path = settings.L_IMAGE_PATH/(name+".jpg")
-    thumb_path = settings.L_IMAGE_PATH/(name+"_thumb.jpg")
+    image_store.make_dir(name)
+    image_path = image_store.path(name, ".jpg")
+    thumb_path = image_store.path(name, "_thumb.jpg")
+    file_paths = []
     succeeded = False
     try:
         with transaction.atomic():
@@ -279,15 +545,24 @@ def process_image(uploader, name, orig_data):
             image.uploaded = True
             image.image_x = image_size[0]
             image.image_y = image_size[1]
+            image.thumb_x = thumb_size[0]
+            image.thumb_y = thumb_size[1]
+            image.thumb_version = THUMB_VERSION
             image.save()
 
-            f = open(image_path, "wb")
-            f.write(rebuilt_data)
-            f.close()
+            if isinstance(rebuilt_data, pathlib.Path):
+                # it's already on disk, we just need to move it
+                os.replace(rebuilt_data, image_path)
+            else:
+                f = open(image_path, "wb")
+                f.write(rebuilt_data)
+                f.close()
 
             f = open(thumb_path, "wb")
             f.write(thumb_data)
             f.close()
+
+            save_files(name, files, file_paths)
         succeeded = True
     finally:
         if not succeeded:
@@ -300,6 +575,37 @@ def process_image(uploader, name, orig_data):
                 thumb_path.unlink()
             except:
                 pass
+            for file_path in file_paths:
+                try:
+                    file_path.unlink()
+                except:
+                    pass
 
     # give back the image we made
     return image
+
+
+# returns the created Image if the image was new, None if it's already in the
+# database (ignoring whether or not it was ever processed), or raises an
+# exception if it could not be processed
+def process_image(uploader, name, orig_data):
+    image = start_image(uploader, orig_data)
+    if image is None:
+        return None
+
+    return finish_image(image, name, transcode_image(orig_data))
+
+
+# move the uploaded image file at orig_path into the queue and create a job for
+# the process_uploads command to process it later. returns the UploadJob.
+def queue_image(uploader, name, orig_path, image_hash):
+    with transaction.atomic():
+        job = UploadJob(uploader=uploader, name=name[:255],
+            original_hash=image_hash)
+        job.save()
+
+        # if this fails, the job won't be created either
+        job.data_path.parent.mkdir(exist_ok=True)
+        file_move_safe(orig_path, job.data_path)
+
+    return job
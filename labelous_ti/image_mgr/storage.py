@@ -0,0 +1,130 @@
+# this file decides where image files (and everything made from them, like
+# thumbnails and levels) live on disk. every image's file_path ends
+# with the SHA-256 hash of its original data, so the files are spread into
+# directories named after the first few characters of that hash. this keeps any
+# one directory from getting huge, which makes opening files slow for both us
+# and nginx.
+
+# for an image with file_path "name_1a2b..." the image is stored as
+# <L_IMAGE_PATH>/1a/2b/name_1a2b....jpg and its thumbnail next to it as
+# name_1a2b..._thumb.jpg, and so on.
+
+# the relocate_images command moves files stored by older versions (all in
+# L_IMAGE_PATH itself) into their directories.
+
+from django.conf import settings
+
+import hashlib
+import fcntl
+import os
+import re
+
+# find the hash at the end of an image's file_path
+HASH_RE = re.compile(r"_([0-9a-f]{64})$")
+# find the hash in the name of any of the image's files
+FILE_HASH_RE = re.compile(r"_([0-9a-f]{64})(?:_|\.)")
+
+# ioctl to ask the filesystem to share the data of one file with another
+# (a "reflink"). from linux/fs.h.
+FICLONE = 0x40049409
+
+class ImageStore:
+    # root is where the files are on disk, and redir_root is where nginx finds
+    # them for x-accel-redirect. each directory level uses two characters of
+    # the hash, so two levels gives 65536 directories.
+    def __init__(self, root, redir_root, levels=2):
+        self.root = root
+        self.redir_root = redir_root
+        self.levels = levels
+
+    # the directory of the image with the given file_path, relative to the root
+    def shard(self, file_path):
+        m = HASH_RE.search(file_path)
+        if m is not None:
+            image_hash = m.group(1)
+        else:
+            # shouldn't happen, but the files still need to go somewhere
+            image_hash = hashlib.sha256(file_path.encode("utf8")).hexdigest()
+        return self.hash_shard(image_hash)
+
+    # the directory for the given hash (as hex), relative to the root
+    def hash_shard(self, image_hash):
+        return "/".join(image_hash[i*2:i*2+2] for i in range(self.levels))
+
+    # path on disk to the file of the image with the given file_path. suffix is
+    # added on to the file_path, and includes the extension (e.g. ".jpg" for
+    # the image itself or "_thumb.jpg" for its thumbnail).
+    def path(self, file_path, suffix):
+        return self.root/self.shard(file_path)/(file_path+suffix)
+
+    # path nginx uses to find the same file
+    def redir_path(self, file_path, suffix):
+        return "{}/{}/{}{}".format(self.redir_root, self.shard(file_path),
+            file_path, suffix)
+
+    # make sure the directory for the image's files exists
+    def make_dir(self, file_path):
+        (self.root/self.shard(file_path)).mkdir(parents=True, exist_ok=True)
+
+    # where the file with the given name (in the old flat layout) belongs, or
+    # None if it doesn't look like it belongs to an image
+    def relocated_path(self, name):
+        m = FILE_HASH_RE.search(name)
+        if m is None:
+            return None
+        return self.root/self.hash_shard(m.group(1))/name
+
+# the store everything uses
+image_store = ImageStore(settings.L_IMAGE_PATH, "/image_real")
+
+# put a copy of the file at src at dest without copying any data if we can help
+# it. dest is replaced if it exists.
+
+# the best case is a hardlink, which costs nothing. this is okay because image
+# files are never modified once they're written, but it does mean dest must not
+# be modified either. if src and dest are on different filesystems, we try a
+# reflink, where the filesystem (e.g. btrfs or XFS) shares the data between the
+# files until one of them is changed. if that's not supported either, the data
+# is copied by the kernel without passing through us.
+def link_or_copy(src, dest):
+    try:
+        dest.unlink()
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+
+    src_file = open(src, "rb")
+    dest_file = open(dest, "wb")
+    try:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+
+        size = os.fstat(src_file.fileno()).st_size
+        copy = getattr(os, "copy_file_range", None) # only in python 3.8+
+        copied = 0
+        while copied < size:
+            if copy is not None:
+                try:
+                    n = copy(src_file.fileno(), dest_file.fileno(),
+                        size-copied)
+                except OSError:
+                    # probably not supported between these filesystems
+                    copy = None
+                    continue
+            else:
+                n = os.sendfile(dest_file.fileno(), src_file.fileno(),
+                    copied, size-copied)
+            if n == 0:
+                break # file got shorter?
+            copied += n
+    finally:
+        src_file.close()
+        dest_file.close()
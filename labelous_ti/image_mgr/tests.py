@@ -1,3 +1,68 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+import PIL.Image
+import piexif
+import io
+
+from .process_image import jpeg_size, ProcessingFailure
+from .views import accepts
+
+def make_jpeg(size, **save_args):
+    f = io.BytesIO()
+    PIL.Image.new("RGB", size, (12, 34, 56)).save(f, format="JPEG",
+        **save_args)
+    return f.getvalue()
+
+class JpegSizeTests(SimpleTestCase):
+    def size(self, data):
+        return jpeg_size(io.BytesIO(data))
+
+    def test_baseline(self):
+        self.assertEqual(self.size(make_jpeg((1234, 567))), (1234, 567))
+
+    def test_progressive(self):
+        self.assertEqual(self.size(make_jpeg((800, 1000), progressive=True)),
+            (800, 1000))
+
+    def test_skips_exif(self):
+        exif = piexif.dump({"0th": {piexif.ImageIFD.Orientation: 6}})
+        self.assertEqual(self.size(make_jpeg((640, 480), exif=exif)),
+            (640, 480))
+
+    def test_padded_markers(self):
+        data = make_jpeg((100, 200))
+        # any number of FFs can come before a marker
+        data = data[:2]+b"\xff\xff\xff"+data[2:]
+        self.assertEqual(self.size(data), (100, 200))
+
+    def test_not_jpeg(self):
+        f = io.BytesIO()
+        PIL.Image.new("RGB", (10, 10)).save(f, format="PNG")
+        with self.assertRaises(ProcessingFailure):
+            self.size(f.getvalue())
+
+    def test_truncated(self):
+        data = make_jpeg((100, 200))
+        sof = data.index(b"\xff\xc0")
+        for end in (1, 3, sof+1, sof+6):
+            with self.subTest(end=end), self.assertRaises(ProcessingFailure):
+                self.size(data[:end])
+
+    def test_no_sof(self):
+        with self.assertRaises(ProcessingFailure):
+            self.size(b"\xff\xd8\xff\xda\x00\x02")
+
+class AcceptsTests(SimpleTestCase):
+    def test_listed(self):
+        self.assertTrue(accepts("image/avif,image/webp,*/*", "image/avif"))
+        self.assertTrue(accepts("image/webp;q=0.8", "image/webp"))
+        self.assertTrue(accepts(" Image/WebP ; Q=1", "image/webp"))
+
+    def test_refused(self):
+        self.assertFalse(accepts("image/avif;q=0,image/webp", "image/avif"))
+        self.assertFalse(accepts("image/avif;q=0.0", "image/avif"))
+        self.assertFalse(accepts("image/avif;q=bogus", "image/avif"))
+
+    def test_wildcards_dont_count(self):
+        self.assertFalse(accepts("image/*,*/*;q=0.8", "image/avif"))
+        self.assertFalse(accepts("", "image/avif"))
@@ -0,0 +1,160 @@
+# this file manages the pool of processes that do the slow part of image
+# processing (transcode_image and transcode_image_file in process_image.py). the
+# worker processes are started once and reused for every image, so we pay for
+# starting python and importing everything only once per worker. each image
+# still gets its own jpegtran process, which is limited as described in
+# process_image.py.
+
+# both process_uploads and batch_upload use this, so the number of images being
+# processed at once, and therefore the memory used, is bounded by the number of
+# workers. the pool also keeps some statistics so the commands can report how
+# it's keeping up.
+
+# the workers are limited too, since decoding and resizing the image with PIL
+# takes much more memory than jpegtran does. a job that uses too much memory
+# gets a MemoryError and one that uses too much CPU time gets a JobTimeout, and
+# the worker carries on with the next one. if a worker dies anyway (e.g. the
+# OOM killer got it), the jobs the pool had are failed with BrokenProcessPool
+# and the pool starts new workers for the ones after.
+
+import concurrent.futures
+import concurrent.futures.process
+import resource
+import signal
+import threading
+import time
+
+# limits on each worker process while it works on one job
+WORKER_CPU_LIMIT = 60 # seconds of CPU time
+WORKER_MEMORY_LIMIT = 2*1024*1024*1024 # bytes of address space
+
+class JobTimeout(Exception):
+    pass
+
+def _cpu_exceeded(signum, frame):
+    raise JobTimeout("job used too much CPU time")
+
+# set a limit that is at most the hard limit. only the soft limit is changed so
+# it can be raised again later, and so jpegtran can set its own limits.
+def _set_soft_limit(which, limit):
+    _, hard = resource.getrlimit(which)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(which, (limit, hard))
+
+# called in each worker process when it starts
+_in_worker = False
+def _init_worker():
+    global _in_worker
+    _in_worker = True
+    # the kernel sends SIGXCPU once the CPU limit is reached. it would kill the
+    # worker, so turn it into an exception that fails the job instead.
+    signal.signal(signal.SIGXCPU, _cpu_exceeded)
+    _set_soft_limit(resource.RLIMIT_AS, WORKER_MEMORY_LIMIT)
+
+# run the function and return how long it took along with its result. this runs
+# in the worker, so the time doesn't include waiting in the queue.
+def _timed_call(fn, args):
+    if _in_worker:
+        # the CPU limit counts all the time the process has used, so move it
+        # to however much this job is allowed past what's been used so far
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _set_soft_limit(resource.RLIMIT_CPU,
+            int(usage.ru_utime+usage.ru_stime)+WORKER_CPU_LIMIT)
+    start = time.monotonic()
+    result = fn(*args)
+    return (time.monotonic()-start, result)
+
+class TranscodePool:
+    # with one worker, jobs are just run immediately in this process, which is
+    # easier to debug
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        if num_workers > 1:
+            self.executor = self._make_executor()
+        else:
+            self.executor = None
+
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.submitted = 0 # jobs given to the pool
+        self.completed = 0 # jobs that finished, successfully or not
+        self.failed = 0 # jobs that raised an exception
+        self.max_depth = 0 # most jobs ever waiting or running at once
+        self.work_time = 0 # seconds the workers spent on completed jobs
+        self.restarts = 0 # times the workers were started over
+
+    def _make_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.num_workers, initializer=_init_worker)
+
+    # number of jobs waiting for or being processed by a worker
+    @property
+    def depth(self):
+        with self.lock:
+            return self.submitted - self.completed
+
+    # run fn(*args) in a worker. returns a Future for its result.
+    def submit(self, fn, *args):
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth,
+                self.submitted - self.completed)
+
+        future = concurrent.futures.Future()
+        if self.executor is None:
+            # do it right now, but pretend it went through the pool so the
+            # rest works the same
+            try:
+                timed = _timed_call(fn, args)
+            except Exception as e:
+                self._finish(future, None, e)
+            else:
+                self._finish(future, timed, None)
+        else:
+            try:
+                inner = self.executor.submit(_timed_call, fn, args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died and broke the pool. its jobs have already
+                # failed, so start over with new workers.
+                self.executor.shutdown(wait=False)
+                self.executor = self._make_executor()
+                with self.lock:
+                    self.restarts += 1
+                inner = self.executor.submit(_timed_call, fn, args)
+            inner.add_done_callback(lambda inner: self._finish(future,
+                None if inner.exception() else inner.result(),
+                inner.exception()))
+
+        return future
+
+    # record the job's statistics and pass its result on
+    def _finish(self, future, timed, exception):
+        with self.lock:
+            self.completed += 1
+            if exception is None:
+                self.work_time += timed[0]
+            else:
+                self.failed += 1
+
+        if exception is None:
+            future.set_result(timed[1])
+        else:
+            future.set_exception(exception)
+
+    # a line describing how the pool has been doing, for the commands to print
+    def stats(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            succeeded = self.completed - self.failed
+            return ("pool: {} workers, {} queued (max {}), {} done, {} failed, "
+                "{} restarts, {:.2f}s avg work, {:.0f}% busy".format(
+                    self.num_workers, self.submitted - self.completed,
+                    self.max_depth, self.completed, self.failed, self.restarts,
+                    self.work_time/succeeded if succeeded > 0 else 0,
+                    100*self.work_time/(elapsed*self.num_workers)
+                        if elapsed > 0 else 0))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
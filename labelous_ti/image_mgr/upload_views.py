@@ -4,33 +4,38 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.core.files.uploadhandler import (
     FileUploadHandler, StopUpload, StopFutureHandlers
 )
 
 import shutil
-import io
+import hashlib
 
 from labelous import contest_info
-from .models import Image
+from .models import Image, UploadJob
 from label_app.filename_smuggler import *
-from .process_image import (process_image, MAX_IMAGE_SIZE,
-    ProcessingFailure, UnacceptableImage)
-
-# this custom upload handler stores the upload to memory, and then stops
-# processing it if it's too big. amazingly, it doesn't actually seem possible to
-# stop the upload, but we can at least stop storing more data.
+from .process_image import (queue_image, jpeg_size, check_dimensions,
+    MAX_IMAGE_SIZE, ProcessingFailure, UnacceptableImage)
+
+# this custom upload handler streams the upload to a temporary file, and then
+# stops processing it if it's too big. amazingly, it doesn't actually seem
+# possible to stop the upload, but we can at least stop storing more data. it
+# also calculates the upload's hash as it goes, so we never need to have the
+# whole image in memory.
 class RestrictedSizeUploadHandler(FileUploadHandler):
     def __init__(self, request, max_size):
         super().__init__(request)
         self.max_size = max_size
+        self.file = None
 
     def new_file(self, *args, **kwargs):
         super().new_file(*args, **kwargs)
 
         self.received_size = 0
-        self.chunks = []
+        self.hasher = hashlib.sha256()
+        self.file = TemporaryUploadedFile(self.file_name, self.content_type,
+            0, self.charset, self.content_type_extra)
 
         raise StopFutureHandlers() # we're doing this by ourselves
 
@@ -42,27 +47,24 @@ class RestrictedSizeUploadHandler(FileUploadHandler):
             # does at least stop processing, so that the server can prepare a
             # "too big" response and get on with other things while the client
             # wastes its time.
-            self.chunks = None
+            self.file.close() # deletes what we saved so far
+            self.file = None
             raise StopUpload(connection_reset=True)
         # save the chunk of data
-        self.chunks.append(raw_data)
+        self.hasher.update(raw_data)
+        self.file.write(raw_data)
 
     def file_complete(self, file_size):
-        # glue all the chunks together
-        data = b"".join(self.chunks)
-        mem_file = InMemoryUploadedFile(
-            # so we can turn it into a file type thing
-            file=io.BytesIO(data),
-            field_name=self.field_name,
-            name=self.file_name,
-            content_type=self.content_type,
-            size=file_size,
-            charset=self.charset,
-            content_type_extra=self.content_type_extra
-        )
-        # make sure we're not wasting memory on the chunk data
-        self.chunks = None
-        return mem_file
+        self.file.seek(0)
+        self.file.size = file_size
+        # remember the hash for deduplication
+        self.file.sha256 = self.hasher.digest()
+        return self.file
+
+    def upload_interrupted(self):
+        # get rid of the partial upload
+        if self.file is not None:
+            self.file.close()
 
 
 # we need to play a bit of games with CSRF so we can install the custom handler.
@@ -89,9 +91,26 @@ def upload_image_view(request):
             upload_image_post(request)
         return redirect("upload_image")
 
+    # tell the user how their queued images turned out
+    jobs = UploadJob.objects.filter(
+        uploader=request.user, reported=False).order_by("pk")
+    pending_jobs = []
+    reported_jobs = []
+    for job in jobs:
+        if job.state == UploadJob.DONE:
+            messages.add_message(request,
+                messages.SUCCESS if job.succeeded else messages.ERROR,
+                job.message)
+            reported_jobs.append(job.pk)
+        else:
+            pending_jobs.append(job)
+    if len(reported_jobs) > 0:
+        UploadJob.objects.filter(pk__in=reported_jobs).update(reported=True)
+
     return render(request, "image_mgr/upload.html",
         {"can_upload": can_upload,
-         "open_date": contest_info.open_date})
+         "open_date": contest_info.open_date,
+         "pending_jobs": pending_jobs})
 
 def upload_image_post(request):
     # first, check that the file is okay
@@ -105,41 +124,49 @@ def upload_image_post(request):
     the_image = request.FILES["the_image"]
     assert(the_image.size <= MAX_IMAGE_SIZE)
 
-    the_image_data = the_image.read()
     # make sure the file starts like a JPEG. we ignore the content_type since
     # who knows what it could be. it might be right but what if it's wrong?
-    if len(the_image_data) < 2 or the_image_data[:2] != b"\xff\xd8":
+    if the_image.read(2) != b"\xff\xd8":
         messages.add_message(request, messages.ERROR,
             "The image format is not JPEG. Please mind the upload guidelines.")
         return
     # it may still not be a jpeg even though the header claims so!
 
-    # but we let the processor handle that possibility. it returns the new Image
-    # (or None if the image wasn't new), or raises an exception if something
-    # went wrong.
+    # the header also tells us if the image is too small, so we don't need to
+    # make the user wait for processing to find that out
+    the_image.seek(0)
     try:
-        new_image = process_image(uploader=request.user,
-            name=the_image.name, orig_data=the_image_data)
-    except ProcessingFailure as e:
-        print(str(e))
+        check_dimensions(jpeg_size(the_image))
+    except ProcessingFailure:
         messages.add_message(request, messages.ERROR,
             "The image appears corrupt. Please try a different image.")
         return
     except UnacceptableImage as e:
-        # we stopped liking it in the middle of processing
         messages.add_message(request, messages.ERROR,
             str(e)+" Please mind the upload guidelines.")
         return
 
-    if new_image is not None:
-        messages.add_message(request, messages.SUCCESS,
-            "Thank you for your submission. The image will be reviewed"
-            " by a moderator before it is available for annotation.")
-    else:
+    # if we already have the image, we can tell the user right away. the
+    # processor checks again (properly) in case someone else uploads the same
+    # image in the meantime.
+    if Image.objects.filter(original_hash=the_image.sha256).exists():
         messages.add_message(request, messages.SUCCESS,
             "Thank you for your submission. Unfortunately, this image has"
             " already been submitted. Please try a different image.")
+        return
 
-    # now that the processing is complete, the view will redirect the user back
-    # to the upload page. if we just send the upload page again, then a refresh
-    # would re-POST the data.
+    # but we let the processor handle that possibility. processing takes a
+    # while, so we queue the image up and the process_uploads command takes
+    # care of it. the user is told how it went next time they load the page.
+    queue_image(uploader=request.user, name=the_image.name,
+        orig_path=the_image.temporary_file_path(),
+        image_hash=the_image.sha256)
+
+    messages.add_message(request, messages.SUCCESS,
+        "Thank you for your submission. The image will be processed shortly,"
+        " then reviewed by a moderator before it is available for"
+        " annotation.")
+
+    # now that the image is queued, the view will redirect the user back to the
+    # upload page. if we just send the upload page again, then a refresh would
+    # re-POST the data.
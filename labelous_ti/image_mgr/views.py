@@ -1,13 +1,64 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, FileResponse, Http404
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.utils.cache import (get_conditional_response,
+    patch_cache_control, patch_vary_headers)
 
-import shutil
+import os
 
-from .models import Image
+from .models import Image, THUMB_VARIANTS
 from label_app.filename_smuggler import *
 
+# how long browsers can keep images without asking about them again. the image
+# itself never changes, but the other files (e.g. thumbnails) can be remade if
+# the settings change, so the browser checks on those more often.
+IMAGE_CACHE_TIME = 365*24*60*60
+DERIVED_CACHE_TIME = 24*60*60
+
+# send the file at the given path of the given image, or ask nginx to send it
+# from the given x-accel-redirect path. if derived is False, the file is the
+# image itself.
+def serve_image(request, image, path, redir_path, derived=True,
+        content_type="image/jpeg"):
+    # the image is identified by its hash, so that makes a good ETag. the other
+    # files are made from it but may be remade, so we add when they were. the
+    # thumbnail formats come from the same URL and are made at nearly the same
+    # time, so we add the format too.
+    image_hash = bytes(image.original_hash).hex()
+    if derived:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError as e:
+            raise Http404("File does not exist.") from e
+        etag = '"{}-{}-{:x}"'.format(image_hash,
+            content_type.split("/")[-1], mtime)
+    else:
+        etag = '"{}"'.format(image_hash)
+
+    # if the browser already has this file, there's nothing to send
+    resp = get_conditional_response(request, etag=etag)
+    if resp is None:
+        if settings.L_IMAGE_ACCEL:
+            # ask nginx to serve the image on our behalf
+            resp = HttpResponse(content_type=content_type)
+            resp["X-Accel-Redirect"] = redir_path
+        else:
+            # the server can send this straight from the file (e.g. with
+            # sendfile) without us reading it into memory
+            resp = FileResponse(open(path, "rb"), content_type=content_type)
+
+    resp["ETag"] = etag
+    # the images are only for logged in users, so they can't be cached by
+    # anything but the browser
+    if derived:
+        patch_cache_control(resp, private=True, max_age=DERIVED_CACHE_TIME)
+    else:
+        patch_cache_control(resp, private=True, max_age=IMAGE_CACHE_TIME,
+            immutable=True)
+
+    return resp
+
 # serve images to the labeler
 @login_required
 def image_file(request, filename):
@@ -25,17 +76,75 @@ def image_file(request, filename):
     if canonical != filename:
         return redirect(image.image_url, permanent=True)
 
-    if settings.L_IMAGE_ACCEL:
-        # ask nginx to serve the image on our behalf
-        resp = HttpResponse(content_type="image/jpeg")
-        resp["X-Accel-Redirect"] = image.image_redir_path
-    else:
-        f = open(image.image_path, "rb")
-        resp = HttpResponse(content_type="image/jpeg")
-        shutil.copyfileobj(f, resp)
-        f.close()
+    return serve_image(request, image, image.image_path,
+        image.image_redir_path, derived=False)
 
-    return resp
+# serve the smaller levels of the image pyramid to the labeler. the labeler
+# loads one that fits the screen first, then the full image once the user zooms
+# in.
+@login_required
+def image_level_file(request, level, filename):
+    try:
+        nd = decode_filename(filename, image_id=True)
+        image = Image.objects.get(pk=nd.image_id, deleted=False)
+    except Exception as e:
+        raise Http404("Image does not exist.") from e
+
+    if level == 0:
+        # that's just the image
+        return redirect(image.image_url, permanent=True)
+    if level > image.num_levels:
+        raise Http404("Level does not exist.")
+
+    canonical = encode_filename(image_id=nd.image_id)
+    if canonical != filename:
+        return redirect(image.level_url(level), permanent=True)
+
+    if not image.level_path(level).exists():
+        # the image was uploaded before we made levels and make_levels hasn't
+        # been run yet. the full image is better than nothing.
+        return redirect(image.image_url)
+
+    return serve_image(request, image, image.level_path(level),
+        image.level_redir_path(level))
+
+# serve tiles of the full size image to the labeler
+@login_required
+def image_tile_file(request, col, row, filename):
+    try:
+        nd = decode_filename(filename, image_id=True)
+        image = Image.objects.get(pk=nd.image_id, deleted=False)
+    except Exception as e:
+        raise Http404("Image does not exist.") from e
+
+    cols, rows = image.tile_grid
+    if col >= cols or row >= rows:
+        raise Http404("Tile does not exist.")
+
+    canonical = encode_filename(image_id=nd.image_id)
+    if canonical != filename:
+        return redirect(image.tile_url(col, row), permanent=True)
+
+    return serve_image(request, image, image.tile_path(col, row),
+        image.tile_redir_path(col, row))
+
+# return True if the Accept header explicitly accepts the given content type,
+# i.e. lists it without q=0. wildcards don't count since browsers send them even
+# for formats they can't show.
+def accepts(accept, content_type):
+    for media_range in accept.split(","):
+        media_type, *params = media_range.split(";")
+        if media_type.strip().lower() != content_type:
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
 
 # serve image thumbnails
 @login_required
@@ -47,14 +156,22 @@ def image_thumb_file(request, filename):
     except Exception as e:
         raise Http404("Image does not exist.") from e
 
-    if settings.L_IMAGE_ACCEL:
-        # ask nginx to serve the image on our behalf
-        resp = HttpResponse(content_type="image/jpeg")
-        resp["X-Accel-Redirect"] = image.thumb_redir_path
+    # send the best format the browser says it can show. the variants might not
+    # exist if the image is old or the server couldn't make them.
+    accept = request.META.get("HTTP_ACCEPT", "")
+    for suffix, content_type in THUMB_VARIANTS:
+        if not accepts(accept, content_type):
+            continue
+        path = image.thumb_variant_path(suffix)
+        if path.exists():
+            resp = serve_image(request, image, path,
+                image.thumb_variant_redir_path(suffix),
+                content_type=content_type)
+            break
     else:
-        f = open(image.thumb_path, "rb")
-        resp = HttpResponse(content_type="image/jpeg")
-        shutil.copyfileobj(f, resp)
-        f.close()
+        resp = serve_image(request, image, image.thumb_path,
+            image.thumb_redir_path)
 
+    # the same URL gives a different file depending on what was accepted
+    patch_vary_headers(resp, ("Accept",))
     return resp
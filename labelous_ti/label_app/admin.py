@@ -9,3 +9,9 @@ from .models import Polygon
 class PolygonAdmin(admin.ModelAdmin):
     readonly_fields = ('creation_time', 'last_edit_time',)
 admin.site.register(Polygon, PolygonAdmin)
+
+from .models import Label
+class LabelAdmin(admin.ModelAdmin):
+    list_display = ('name', 'score', 'choice')
+    ordering = ('-choice', '-score', 'name')
+admin.site.register(Label, LabelAdmin)
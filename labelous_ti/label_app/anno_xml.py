@@ -0,0 +1,100 @@
+# this file builds the annotation XML documents we send to the tool. see the
+# theory of operation in views.py for what's in them and why.
+
+from django.conf import settings
+
+from xml.sax.saxutils import escape as xml_escape
+import functools
+
+from .filename_smuggler import *
+from .models import get_labels
+from image_mgr.models import TILE_SIZE
+
+# the tool can send non-integer coordinates even if they are a little silly. we
+# specify a limit of 2 decimal places to get good accuracy and make sure the
+# numbers are reasonable length. (i.e. not 3.5000000000000000069 or w/e)
+PT_FORMAT = "<pt><x>{:.2f}</x><y>{:.2f}</y></pt>"
+
+# build a format string that formats a whole polygon's worth of points in one
+# go. calling format once per point is most of the time it takes to build the
+# document, and polygons tend to have the same handful of point counts, so we
+# keep the strings around.
+@functools.lru_cache(maxsize=256)
+def _points_format(num_points):
+    return PT_FORMAT*num_points
+
+# turn a flat array of points (even indices are x and odd are y) into the tool's
+# <pt> tags
+def points_xml(points):
+    return _points_format(len(points)//2).format(*points)
+
+# generate the document for the given annotation and its polygons as a series of
+# strings. if edit_key is None, the document is for viewing only. the annotation's
+# image should already be loaded.
+def annotation_xml_chunks(annotation, polygons, edit_key=None):
+    view = edit_key is None
+
+    # because XML is hard and bad, we build the result with string operations.
+    # the annotation tool doesn't rebuild the document, it only modifies it.
+    # this means we can attach arbitrary tags (which we prefix with c_) and they
+    # will be returned untouched. it also means that most of the formatting we
+    # apply will be preserved. formatting is wasted bytes, so we don't put it
+    # in.
+    head = ["<annotation>"]
+
+    # store the edit key as a hex string. this, basically, ensures that the user
+    # doesn't get confused by having the same annotation open multiple times,
+    # and that the file's structure still matches the database. if we're not
+    # editing, we don't send the edit key, guaranteeing that the tool can't send
+    # back any changes.
+    if not view:
+        head.append("<edit_key>{}</edit_key>".format(edit_key.hex()))
+        # edit version always starts from 0
+        head.append("<edit_version>0</edit_version>")
+        # tell the tool we understand delta documents
+        head.append("<c_delta_ok>1</c_delta_ok>")
+    # specify which image file to show for this annotation. since we look up
+    # images by their ID, the folder doesn't matter as long as it's constant.
+    # it's not clear if this is actually used though?
+    head.append("<filename>{}.jpg</filename><folder>f</folder>".format(
+        encode_filename(image_id=annotation.image_id, anno_id=annotation.pk)))
+    # tell the tool how many smaller levels of the image there are so it can
+    # load one of those (from Images/l<level>/) first. if the image was cut into
+    # tiles, it can also load just the parts of the full image it needs (from
+    # Images/tile/<col>_<row>/) instead of the whole thing.
+    image = annotation.image
+    head.append("<c_levels>{}</c_levels>".format(image.num_levels))
+    if settings.L_IMAGE_TILES and image.tile_path(0, 0).exists():
+        head.append("<c_tile_size>{}</c_tile_size>".format(TILE_SIZE))
+    yield "".join(head)
+
+    # if verified is 1, the polygon will show an error if the user tries to
+    # edit it. we set the flag when the user is only allowed to view it.
+    verified = 1 if view else 0
+    labels = get_labels()
+    for polygon in polygons:
+        yield "".join((
+            # we need to know the polygon ID so we can update the record if the
+            # user changed the points
+            "<object><c_poly_id>{}</c_poly_id>".format(polygon.pk),
+            # the polygon's label as text
+            "<name>{}</name>".format(
+                xml_escape(labels.get(polygon.label_id).name)),
+            # if deleted is 1, the polygon won't show up. we avoid sending
+            # deleted polygons, so there's no case it would be set to 1.
+            "<deleted>0</deleted><verified>{}</verified>".format(verified),
+            # whether the user considers the polygon to be occluded. same as
+            # database flag.
+            "<occluded>{}</occluded>".format(
+                "yes" if polygon.occluded else "no"),
+            # any additional notes the user wants to put.
+            "<attributes>{}</attributes>".format(xml_escape(polygon.notes)),
+            # now the actual polygon points. we need to specify the user that
+            # created the polygon. so the tool is happy, we claim this is always
+            # the logged in user (or for now, a constant user.)
+            "<polygon><username>hi</username>",
+            points_xml(polygon.points),
+            "</polygon></object>",
+        ))
+
+    yield "</annotation>"
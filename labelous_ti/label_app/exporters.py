@@ -0,0 +1,470 @@
+# this file has the different ways the export_annos command can export the
+# finished annotations. each exporter is a class with an export() method, and
+# the command picks one from EXPORTERS by name. to add another format, write a
+# class like the ones below and add it there.
+
+# every exporter gets everything it needs from the database in a few bulk
+# queries, instead of looking things up annotation by annotation.
+
+from django.db.models import Prefetch, Case, When, F, FloatField
+from django.contrib.postgres.fields import ArrayField
+
+import concurrent.futures
+import collections
+import datetime
+import tarfile
+import array
+import json
+import sys
+import io
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .models import Annotation, Polygon, POINT_SCALE, get_labels, pack_points
+from image_mgr.storage import image_store, link_or_copy
+
+# how many annotations to load from the database at once
+BATCH_SIZE = 500
+
+# return the color of the label as an (r, g, b) tuple
+def get_color(label):
+    c = label.color
+    return (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16))
+
+# the image of each annotation has to be named the same as its annotation file
+# for desktop labelme to pick it up. the other formats use the same names.
+def image_name(anno_pk):
+    return "anno_{}.jpg".format(anno_pk)
+
+# turn packed points (see models.py) into a flat list of floats
+def unpack_points(packed_points):
+    points = array.array("i", bytes(packed_points))
+    if sys.byteorder != "little":
+        points.byteswap()
+    return [p/POINT_SCALE for p in points]
+
+class Exporter:
+    # out_dir is where to put the files, stdout is where to report how it went,
+    # and options are the command's options
+    def __init__(self, out_dir, stdout, options):
+        self.out_dir = out_dir
+        self.stdout = stdout
+        self.options = options
+
+    def export(self):
+        raise NotImplementedError
+
+    # load all the finished annotations, with their images and polygons, a
+    # batch at a time. prefetch_related doesn't work with iterator() (in this
+    # version of Django), so we do the batching ourselves.
+    def finished_annos(self):
+        annos = Annotation.objects.filter(finished=True).select_related(
+            "image").prefetch_related(Prefetch("polygons",
+                queryset=Polygon.objects.filter(deleted=False).defer(
+                    "points").order_by("pk"))).order_by("pk")
+        last_pk = -1
+        while True:
+            batch = list(annos.filter(pk__gt=last_pk)[:BATCH_SIZE])
+            if len(batch) == 0:
+                break
+            last_pk = batch[-1].pk
+            yield batch
+
+    # return a list of (anno pk, image_x, image_y, image file_path) of all the
+    # finished annotations, in one query
+    def anno_images(self):
+        return list(Annotation.objects.filter(finished=True).order_by(
+            "pk").values_list("pk", "image__image_x", "image__image_y",
+                "image__file_path"))
+
+    # iterate (polygon pk, anno pk, label ID, packed points) of the polygons of
+    # all the finished annotations, in one query. polygons that haven't had
+    # their points packed yet get them packed here, so the query only brings
+    # the unpacked points along for those.
+    def finished_polygons(self):
+        polygons = Polygon.objects.filter(annotation__finished=True,
+            deleted=False).order_by("annotation_id", "pk").annotate(
+                unpacked_points=Case(When(packed_points__isnull=True,
+                    then=F("points")), default=None,
+                    output_field=ArrayField(FloatField()))).values_list(
+                "pk", "annotation_id", "label_id", "packed_points",
+                "unpacked_points")
+        for poly_pk, anno_pk, label_id, packed_points, points in \
+                polygons.iterator():
+            if packed_points is None:
+                packed_points = pack_points(points)
+            yield (poly_pk, anno_pk, label_id, packed_points)
+
+    # link or copy the images of the given annotations (from anno_images)
+    # into the given directory, using a pool of threads
+    def export_images(self, anno_images, image_dir):
+        image_dir.mkdir(exist_ok=True)
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.options["jobs"])
+        futures = [pool.submit(link_or_copy,
+            image_store.path(file_path, ".jpg"), image_dir/image_name(pk))
+                for pk, _, _, file_path in anno_images]
+        for future in futures:
+            future.result()
+        pool.shutdown()
+
+# desktop LabelMe compatible JSON files, one per annotation, along with the
+# annotation's image.
+
+# a manifest in the output directory records the last edit time, image hash and
+# label version of each exported annotation. running the export again into the
+# same directory only writes annotations that changed since then (or all of
+# them, if any label did), and removes those that aren't finished anymore. the
+# manifest is saved after each batch, so an interrupted export also picks up
+# where it left off.
+
+# with --bundle, everything is instead written into tar files of --bundle-size
+# annotations each, which are much easier to move around than many thousands of
+# small files. bundles always contain every annotation.
+class LabelMeExporter(Exporter):
+    MANIFEST_NAME = "manifest.json"
+
+    def export(self):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.options["jobs"])
+        try:
+            if self.options["bundle"]:
+                self.export_bundles(self.options["bundle_size"],
+                    self.options["jobs"]*2)
+            else:
+                self.export_files()
+        finally:
+            self.pool.shutdown()
+
+    # build the JSON document for the annotation. its image and polygons should
+    # already be loaded.
+    @staticmethod
+    def anno_json(anno):
+        image = anno.image
+        # from some files generated by the tool
+        out_json = {
+            "version": "3.6.16",
+            "flags": {},
+            "lineColor": [0, 255, 0, 128],
+            "fillColor": [255, 0, 0, 128],
+            "imagePath": image_name(anno.pk),
+            "imageData": None,
+            "imageWidth": image.image_size[0],
+            "imageHeight": image.image_size[1],
+        }
+
+        # export all the labels for this annotation
+        labels = get_labels()
+        shapes = []
+        for pi, poly in enumerate(anno.polygons.all()):
+            # points are packed as hundredths
+            points = poly.point_array
+            out_points = []
+            for pti in range(0, len(points), 2):
+                out_points.append([int(points[pti])/POINT_SCALE,
+                    int(points[pti+1])/POINT_SCALE])
+
+            label = labels.get(poly.label_id)
+            color = get_color(label)
+            shapes.append({
+                "label": label.name,
+                "id": pi,
+                "line_color": [*color, 255],
+                "fill_color": [*color, 128],
+                "points": out_points,
+                "shape_type": "polygon",
+            })
+
+        out_json["shapes"] = shapes
+        return json.dumps(out_json)
+
+    # the manifest entry of the annotation: what we need to know if it changed.
+    # the label version is there because the files have the label names and
+    # colors in them.
+    @staticmethod
+    def manifest_entry(anno):
+        return [anno.last_edit_time.timestamp(),
+            bytes(anno.image.original_hash).hex(), get_labels().version]
+
+    # write the annotation's JSON and image into the output directory. the
+    # export is linked to the stored image if possible, so it must not be
+    # modified.
+    @staticmethod
+    def write_anno(out_dir, anno_pk, json_data, image_path):
+        link_or_copy(image_path, out_dir/image_name(anno_pk))
+        f = open(out_dir/("anno_{}.json".format(anno_pk)), "w")
+        f.write(json_data)
+        f.close()
+
+    # write a bundle of annotations, a list of (anno_pk, json_data,
+    # image_path), into a tar file at bundle_path
+    @staticmethod
+    def write_bundle(bundle_path, annos):
+        temp_path = bundle_path.with_name(bundle_path.name+".tmp")
+        tar = tarfile.open(temp_path, "w")
+        for anno_pk, json_data, image_path in annos:
+            tar.add(image_path, arcname=image_name(anno_pk))
+            json_data = json_data.encode("utf8")
+            info = tarfile.TarInfo("anno_{}.json".format(anno_pk))
+            info.size = len(json_data)
+            info.mtime = datetime.datetime.now().timestamp()
+            tar.addfile(info, io.BytesIO(json_data))
+        tar.close()
+        os.replace(temp_path, bundle_path)
+
+    def export_files(self):
+        manifest_path = self.out_dir/self.MANIFEST_NAME
+        try:
+            f = open(manifest_path, "r")
+            manifest = json.load(f)
+            f.close()
+        except FileNotFoundError:
+            manifest = {}
+        # annotations in the manifest we haven't seen this time
+        stale = set(manifest.keys())
+
+        num_written = 0
+        num_current = 0
+        for batch in self.finished_annos():
+            futures = []
+            for anno in batch:
+                key = str(anno.pk)
+                stale.discard(key)
+                entry = self.manifest_entry(anno)
+                if manifest.get(key) == entry:
+                    num_current += 1
+                    continue # already exported as it is now
+
+                futures.append((key, entry, self.pool.submit(self.write_anno,
+                    self.out_dir, anno.pk, self.anno_json(anno),
+                    anno.image.image_path)))
+
+            for key, entry, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.stdout.write("anno {}... {}".format(key, e))
+                    manifest.pop(key, None) # try again next time
+                else:
+                    manifest[key] = entry
+                    num_written += 1
+            self.save_manifest(manifest_path, manifest)
+
+        # get rid of annotations that aren't finished anymore
+        for key in stale:
+            for name in ("anno_{}.json", "anno_{}.jpg"):
+                try:
+                    (self.out_dir/name.format(key)).unlink()
+                except FileNotFoundError:
+                    pass
+            del manifest[key]
+        self.save_manifest(manifest_path, manifest)
+
+        self.stdout.write("{} written, {} already current, {} removed".format(
+            num_written, num_current, len(stale)))
+
+    # write the manifest so that nobody sees half of it
+    def save_manifest(self, manifest_path, manifest):
+        temp_path = manifest_path.with_name(manifest_path.name+".tmp")
+        f = open(temp_path, "w")
+        json.dump(manifest, f)
+        f.close()
+        os.replace(temp_path, manifest_path)
+
+    def export_bundles(self, bundle_size, max_pending):
+        # bundles being written. each one holds its annotations' JSON in
+        # memory, so we don't let too many pile up.
+        pending = collections.deque()
+        bundle = []
+        num_bundles = 0
+        num_annos = 0
+        for batch in self.finished_annos():
+            for anno in batch:
+                bundle.append((anno.pk, self.anno_json(anno),
+                    anno.image.image_path))
+                if len(bundle) < bundle_size:
+                    continue
+                pending.append(self.start_bundle(num_bundles, bundle))
+                num_bundles += 1
+                num_annos += len(bundle)
+                bundle = []
+                while len(pending) > max_pending:
+                    pending.popleft().result()
+        if len(bundle) > 0:
+            pending.append(self.start_bundle(num_bundles, bundle))
+            num_bundles += 1
+            num_annos += len(bundle)
+
+        while len(pending) > 0:
+            pending.popleft().result()
+        self.stdout.write("{} annotations in {} bundles".format(
+            num_annos, num_bundles))
+
+    def start_bundle(self, bundle_num, bundle):
+        bundle_path = self.out_dir/"annos_{:05d}.tar".format(bundle_num)
+        return self.pool.submit(self.write_bundle, bundle_path, bundle)
+
+# a single COCO instances.json covering all the annotations, with the images in
+# an images directory next to it. each annotation is its own COCO image (named
+# like the LabelMe export), since different users' annotations of the same
+# image shouldn't be mixed together.
+class CocoExporter(Exporter):
+    def export(self):
+        anno_images = self.anno_images()
+
+        # the categories are the labels, with the same IDs. the tool's choices
+        # come first, most valuable first. other labels (which can be typed in
+        # the tool) are added at the end as we find them.
+        labels = get_labels()
+        categories = {label.pk: label for label in sorted(
+            (label for label in labels.by_id.values() if label.choice),
+            key=lambda label: (-label.score, label.name))}
+
+        coco_annotations = []
+        for poly_pk, anno_pk, label_id, packed_points in \
+                self.finished_polygons():
+            points = unpack_points(packed_points)
+            if len(points) < 6:
+                continue # not a polygon, so COCO can't use it
+            xs = points[0::2]
+            ys = points[1::2]
+            # area by the shoelace formula
+            area = abs(sum(xs[i]*ys[i-1] - xs[i-1]*ys[i]
+                for i in range(len(xs))))/2
+            if label_id not in categories:
+                categories[label_id] = labels.get(label_id)
+            coco_annotations.append({
+                "id": poly_pk,
+                "image_id": anno_pk,
+                "category_id": label_id,
+                "segmentation": [points],
+                "area": area,
+                "bbox": [min(xs), min(ys), max(xs)-min(xs), max(ys)-min(ys)],
+                "iscrowd": 0,
+            })
+
+        coco = {
+            "info": {
+                "description": "Labelous export",
+                "date_created": datetime.datetime.now().isoformat(),
+            },
+            "images": [{
+                    "id": pk,
+                    "file_name": image_name(pk),
+                    "width": image_x,
+                    "height": image_y,
+                } for pk, image_x, image_y, _ in anno_images],
+            "annotations": coco_annotations,
+            "categories": [{
+                    "id": label.pk,
+                    "name": label.name,
+                    "supercategory": "object",
+                } for label in categories.values()],
+        }
+
+        f = open(self.out_dir/"instances.json", "w")
+        json.dump(coco, f)
+        f.close()
+
+        self.export_images(anno_images, self.out_dir/"images")
+
+        self.stdout.write("{} images, {} annotations, {} categories".format(
+            len(anno_images), len(coco_annotations), len(categories)))
+
+# all the polygons in one columnar file, so they can be loaded all at once
+# without parsing anything. with pyarrow, it's polygons.parquet with a row per
+# polygon, and the images are listed as (anno_id, width, height) in
+# images.json. otherwise, it's polygons.npz (which needs numpy) with these
+# arrays:
+
+# polygon_id, anno_id: the polygon's and its annotation's database IDs
+# label: index into labels for the polygon's label
+# offsets: the polygon's points are coords[offsets[i]:offsets[i+1]]
+# coords: all the points of all the polygons, as consecutive x, y
+# labels: the text of each label
+# images: (anno_id, width, height) of each annotation's image
+
+# the images aren't exported, since this is meant to go along with one of the
+# other exports.
+class ColumnarExporter(Exporter):
+    def export(self):
+        if pyarrow is None and numpy is None:
+            raise Exception("columnar export needs pyarrow or numpy")
+
+        polygon_ids = []
+        anno_ids = []
+        # index in label_list of each label ID
+        labels = {}
+        label_ids = []
+        offsets = [0]
+        # the packed points of each polygon, joined together at the end
+        packed = []
+        for poly_pk, anno_pk, label_id, packed_points in \
+                self.finished_polygons():
+            polygon_ids.append(poly_pk)
+            anno_ids.append(anno_pk)
+            label_ids.append(labels.setdefault(label_id, len(labels)))
+            packed.append(bytes(packed_points))
+            offsets.append(offsets[-1]+len(packed_points)//4)
+        packed = b"".join(packed)
+        all_labels = get_labels()
+        label_list = [all_labels.get(label_id).name
+            for label_id in labels.keys()]
+
+        anno_images = self.anno_images()
+
+        if pyarrow is not None:
+            self.write_parquet(polygon_ids, anno_ids, label_ids, label_list,
+                offsets, packed)
+            # images are small enough for JSON
+            f = open(self.out_dir/"images.json", "w")
+            json.dump([(pk, image_x, image_y)
+                for pk, image_x, image_y, _ in anno_images], f)
+            f.close()
+        else:
+            numpy.savez_compressed(self.out_dir/"polygons.npz",
+                polygon_id=numpy.array(polygon_ids, dtype=numpy.int64),
+                anno_id=numpy.array(anno_ids, dtype=numpy.int64),
+                label=numpy.array(label_ids, dtype=numpy.int32),
+                offsets=numpy.array(offsets, dtype=numpy.int64),
+                coords=numpy.frombuffer(packed, dtype="<i4").astype(
+                    numpy.float32)/POINT_SCALE,
+                labels=numpy.array(label_list, dtype=str),
+                images=numpy.array([(pk, image_x, image_y)
+                    for pk, image_x, image_y, _ in anno_images],
+                        dtype=numpy.int64).reshape(-1, 3))
+
+        self.stdout.write("{} polygons, {} labels".format(
+            len(polygon_ids), len(label_list)))
+
+    def write_parquet(self, polygon_ids, anno_ids, label_ids, label_list,
+            offsets, packed):
+        coords = pyarrow.array(numpy.frombuffer(packed, dtype="<i4").astype(
+            numpy.float32)/POINT_SCALE if numpy is not None else
+            unpack_points(packed), type=pyarrow.float32())
+        table = pyarrow.table({
+            "polygon_id": pyarrow.array(polygon_ids, type=pyarrow.int64()),
+            "anno_id": pyarrow.array(anno_ids, type=pyarrow.int64()),
+            "label": pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(label_ids, type=pyarrow.int32()),
+                pyarrow.array(label_list, type=pyarrow.string())),
+            "points": pyarrow.ListArray.from_arrays(
+                pyarrow.array(offsets, type=pyarrow.int32()), coords),
+        })
+        pyarrow.parquet.write_table(table, self.out_dir/"polygons.parquet")
+
+# the exporters the command knows about, by name
+EXPORTERS = {
+    "labelme": LabelMeExporter,
+    "coco": CocoExporter,
+    "columnar": ColumnarExporter,
+}
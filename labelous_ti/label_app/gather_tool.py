@@ -38,19 +38,12 @@ resources.update([
     "browserTools/css/main4.css",
 ])
 
-# one file the tool depends on is the names of all the priority objects. we have
-# to make that file especially for it.
-objects = []
-with open(script_dir/"label_priorities.txt", "r") as priorities:
-    for obj in priorities.readlines():
-        if obj == "" or obj == "\n": continue
-        if obj.endswith("\n"): obj = obj[:-1]
-        objects.append(obj.split(",", 1)[1])
-objects.sort()
+# the tool also needs the names of all the labels it offers. those are in the
+# database, so the tool view fills them in.
 obj_script = ['<script type="text/javascript">']
 obj_script.append("var object_choices = [")
-for obj in objects:
-    obj_script.append('"{}",'.format(obj))
+obj_script.append('{% for obj in object_choices %}"{{ obj|escapejs }}",'
+    '{% endfor %}')
 obj_script.append("]")
 obj_script.append("</script>")
 tool = tool.replace("<!--OBJECT_LIST-->", "\n".join(obj_script))
@@ -0,0 +1,35 @@
+# delete the PNG overlays that older versions drew next to the image thumbnails
+# (<file_path>_overlay_a<anno id>.png). the browse and review pages get their
+# overlays from the SVG sprite now, so nothing reads these files anymore. they
+# may be directly in L_IMAGE_PATH or, if relocate_images was run, in the
+# sharded directories, so everything is looked through.
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+import os
+import re
+
+OVERLAY_RE = re.compile(r"_overlay_a[0-9]+\.png$")
+
+class Command(BaseCommand):
+    help = "Delete the pre-rendered PNG annotation overlays."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+            help="Only print what would be deleted.")
+
+    def handle(self, *args, **options):
+        num_deleted = 0
+        for dirpath, dirnames, filenames in os.walk(settings.L_IMAGE_PATH):
+            for name in filenames:
+                if OVERLAY_RE.search(name) is None:
+                    continue
+                path = os.path.join(dirpath, name)
+                if options["dry_run"]:
+                    self.stdout.write(path)
+                else:
+                    os.unlink(path)
+                num_deleted += 1
+
+        self.stdout.write("deleted {} files".format(num_deleted))
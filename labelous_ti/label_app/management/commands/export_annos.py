@@ -1,79 +1,36 @@
-# export all the finished annotations to desktop LabelMe compatible JSON files
-# (along with the relevant images)
+# export all the finished annotations (along with the relevant images). the
+# formats are in label_app/exporters.py; the default is desktop LabelMe
+# compatible JSON files.
 
-from django.db import transaction
 from django.core.management.base import BaseCommand, CommandError
 
 import pathlib
-import json
 
-from label_app.models import Annotation
-from label_app.views import calculate_object_color
-
-# return the color of the name as an (r, g, b) tuple
-def get_color(name):
-    c = calculate_object_color(name)
-    return (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16))
+from label_app.exporters import EXPORTERS
 
 class Command(BaseCommand):
-    help = "Export finished annotations as JSON."
+    help = "Export finished annotations."
 
     def add_arguments(self, parser):
         parser.add_argument("dir",
-            help="Directory to place exported JSON files and images.")
+            help="Directory to place exported files and images.")
+        parser.add_argument("--format", choices=sorted(EXPORTERS.keys()),
+            default="labelme", help="Format to export in.")
+        parser.add_argument("--jobs", type=int, default=4,
+            help="Number of threads to write files with.")
+        parser.add_argument("--bundle", action="store_true",
+            help="Write tar bundles instead of separate files (labelme only).")
+        parser.add_argument("--bundle-size", type=int, default=1000,
+            help="Number of annotations in each bundle.")
 
     def handle(self, *args, **options):
         out_dir = pathlib.Path(options["dir"]).resolve(strict=True)
         if not out_dir.is_dir():
             raise Exception("output directory must be a directory")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs must be at least 1")
+        if options["bundle_size"] < 1:
+            raise CommandError("--bundle-size must be at least 1")
 
-        for anno in Annotation.objects.filter(finished=True).only("pk"):
-            with transaction.atomic():
-                # reselect the annotation for update so nobody else can touch it
-                # until we are done with it (and vice versa)
-                anno = Annotation.objects.select_for_update().get(pk=anno.pk)
-                if anno.finished is not True: continue
-                image = anno.image
-
-                # export this annotation's image. it has to be named the same as
-                # the annotation file for desktop labelme to pick it up
-                image_name = ("anno_{}.jpg".format(anno.pk))
-                src = image.image_path
-                dest = out_dir/image_name
-                dest.write_bytes(src.read_bytes())
-
-                # from some files generated by the tool
-                out_json = {
-                    "version": "3.6.16",
-                    "flags": {},
-                    "lineColor": [0, 255, 0, 128],
-                    "fillColor": [255, 0, 0, 128],
-                    "imagePath": image_name,
-                    "imageData": None,
-                    "imageWidth": image.image_size[0],
-                    "imageHeight": image.image_size[1],
-                }
-
-                # export all the labels for this annotation
-                shapes = []
-                for pi, poly in enumerate(anno.polygons.filter(deleted=False)):
-                    points = poly.points
-                    out_points = []
-                    for pti in range(0, len(points), 2):
-                        out_points.append([points[pti], points[pti+1]])
-
-                    color = get_color(poly.label_as_str)
-                    shapes.append({
-                        "label": poly.label_as_str,
-                        "id": pi,
-                        "line_color": [*color, 255],
-                        "fill_color": [*color, 128],
-                        "points": out_points,
-                        "shape_type": "polygon",
-                    })
-
-                out_json["shapes"] = shapes
-
-                f = open(out_dir/("anno_{}.json".format(anno.pk)), "w")
-                json.dump(out_json, f)
-                f.close()
+        exporter = EXPORTERS[options["format"]](out_dir, self.stdout, options)
+        exporter.export()
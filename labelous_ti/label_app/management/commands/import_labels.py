@@ -0,0 +1,49 @@
+# update the labels from a list in the format of label_priorities.txt: one
+# label per line, as the score, a comma, then the name. the labels on the list
+# become the tool's choices with the given scores. any other labels are no
+# longer offered and are worth nothing. run rescore afterwards to update the
+# annotations' scores.
+
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+import pathlib
+
+from label_app.models import Label
+
+class Command(BaseCommand):
+    help = "Update label choices and scores from a list."
+
+    def add_arguments(self, parser):
+        parser.add_argument("label_list", type=str)
+
+    def handle(self, *args, **options):
+        label_list = pathlib.Path(options["label_list"]).resolve(strict=True)
+
+        scores = {}
+        with open(label_list, "r") as priorities:
+            for obj in priorities.readlines():
+                if obj == "" or obj == "\n": continue
+                if obj.endswith("\n"): obj = obj[:-1]
+                try:
+                    score, name = obj.split(",", 1)
+                    scores[name] = float(score)
+                except ValueError as e:
+                    raise CommandError("bad line: {}".format(obj)) from e
+
+        num_changed = 0
+        with transaction.atomic():
+            for label in Label.objects.select_for_update():
+                score = scores.pop(label.name, None)
+                choice = score is not None
+                score = 0 if score is None else score
+                if label.score != score or label.choice != choice:
+                    label.score = score
+                    label.choice = choice
+                    label.save()
+                    num_changed += 1
+            for name, score in scores.items():
+                Label(name=name, score=score, choice=True).save()
+
+        print("Changed {} labels, added {} labels".format(
+            num_changed, len(scores)))
@@ -1,12 +1,19 @@
 # go through all the annotations in the database and recompute their scores
 
-from django.db import transaction
-from django.core.management.base import BaseCommand, CommandError
+# this is done in the database with one query: the label scores are joined with
+# every annotation's polygons and summed up per annotation. only annotations
+# whose score changed are updated (or, without --save, just reported). run it
+# after changing label scores.
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
 from django.utils import timezone
 
-from browser.models import User
-from label_app.models import Annotation, Polygon
-from label_app.views import load_object_scores
+from label_app.models import Annotation, Polygon, Label
+from browser.ledger import rebuild_scores
+
+# how many changed annotations to look up at once for the report
+REPORT_BATCH_SIZE = 1000
 
 class Command(BaseCommand):
     help = "Recompute scores for all annotations in the database."
@@ -16,22 +23,72 @@ class Command(BaseCommand):
             help="Save recomputed scores to the database.")
 
     def handle(self, *args, **options):
-        do_save = options["save"]
-        edit_time = timezone.now()
+        anno_table = connection.ops.quote_name(Annotation._meta.db_table)
+        poly_table = connection.ops.quote_name(Polygon._meta.db_table)
+        label_table = connection.ops.quote_name(Label._meta.db_table)
+        # the new score of every annotation whose score is off by more than a
+        # rounding error. new is the new score and old is the current one.
+        changed_sql = """
+            WITH new_scores AS (
+                SELECT a.id, COALESCE(SUM(l.score), 0) AS score
+                FROM {anno} a
+                LEFT JOIN {poly} p ON p.annotation_id = a.id AND NOT p.deleted
+                LEFT JOIN {label} l ON l.id = p.label_id
+                WHERE NOT a.deleted
+                GROUP BY a.id
+            )
+            SELECT old.id, old.score AS old, new_scores.score AS new
+            FROM new_scores JOIN {anno} old ON old.id = new_scores.id
+            WHERE abs(old.score - new_scores.score) > 0.01
+        """.format(anno=anno_table, poly=poly_table, label=label_table)
 
-        object_scores = load_object_scores()
+        with transaction.atomic(), connection.cursor() as cursor:
+            if options["save"]:
+                # stop anyone from editing annotations while we're working so
+                # we can't save a score calculated from polygons that just
+                # changed. viewing is still fine. edits lock their annotation
+                # with SELECT ... FOR UPDATE first, which this mode conflicts
+                # with, so we wait for any edits in progress to finish instead
+                # of deadlocking with them. the lock is held until all the
+                # polygons have been summed up and saved, so edits will be
+                # stuck for as long as that takes.
+                cursor.execute("LOCK TABLE {} IN EXCLUSIVE MODE".format(
+                    anno_table))
+                # save the updated scores back to the database. we don't change
+                # the edit key because nobody else can be editing right now and
+                # edits will recalculate the score anyway.
+                cursor.execute("""
+                    WITH changed AS ({changed})
+                    UPDATE {anno} a SET score = changed.new, last_edit_time = %s
+                    FROM changed WHERE a.id = changed.id
+                    RETURNING changed.id, changed.old, changed.new
+                """.format(changed=changed_sql, anno=anno_table),
+                    (timezone.now(),))
+            else:
+                cursor.execute(changed_sql)
+            changed = cursor.fetchall()
 
-        for anno in Annotation.objects.filter(deleted=False).only("pk"):
-            with transaction.atomic():
-                # reselect the annotation for update so nobody else can touch it
-                # until we are done with it (and vice versa)
-                anno = Annotation.objects.select_for_update().get(pk=anno.pk)
+            if options["save"]:
+                # the annotators' points changed too
+                rebuild_scores(Annotation.objects.filter(
+                    pk__in=[pk for pk, _, _ in changed]).values_list(
+                        "annotator", flat=True).distinct())
 
-                # get all the labels for this annotation
-                polys = anno.polygons.filter(deleted=False).only("label_as_str")
-                # then tally up the score
-                score = sum(object_scores.get(p.label_as_str, 0) for p in polys)
+        self.report(changed)
+        print("{} annotations {}".format(len(changed),
+            "updated" if options["save"] else "would be updated"))
 
+    # print who each changed annotation belongs to and how its score changed
+    def report(self, changed):
+        changed.sort()
+        for start in range(0, len(changed), REPORT_BATCH_SIZE):
+            batch = changed[start:start+REPORT_BATCH_SIZE]
+            annos = Annotation.objects.filter(
+                pk__in=[pk for pk, _, _ in batch]).select_related(
+                    "annotator").only("finished", "locked", "annotator",
+                        "annotator__email").in_bulk()
+            for pk, old, new in batch:
+                anno = annos[pk]
                 if anno.finished:
                     status = "finished"
                 elif anno.locked:
@@ -39,17 +96,5 @@ class Command(BaseCommand):
                 else:
                     status = "in progress"
 
-                if abs(anno.score - score) > 0.01:
-                    print("by:{} status:{} {:.1f}->{:.1f}".format(
-                        anno.annotator.email, status,
-                        anno.score, score))
-
-                    # save the updated score back to the database. we don't
-                    # change the edit key because a) we've calculated an
-                    # accurate score since nobody else is touching this
-                    # annotation right now and b) edits will recalculate the
-                    # score anyway.
-                    if do_save:
-                        anno.last_edit_time = edit_time
-                        anno.score = score
-                        anno.save()
+                print("by:{} status:{} {:.1f}->{:.1f}".format(
+                    anno.annotator.email, status, old, new))
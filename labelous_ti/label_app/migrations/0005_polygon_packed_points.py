@@ -0,0 +1,44 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:22
+
+from django.db import migrations, models
+
+import array
+import sys
+
+
+# copy of label_app.models.pack_points as of this migration, so later changes
+# to it don't change what this migration does
+def pack_points(points):
+    packed = array.array("i", (round(p*100) for p in points))
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+def backfill_packed_points(apps, schema_editor):
+    Polygon = apps.get_model("label_app", "Polygon")
+    batch = []
+    for poly in Polygon.objects.only("pk", "points").iterator(chunk_size=2000):
+        poly.packed_points = pack_points(poly.points)
+        batch.append(poly)
+        if len(batch) == 2000:
+            Polygon.objects.bulk_update(batch, ["packed_points"])
+            batch = []
+    if len(batch) > 0:
+        Polygon.objects.bulk_update(batch, ["packed_points"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('label_app', '0004_auto_20200910_1411'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='polygon',
+            name='packed_points',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_packed_points,
+            migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('label_app', '0005_polygon_packed_points'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(condition=models.Q(('deleted', False), ('finished', False), ('locked', True)), fields=['id'], name='anno_review_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('label_app', '0006_review_queue_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(condition=models.Q(deleted=False), fields=['annotator', 'image'], name='anno_user_image_idx'),
+        ),
+    ]
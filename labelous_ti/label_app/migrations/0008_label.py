@@ -0,0 +1,90 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import pathlib
+
+
+# copy of label_app.models.calculate_object_color as of this migration, so
+# later changes to it don't change what this migration does
+object_colors = \
+    ["#009900","#00ff00","#ccff00","#ffff00","#ffcc00","#ff9999","#cc0033",
+    "#ff33cc","#9933ff","#990099","#000099","#006699","#00ccff","#999900"]
+def calculate_object_color(name):
+    name_hash = sum(name.upper().encode("utf8"))
+    color_idx = (((name_hash + 567) * 1048797) % len(object_colors))
+    return object_colors[color_idx]
+
+
+# make a label for everything in the old label_priorities.txt, which were the
+# choices, and for every other label a polygon has
+def fill_labels(apps, schema_editor):
+    Label = apps.get_model("label_app", "Label")
+    Polygon = apps.get_model("label_app", "Polygon")
+
+    labels = {}
+    priorities_path = pathlib.Path(__file__).resolve().parent.parent/ \
+        "label_priorities.txt"
+    with open(priorities_path, "r") as priorities:
+        for obj in priorities.readlines():
+            if obj == "" or obj == "\n": continue
+            if obj.endswith("\n"): obj = obj[:-1]
+            score, name = obj.split(",", 1)
+            labels[name] = Label(name=name, score=float(score),
+                color=calculate_object_color(name), choice=True)
+    for name in Polygon.objects.values_list(
+            "label_as_str", flat=True).distinct().iterator():
+        if name not in labels:
+            labels[name] = Label(name=name, score=0,
+                color=calculate_object_color(name), choice=False)
+    Label.objects.bulk_create(labels.values(), batch_size=2000)
+
+# point each polygon at the label with its name
+def fill_polygon_labels(apps, schema_editor):
+    Label = apps.get_model("label_app", "Label")
+    Polygon = apps.get_model("label_app", "Polygon")
+    for label_id, name in Label.objects.values_list("pk", "name"):
+        Polygon.objects.filter(label_as_str=name).update(label_id=label_id)
+
+def empty_polygon_labels(apps, schema_editor):
+    Label = apps.get_model("label_app", "Label")
+    Polygon = apps.get_model("label_app", "Polygon")
+    for label_id, name in Label.objects.values_list("pk", "name"):
+        Polygon.objects.filter(label_id=label_id).update(label_as_str=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('label_app', '0007_anno_user_image_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Label',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('score', models.FloatField(default=0)),
+                ('color', models.CharField(blank=True, max_length=7)),
+                ('choice', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.RunPython(fill_labels, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='polygon',
+            name='label',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='polygons', to='label_app.Label'),
+        ),
+        migrations.RunPython(fill_polygon_labels, empty_polygon_labels),
+        migrations.AlterField(
+            model_name='polygon',
+            name='label',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='polygons', to='label_app.Label'),
+        ),
+        migrations.RemoveField(
+            model_name='polygon',
+            name='label_as_str',
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('label_app', '0008_label'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['annotator', 'locked', 'finished', 'deleted', 'id'], name='anno_nav_idx'),
+        ),
+    ]
@@ -1,9 +1,19 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import ValidationError
 from django.urls import reverse
+from django.core.cache import cache
 
 from datetime import datetime
+import secrets
+import array
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from browser.models import User
 from image_mgr.models import Image
@@ -42,19 +52,36 @@ class Annotation(models.Model):
     # TODO: convert to text field and remove max length
     comment = models.CharField(max_length=2000, blank=True)
 
+    class Meta:
+        indexes = [
+            # the review queue only looks at annotations awaiting review, in pk
+            # order. those are a tiny fraction of all annotations, so a partial
+            # index keeps it quick to page through.
+            models.Index(fields=["id"], name="anno_review_queue_idx",
+                condition=Q(locked=True, finished=False, deleted=False)),
+            # finding an image a user doesn't already have an annotation for
+            # looks up each candidate image in the user's annotations
+            models.Index(fields=["annotator", "image"],
+                name="anno_user_image_idx", condition=Q(deleted=False)),
+            # the tool's next and previous buttons step through one user's
+            # annotations in one state in pk order
+            models.Index(fields=["annotator", "locked", "finished", "deleted",
+                "id"], name="anno_nav_idx"),
+        ]
+
     # return the url that goes to the tool to edit this annotation
     @property
     def edit_url(self):
         return reverse("label_app:label_tool")+("#collection=LabelMe&mode=f"
             "&folder=f&image={}&username=hi&actions=a").format(
-            encode_filename(image_id=self.image.pk, anno_id=self.pk))
+            encode_filename(image_id=self.image_id, anno_id=self.pk))
 
     # return the url that goes to the tool to just look at this annotation
     @property
     def view_url(self):
         return reverse("label_app:label_tool")+("#collection=LabelMe&mode=f"
             "&folder=f&image={}&username=hi&actions=v").format(
-            encode_filename(image_id=self.image.pk, anno_id=self.pk,
+            encode_filename(image_id=self.image_id, anno_id=self.pk,
                 # ensures the edit key isn't changed
                 view=True))
 
@@ -70,6 +97,142 @@ def validate_is_points(value):
     if len(value) % 2 != 0:
         raise ValidationError("points must be x,y pairs. can't be odd length!")
 
+# the tool only gets points with 2 decimal places, so we can store them exactly
+# as whole numbers of hundredths of a pixel
+POINT_SCALE = 100
+
+# pack a flat list of points into little-endian int32 hundredths
+def pack_points(points):
+    packed = array.array("i", (round(p*POINT_SCALE) for p in points))
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+# gives the polygon's packed points as an array of int32 hundredths, using
+# numpy if it's around. the array shares memory with the packed data, so it's
+# cheap to get but also read-only.
+class PackedPointsDescriptor:
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        data = instance.packed_points
+        if data is None:
+            # not backfilled yet
+            data = pack_points(instance.points)
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype="<i4")
+        if sys.byteorder != "little":
+            # can't be zero-copy here, but this is just in case
+            unpacked = array.array("i", bytes(data))
+            unpacked.byteswap()
+            return memoryview(unpacked)
+        return memoryview(data).cast("B").cast("i")
+
+# give an object's outline a color based on its name. taken from the JS so we
+# can give the same colors
+object_colors = \
+    ["#009900","#00ff00","#ccff00","#ffff00","#ffcc00","#ff9999","#cc0033",
+    "#ff33cc","#9933ff","#990099","#000099","#006699","#00ccff","#999900"]
+def calculate_object_color(name):
+    # might not give the same color for non-ascii chars but those aren't very
+    # likely and it doesn't matter much anyway
+    name_hash = sum(name.upper().encode("utf8"))
+    color_idx = (((name_hash + 567) * 1048797) % len(object_colors))
+    return object_colors[color_idx]
+
+# a label that polygons can have. the tool offers the choices as a list, but
+# users can also type in whatever they like, so any label we haven't seen
+# before gets added (with no score).
+class Label(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    # how many points each object with this label is worth
+    score = models.FloatField(default=0)
+    # color the objects' outlines are drawn in, as #rrggbb. calculated from the
+    # name if not given.
+    color = models.CharField(max_length=7, blank=True)
+    # if the tool offers this label in its list
+    choice = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        if self.color == "":
+            self.color = calculate_object_color(self.name)
+        # a new label doesn't change any the processes already have, and they
+        # load it once they come across its ID. but if the tool should offer
+        # it, they have to know about it now.
+        changed = not self._state.adding or self.choice
+        super().save(*args, **kwargs)
+        if changed:
+            # let all the processes know once the change is actually there
+            transaction.on_commit(labels_changed)
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        transaction.on_commit(labels_changed)
+
+# the labels are needed for nearly everything and there aren't many of them, so
+# each process keeps them all in memory. the cache holds a version that's
+# changed whenever a label is, and a process reloads its labels once the version
+# isn't the one it loaded them under. the cache is shared by all the processes,
+# so they see changes right away and the version never has to expire. if it's
+# lost anyway (e.g. the cache was cleared), a new one is made and everybody
+# reloads. labels that are just added (like the ones users type in) don't change
+# the version, since everything already loaded is still right; a process picks
+# them up when it comes across one it doesn't have.
+LABEL_VERSION_KEY = "label_version"
+
+# all the labels, looked up a few ways, as of the given version
+class LabelSet:
+    def __init__(self, labels, version):
+        self.version = version
+        self.by_id = {label.pk: label for label in labels}
+        self.by_name = {label.name: label for label in labels}
+        # names of the labels the tool offers, in alphabetical order
+        self.choices = sorted(label.name for label in labels if label.choice)
+
+    # the label with the given ID. one that was just added by another process
+    # might not be here yet, so if it's missing, we load the labels again.
+    def get(self, label_id):
+        try:
+            return self.by_id[label_id]
+        except KeyError:
+            return load_labels(self.version).by_id[label_id]
+
+label_set = None
+def get_labels():
+    version = cache.get(LABEL_VERSION_KEY)
+    if version is None:
+        # nobody has set one (or it was lost), so whatever we have is suspect.
+        # someone else may be setting one at the same time, so use theirs if so.
+        cache.add(LABEL_VERSION_KEY, secrets.token_hex(8), None)
+        version = cache.get(LABEL_VERSION_KEY)
+    if label_set is None or version != label_set.version:
+        return load_labels(version)
+    return label_set
+
+def load_labels(version):
+    global label_set
+    label_set = LabelSet(list(Label.objects.all()), version)
+    return label_set
+
+def labels_changed():
+    cache.set(LABEL_VERSION_KEY, secrets.token_hex(8), None)
+
+# get the labels with the given names, adding any that don't exist. returns a
+# dict of name to Label. should be called in the transaction that uses the
+# labels, so the new ones aren't left behind if it's rolled back.
+def get_or_add_labels(names):
+    labels = get_labels().by_name
+    found = {}
+    for name in names:
+        label = labels.get(name)
+        if label is None:
+            label, _ = Label.objects.get_or_create(name=name)
+        found[name] = label
+    return found
+
 # one polygon on an annotation
 class Polygon(models.Model):
     # the annotation this polygon belongs to
@@ -79,14 +242,20 @@ class Polygon(models.Model):
     creation_time = models.DateTimeField(auto_now_add=True)
     # when this polygon was last edited
     last_edit_time = models.DateTimeField()
-    # this polygon's label. for now a string, but will be changed later
-    label_as_str = models.CharField(max_length=255)
+    # this polygon's label
+    label = models.ForeignKey(Label, on_delete=models.PROTECT,
+        related_name="polygons")
     # any notes the user attached to this polygon
     notes = models.TextField(blank=True)
     # the points in this polygon as consecutive x, y entries. we could use a
     # nested array, but it's hard to deal with in the admin interface. so
     # instead we just enforce that this field's length is a multiple of 2.
     points = ArrayField(models.FloatField(), validators=[validate_is_points])
+    # the same points, packed by pack_points. much smaller than the array and
+    # can be compared and processed without building a list of floats. kept up
+    # to date with points whenever the polygon is saved.
+    packed_points = models.BinaryField(null=True, editable=False)
+    point_array = PackedPointsDescriptor()
     # occluded: if the polygon is considered occluded by another object.
     # the annotator has a checkbox to set it.
     occluded = models.BooleanField(default=False)
@@ -97,3 +266,10 @@ class Polygon(models.Model):
     locked = models.BooleanField(default=False)
     # deleted: if true, polygon can't be seen anymore
     deleted = models.BooleanField(default=False)
+
+    def save(self, *args, **kwargs):
+        # points might not have been loaded. if they weren't, they can't have
+        # been changed either.
+        if "points" in self.__dict__:
+            self.packed_points = pack_points(self.points)
+        super().save(*args, **kwargs)
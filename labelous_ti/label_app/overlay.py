@@ -0,0 +1,54 @@
+# this file draws the annotation overlays shown on top of the image thumbnails
+# in the browser. the browse pages show dozens of them at once, so they all come
+# from one SVG sprite instead of a request for each one.
+
+from django.urls import reverse
+
+from datetime import datetime
+
+from .models import POINT_SCALE, get_labels
+
+# return the given polygons as a list of SVG <polygon> tags, scaled down to the
+# size of the image's thumbnail
+def svg_polygons(image, polygons):
+    image_size = image.image_size
+    thumb_size = image.thumb_size
+    x_scale = thumb_size[0]/image_size[0]
+    y_scale = thumb_size[1]/image_size[1]
+    # the points are packed as hundredths
+    scale = min(x_scale, y_scale)/POINT_SCALE
+    labels = get_labels()
+
+    svg = []
+    for polygon in polygons:
+        svg.append('<polygon fill="none" points="')
+        points = polygon.point_array
+        for pi in range(0, len(points), 2):
+            svg.append('{:.2f},{:.2f} '.format(
+                points[pi]*scale, points[pi+1]*scale))
+        svg.append('" style="stroke:{}; stroke-width:2;"/>'.format(
+            labels.get(polygon.label_id).color))
+    return svg
+
+# maximum number of annotations that can be put in one sprite
+MAX_SPRITE_ANNOS = 1000
+
+# return the url of the sprite containing the overlays of all the given
+# annotations. there can't be more than MAX_SPRITE_ANNOS of them.
+def sprite_url(annotations):
+    # add the latest edit timestamp and the label version so the sprite's cache
+    # is reset if any of the annotations or their labels' colors change
+    timestamp = max(datetime.timestamp(a.last_edit_time) for a in annotations)
+    return reverse("label_app:anno_sprite")+"?ids={}&t={}&l={}".format(
+        ",".join(str(a.pk) for a in annotations), timestamp,
+        get_labels().version)
+
+# give each of the annotations a sprite_url attribute with the url of the
+# sprite its overlay is in. the browse pages can have any number of
+# annotations, so they are split up into as many sprites as it takes.
+def set_sprite_urls(annotations):
+    for start in range(0, len(annotations), MAX_SPRITE_ANNOS):
+        sprite = annotations[start:start+MAX_SPRITE_ANNOS]
+        url = sprite_url(sprite)
+        for annotation in sprite:
+            annotation.sprite_url = url
@@ -1,3 +1,293 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import caches
+from django.urls import reverse
+from django.utils import timezone
 
-# Create your tests here.
+from unittest import mock
+import datetime
+
+from labelous import contest_info
+from browser.models import User
+from image_mgr.models import Image
+from .models import Annotation, Label, Polygon, pack_points
+from .exporters import unpack_points
+from .filename_smuggler import encode_filename
+from .views import nav_annotations, step_annotations
+
+# separate local caches, so the tests don't share the real one
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_default',
+    },
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_auth',
+    },
+}
+
+class PackedPointsTests(SimpleTestCase):
+    points = [0, 1.5, 123.45, 0.01, -2.01, 65535.99]
+
+    def test_pack_is_little_endian_hundredths(self):
+        self.assertEqual(pack_points([1.5, -0.01]),
+            (150).to_bytes(4, "little", signed=True)+
+            (-1).to_bytes(4, "little", signed=True))
+
+    def test_round_trip(self):
+        self.assertEqual(unpack_points(pack_points(self.points)), self.points)
+
+    def test_empty(self):
+        self.assertEqual(pack_points([]), b"")
+        self.assertEqual(unpack_points(b""), [])
+
+    def test_point_array(self):
+        polygon = Polygon(points=self.points,
+            packed_points=pack_points(self.points))
+        self.assertEqual(list(polygon.point_array),
+            [round(p*100) for p in self.points])
+
+    def test_point_array_not_backfilled(self):
+        # polygons saved before packed_points existed only have the points
+        polygon = Polygon(points=self.points, packed_points=None)
+        self.assertEqual(list(polygon.point_array),
+            [round(p*100) for p in self.points])
+
+# build an <object> the way the tool sends it back
+def object_xml(name, points, poly_id=None, index=None, deleted=False):
+    xml = ["<object>"]
+    if poly_id is not None:
+        xml.append("<c_poly_id>{}</c_poly_id>".format(poly_id))
+    if index is not None:
+        xml.append("<c_index>{}</c_index>".format(index))
+    xml.append("<name>{}</name><deleted>{}</deleted><verified>0</verified>"
+        "<occluded>no</occluded><attributes></attributes><polygon>".format(
+            name, 1 if deleted else 0))
+    for pi in range(0, len(points), 2):
+        xml.append("<pt><x>{}</x><y>{}</y></pt>".format(
+            points[pi], points[pi+1]))
+    xml.append("</polygon></object>")
+    return "".join(xml)
+
+@override_settings(CACHES=TEST_CACHES)
+class DeltaDocumentTests(TestCase):
+    def setUp(self):
+        for alias in TEST_CACHES.keys():
+            caches[alias].clear()
+        patcher = mock.patch.object(contest_info, "_real_close_date",
+            timezone.now()+datetime.timedelta(days=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user("annotator@example.com")
+        self.client.force_login(self.user)
+        image = Image.objects.create(file_path="image", available=True,
+            uploaded=True, original_hash=bytes(32), image_x=4000,
+            image_y=3000, uploader=self.user)
+        self.edit_key = bytes(range(16))
+        self.annotation = Annotation.objects.create(annotator=self.user,
+            image=image, edit_key=self.edit_key,
+            last_edit_time=timezone.now())
+        self.car = Label.objects.create(name="car", score=2, choice=True)
+        self.tree = Label.objects.create(name="tree", score=1, choice=True)
+
+    def post(self, objects, version, delta):
+        root = "annotation_delta" if delta else "annotation"
+        doc = ("<{root}><edit_key>{key}</edit_key>"
+            "<edit_version>{version}</edit_version>"
+            "<filename>{filename}.jpg</filename>{objects}</{root}>").format(
+                root=root, key=self.edit_key.hex(), version=version,
+                filename=encode_filename(image_id=self.annotation.image_id,
+                    anno_id=self.annotation.pk),
+                objects="".join(objects))
+        return self.client.post(
+            "/label/annotationTools/perl/submit.cgi", doc,
+            content_type="text/xml")
+
+    def polygons(self):
+        return {poly.anno_index: poly for poly in
+            self.annotation.polygons.filter(deleted=False)}
+
+    def test_delta_only_changes_its_objects(self):
+        resp = self.post([object_xml("car", [1, 2, 3, 4, 5, 6]),
+            object_xml("tree", [7, 8, 9, 10, 11, 12])], 1, delta=False)
+        self.assertContains(resp, "<nop/>")
+        # the tree is still known by its index since it was made under this
+        # edit key
+        resp = self.post([object_xml("car", [7, 8, 9, 10, 11, 12.5],
+            index=1)], 2, delta=True)
+        self.assertContains(resp, "<nop/>")
+
+        polygons = self.polygons()
+        self.assertEqual(len(polygons), 2)
+        self.assertEqual(polygons[0].label_id, self.car.pk)
+        self.assertEqual(list(polygons[0].point_array),
+            [100, 200, 300, 400, 500, 600])
+        self.assertEqual(polygons[1].label_id, self.car.pk)
+        self.assertEqual(list(polygons[1].point_array),
+            [700, 800, 900, 1000, 1100, 1250])
+        # the car that wasn't in the delta still counts
+        self.annotation.refresh_from_db()
+        self.assertEqual(self.annotation.score, 4)
+        self.assertEqual(self.annotation.edit_version, 2)
+
+    def test_delta_deletes_by_id(self):
+        polygon = Polygon.objects.create(annotation=self.annotation,
+            label=self.tree, points=[1, 2, 3, 4, 5, 6],
+            last_edit_time=timezone.now())
+        resp = self.post([object_xml("tree", [1, 2, 3, 4, 5, 6],
+            poly_id=polygon.pk, deleted=True)], 1, delta=True)
+        self.assertContains(resp, "<nop/>")
+        polygon.refresh_from_db()
+        self.assertTrue(polygon.deleted)
+        self.annotation.refresh_from_db()
+        self.assertEqual(self.annotation.score, 0)
+
+    def test_version_gap_needs_full_document(self):
+        resp = self.post([object_xml("car", [1, 2, 3, 4, 5, 6], index=0)], 2,
+            delta=True)
+        self.assertContains(resp, "<resend_full/>")
+        self.assertEqual(len(self.polygons()), 0)
+        # and the full document fixes it
+        resp = self.post([object_xml("car", [1, 2, 3, 4, 5, 6])], 2,
+            delta=False)
+        self.assertContains(resp, "<nop/>")
+        self.assertEqual(len(self.polygons()), 1)
+
+    def test_delta_new_object_needs_index(self):
+        resp = self.post([object_xml("car", [1, 2, 3, 4, 5, 6])], 1,
+            delta=True)
+        self.assertEqual(resp.status_code, 400)
+        resp = self.post([object_xml("car", [1, 2, 3, 4, 5, 6], index=0),
+            object_xml("tree", [1, 2, 3, 4, 5, 6], index=0)], 1, delta=True)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(len(self.polygons()), 0)
+
+    def test_failed_submit_adds_no_labels(self):
+        # the tool made up a name, but the polygon it's on doesn't exist
+        resp = self.post([object_xml("bus", [1, 2, 3, 4, 5, 6],
+            poly_id=12345)], 1, delta=True)
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Label.objects.filter(name="bus").exists())
+
+class LabelVersionTests(TestCase):
+    def saved(self, label):
+        with mock.patch("label_app.models.transaction.on_commit") as on_commit:
+            label.save()
+        return on_commit.called
+
+    def test_typed_in_label_keeps_version(self):
+        self.assertFalse(self.saved(Label(name="bus")))
+
+    def test_new_choice_changes_version(self):
+        self.assertTrue(self.saved(Label(name="bus", choice=True)))
+
+    def test_changed_label_changes_version(self):
+        label = Label.objects.create(name="bus")
+        label.color = "#123456"
+        self.assertTrue(self.saved(label))
+
+class StepAnnotationsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("annotator@example.com")
+        other_user = User.objects.create_user("other@example.com")
+        now = timezone.now()
+        self.navs = []
+        for i in range(8):
+            image = Image.objects.create(file_path="image_{}".format(i),
+                available=True, uploaded=True,
+                original_hash=i.to_bytes(32, "big"), image_x=4000,
+                image_y=3000+i, uploader=self.user)
+            # every other annotation is one the user can't step to
+            if i % 2 == 0:
+                anno = Annotation.objects.create(annotator=self.user,
+                    image=image, last_edit_time=now)
+                self.navs.append((anno.pk, image.pk))
+            elif i == 1:
+                Annotation.objects.create(annotator=other_user, image=image,
+                    last_edit_time=now)
+            elif i == 3:
+                Annotation.objects.create(annotator=self.user, image=image,
+                    locked=True, last_edit_time=now)
+            else:
+                Annotation.objects.create(annotator=self.user, image=image,
+                    deleted=True, last_edit_time=now)
+
+    def step(self, index, count, backwards=False):
+        return step_annotations(nav_annotations(self.user, False),
+            self.navs[index][0], count, backwards=backwards)
+
+    def test_forwards(self):
+        self.assertEqual(self.step(0, 1), [self.navs[1]])
+        self.assertEqual(self.step(1, 2), [self.navs[2], self.navs[3]])
+
+    def test_backwards(self):
+        self.assertEqual(self.step(3, 1, backwards=True), [self.navs[2]])
+        self.assertEqual(self.step(2, 2, backwards=True),
+            [self.navs[1], self.navs[0]])
+
+    def test_wraps_around(self):
+        self.assertEqual(self.step(3, 2), [self.navs[0], self.navs[1]])
+        self.assertEqual(self.step(0, 2, backwards=True),
+            [self.navs[3], self.navs[2]])
+
+    def test_comes_back_to_itself(self):
+        # with fewer annotations than asked for, the current one comes up again
+        self.assertEqual(self.step(0, 4),
+            [self.navs[1], self.navs[2], self.navs[3], self.navs[0]])
+
+    def test_nothing_to_step_to(self):
+        nobody = User.objects.create_user("nobody@example.com")
+        self.assertEqual(step_annotations(nav_annotations(nobody, False),
+            self.navs[0][0], 2), [])
+
+@override_settings(CACHES=TEST_CACHES)
+class NavLinkTests(TestCase):
+    def setUp(self):
+        for alias in TEST_CACHES.keys():
+            caches[alias].clear()
+        patcher = mock.patch.object(contest_info, "_real_close_date",
+            timezone.now()+datetime.timedelta(days=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user("annotator@example.com")
+        self.client.force_login(self.user)
+        self.annotations = []
+        for i in range(3):
+            image = Image.objects.create(file_path="image_{}".format(i),
+                available=True, uploaded=True,
+                original_hash=i.to_bytes(32, "big"), image_x=4000,
+                image_y=3000, uploader=self.user)
+            self.annotations.append(Annotation.objects.create(
+                annotator=self.user, image=image, locked=True,
+                last_edit_time=timezone.now()))
+
+    def get_xml(self, annotation, view):
+        return self.client.get(reverse("label_app:anno_xml",
+            args=(encode_filename(image_id=annotation.image_id,
+                anno_id=annotation.pk, view=view),)))
+
+    def test_view_links_neighbours(self):
+        resp = self.get_xml(self.annotations[1], True)
+        self.assertEqual(resp.status_code, 200)
+        links = resp["Link"].split(", ")
+        for annotation in (self.annotations[0], self.annotations[2]):
+            filename = encode_filename(image_id=annotation.image_id,
+                anno_id=annotation.pk, view=True)
+            # the same urls the tool asks for
+            self.assertIn("<{}>; rel=preload; as=image".format(
+                reverse("label_app:label_image", args=(filename,))), links)
+            self.assertIn("<{}>; rel=preload; as=fetch; crossorigin".format(
+                reverse("label_app:anno_xml", args=(filename,))), links)
+
+    def test_edit_has_no_links(self):
+        # unlock them so the user can edit them
+        Annotation.objects.update(locked=False)
+        resp = self.get_xml(self.annotations[1], False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header("Link"))
+        # and the neighbours' edit keys weren't touched
+        for annotation in (self.annotations[0], self.annotations[2]):
+            self.assertEqual(bytes(Annotation.objects.get(
+                pk=annotation.pk).edit_key), b"")
@@ -12,8 +12,14 @@ urlpatterns = [
         image_mgr.views.image_file, name="label_image"),
     path('Images/t/<str:filename>.jpg',
         image_mgr.views.image_thumb_file, name="label_image_thumb"),
+    path('Images/l<int:level>/<str:filename>.jpg',
+        image_mgr.views.image_level_file, name="label_image_level"),
+    path('Images/tile/<int:col>_<int:row>/<str:filename>.jpg',
+        image_mgr.views.image_tile_file, name="label_image_tile"),
     path('Annotations/f/<str:filename>.svg',
         login_required(views.get_annotation_svg), name="anno_svg"),
+    path('Annotations/sprite.svg',
+        login_required(views.get_annotation_sprite), name="anno_sprite"),
     path('Annotations/f/<str:filename>.xml',
         login_required(views.get_annotation_xml), name="anno_xml"),
     path('annotationTools/perl/submit.cgi',
@@ -1,25 +1,25 @@
-from django.shortcuts import render
-from django.http import HttpResponse, Http404
+from django.shortcuts import render, reverse
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import last_modified
 from django.core.exceptions import SuspiciousOperation
 from django.db import transaction
+from django.core.cache import cache
 from django.shortcuts import render
 
-from xml.sax.saxutils import escape as xml_escape
 import defusedxml.ElementTree
 import types
 import secrets
-import pathlib
-import time
 
 from labelous import contest_info
-from .models import Annotation, Polygon
+from .models import (Annotation, Polygon, pack_points, get_labels,
+    get_or_add_labels)
 from image_mgr.models import Image, THUMBNAIL_SIZE
 from .filename_smuggler import *
-
-script_dir = pathlib.Path(__file__).resolve(strict=True).parent
+from .anno_xml import annotation_xml_chunks
+from .overlay import svg_polygons, MAX_SPRITE_ANNOS
+from browser.ledger import change_anno_score
 
 # THEORY OF OPERATION: COMMUNICATIONS
 
@@ -98,6 +98,35 @@ script_dir = pathlib.Path(__file__).resolve(strict=True).parent
 # will reject any updates that don't have the edit key (and thus indices) of the
 # most recent annotation request.
 
+# THEORY OF OPERATION: DELTA DOCUMENTS
+
+# Sending the whole document on every edit means we have to parse and compare
+# every polygon each time, even though usually only one polygon has changed.
+# For big annotations this gets slow, and it all happens while the annotation
+# is locked for update. So, when editing, the document we send includes a
+# <c_delta_ok> tag, telling the tool it may send a delta document instead.
+
+# A delta document is rooted at <annotation_delta> rather than <annotation> and
+# has the same filename, edit key, and edit version as a full document, but
+# contains only the objects that were changed, added, or deleted since the
+# previous version. Because the objects aren't all there, their order no longer
+# tells us their index, so each object without a database ID must carry its
+# index in a <c_index> tag. The objects are otherwise identical and are applied
+# to the database the same way.
+
+# A delta only makes sense relative to the exact version before it. If the
+# delta's edit version is not precisely one more than the version in the
+# database, a previous document was lost or hasn't arrived yet, and we can't
+# apply it. In that case we reply with <resend_full/> and the tool falls back to
+# sending the full document (with a newer version), which always resynchronizes
+# the database. Any stragglers that show up later are older than that full
+# document and are ignored as usual.
+
+# thrown when a delta document can't be applied and the tool needs to send the
+# full document instead
+class NeedFullDocument(Exception):
+    pass
+
 # thrown from require_anno_perms when the user doesn't have permission
 class IncorrectPermissions(SuspiciousOperation):
     pass
@@ -109,7 +138,7 @@ def require_anno_perms(when, user, annotation, perms):
     is_reviewer = user.has_perm("browser.reviewer")
 
     if perms == "view":
-        if annotation.annotator == user:
+        if annotation.annotator_id == user.pk:
             return # people can always look at their own annotations
         elif is_reviewer:
             return # and reviewers can look at any annotation
@@ -131,12 +160,12 @@ def require_anno_perms(when, user, annotation, perms):
         # annotation is not locked, only the owner can edit it. if an annotation
         # is locked, only reviewers can edit it.
         if is_reviewer:
-            if annotation.annotator == user:
+            if annotation.annotator_id == user.pk:
                 return # reviewers can always edit their own annotations
             if not annotation.locked:
                 raise IncorrectPermissions("reviewer can't edit nonlocked anno")
         else:
-            if annotation.annotator != user:
+            if annotation.annotator_id != user.pk:
                 raise IncorrectPermissions("user can't edit others' annos")
             if annotation.locked:
                 raise IncorrectPermissions("user can't edit locked anno")
@@ -144,92 +173,78 @@ def require_anno_perms(when, user, annotation, perms):
         raise IncorrectPermissions("unknown permission level")
 
 
+# how long to keep rendered view-only documents around. they are keyed on the
+# annotation's last edit time and the label version, so they never go stale;
+# this just bounds memory.
+ANNO_XML_CACHE_TIME = 60*60
+
 def get_annotation_xml(request, filename):
     try:
         nd = decode_filename(filename, anno_id=True)
-        annotation = Annotation.objects.get(pk=nd.anno_id,
-            deleted=False, image__deleted=False)
+        annotation = Annotation.objects.select_related("image").get(
+            pk=nd.anno_id, deleted=False, image__deleted=False)
         require_anno_perms(request.when, request.user, annotation,
             "view" if nd.view else "edit")
     except Exception as e:
         raise Http404("Annotation does not exist.") from e
 
-    # randomize the edit key and reset the edit version, if we're editing. we
+    # find all the visible polygons attached to this annotation
+    polygons = annotation.polygons.filter(deleted=False)
+
+    if nd.view:
+        # tell the browser about the annotations on either side of this one so
+        # it can get them ready in case the user goes there next. only when
+        # viewing, since the links are to their documents and getting one for
+        # editing resets its edit key.
+        links = []
+        if annotation.annotator_id == request.user.pk and \
+                annotation.locked and not annotation.finished:
+            annotations = nav_annotations(request.user, True)
+            for nav, rel in ((step_annotations(annotations, annotation.pk, 1),
+                        "next"),
+                    (step_annotations(annotations, annotation.pk, 1,
+                        backwards=True), "prev")):
+                if len(nav) == 0 or nav[0][0] == annotation.pk:
+                    continue
+                links.append("<{}>; rel={}".format(
+                    reverse("label_app:anno_xml",
+                        args=(nav_filename(nav[0], True),)), rel))
+                links.extend(preload_links(nav[0], True))
+
+        # viewing doesn't change anything in the database, so the document only
+        # changes when the annotation or the labels are edited. reviewers tend
+        # to page back and forth through annotations, so we keep the rendered
+        # document around.
+        cache_key = "anno_xml_v:{}:{}:{}".format(annotation.pk,
+            annotation.last_edit_time.timestamp(), get_labels().version)
+        xml = cache.get(cache_key)
+        if xml is None:
+            xml = "".join(annotation_xml_chunks(annotation, polygons))
+            cache.set(cache_key, xml, ANNO_XML_CACHE_TIME)
+        resp = HttpResponse(xml, content_type="text/xml")
+        if len(links) > 0:
+            resp["Link"] = ", ".join(links)
+        return resp
+
+    # randomize the edit key and reset the edit version, since we're editing. we
     # don't use a transaction here because it's the annotation update code's
     # responsibility to make sure it doesn't commit any data when the edit key
     # is incorrect or its document is out of date.
-    if not nd.view:
-        edit_key = secrets.token_bytes(16)
-        annotation.edit_key = edit_key
-        annotation.edit_version = 0
-        annotation.save()
+    edit_key = secrets.token_bytes(16)
+    annotation.edit_key = edit_key
+    annotation.edit_version = 0
+    annotation.save()
 
-    # find all the visible polygons attached to this annotation
-    polygons = annotation.polygons.filter(deleted=False)
     # and remove any old indices, ensuring the database only contains indices
-    # for the file we are about to build
+    # for the file we are about to build. viewing doesn't do this because it
+    # would mess up the indices of a tool that's currently editing.
     polygons.filter(anno_index__isnull=False).update(anno_index=None)
 
-    # because XML is hard and bad, we build the result with string operations.
-    xml = ["<annotation>"]
-    # the annotation tool doesn't rebuild the document, it only modifies it.
-    # this means we can attach arbitrary tags (which we prefix with c_) and they
-    # will be returned untouched. it also means that most of the formatting we
-    # apply will be preserved. formatting is wasted bytes, so we don't put it
-    # in.
-
-    # store the edit key as a hex string. this, basically, ensures that the user
-    # doesn't get confused by having the same annotation open multiple times,
-    # and that the file's structure still matches the database. if we're not
-    # editing, we don't send the edit key, guaranteeing that the tool can't send
-    # back any changes.
-    if not nd.view:
-        xml.append("<edit_key>{}</edit_key>".format(edit_key.hex()))
-        # edit version always starts from 0
-        xml.append("<edit_version>0</edit_version>")
-    # specify which image file to show for this annotation. since we look up
-    # images by their ID, the folder doesn't matter as long as it's constant.
-    # it's not clear if this is actually used though?
-    xml.append("<filename>{}.jpg</filename><folder>f</folder>".format(
-        encode_filename(image_id=annotation.image.pk, anno_id=annotation.pk)))
-    for polygon in polygons:
-        xml.append("<object>")
-        # we need to know the polygon ID so we can update the record if the user
-        # changed the points
-        xml.append("<c_poly_id>{}</c_poly_id>".format(polygon.pk))
-        # the polygon's label as text
-        xml.append("<name>{}</name>".format(xml_escape(polygon.label_as_str)))
-        # if deleted is 1, the polygon won't show up. we avoid sending deleted
-        # polygons, so there's no case it would be set to 1.
-        # if verified is 1, the polygon will show an error if the user tries to
-        # edit it. we set the flag when the user is only allowed to view it.
-        xml.append("<deleted>0</deleted><verified>{}</verified>".format(
-            1 if nd.view else 0))
-        # whether the user considers the polygon to be occluded. same as
-        # database flag.
-        xml.append("<occluded>{}</occluded>".format(
-            "yes" if polygon.occluded else "no"))
-        # any additional notes the user wants to put.
-        xml.append("<attributes>{}</attributes>".format(
-            xml_escape(polygon.notes)))
-        # now the actual polygon points. we need to specify the user that
-        # created the polygon. so the tool is happy, we claim this is always the
-        # logged in user (or for now, a constant user.)
-        xml.append("<polygon><username>hi</username>")
-        points = polygon.points
-        # points are stored as a flat array: even indices are x and odd are y
-        for pi in range(0, len(points), 2):
-            # the tool can send non-integer coordinates even if they are a
-            # little silly. we specify a limit of 2 decimal places to get good
-            # accuracy and make sure the numbers are reasonable length.
-            # (i.e. not 3.5000000000000000069 or w/e)
-            xml.append("<pt><x>{:.2f}</x><y>{:.2f}</y></pt>".format(
-                points[pi], points[pi+1]))
-        xml.append("</polygon></object>")
-    xml.append("</annotation>")
-
-    # django will automatically concatenate our xml strings
-    return HttpResponse(xml, content_type="text/xml")
+    # stream the document out as it's built so big annotations don't have to be
+    # held in memory all at once
+    return StreamingHttpResponse(
+        annotation_xml_chunks(annotation, polygons.iterator(), edit_key),
+        content_type="text/xml")
 
 
 # handle a returned annotation XML document. note that we get no additional
@@ -242,7 +257,11 @@ def get_annotation_xml(request, filename):
 
 # handle understanding the document and updating the database.
 def process_annotation_xml(request, root):
-    if root.tag != "annotation":
+    if root.tag == "annotation":
+        is_delta = False
+    elif root.tag == "annotation_delta":
+        is_delta = True
+    else:
         raise SuspiciousOperation("not an annotation")
 
     # figure out which annotation this document is allegedly for, then look that
@@ -277,11 +296,16 @@ def process_annotation_xml(request, root):
     if annotation.edit_version >= edit_version:
         # if it doesn't, just stop processing. not an error.
         return
+    # a delta can only be applied on top of the version right before it. if
+    # there's a gap, don't bother parsing it; just ask for the whole thing.
+    if is_delta and annotation.edit_version != edit_version-1:
+        raise NeedFullDocument("delta version gap")
 
     # pull out all the polygons defined in this document. once that is done, we
     # will apply them to the database.
     anno_polygons = []
     anno_poly_ids = set()
+    anno_poly_indices = set()
     # iterate through objects in order, keeping track of their index
     curr_index = 0
     for obj_tag in root.findall("object"):
@@ -297,8 +321,20 @@ def process_annotation_xml(request, root):
                     raise Exception("duplicate id")
                 anno_poly_ids.add(anno_polygon.id)
 
-            anno_polygon.index = curr_index
-            curr_index = curr_index + 1
+            if not is_delta:
+                anno_polygon.index = curr_index
+                curr_index = curr_index + 1
+            elif anno_polygon.id is None:
+                # delta objects aren't all there, so the ones without an ID
+                # have to tell us their index explicitly
+                anno_polygon.index = int(obj_tag.find("c_index").text)
+                if anno_polygon.index < 0:
+                    raise Exception("bad index")
+                if anno_polygon.index in anno_poly_indices:
+                    raise Exception("duplicate index")
+                anno_poly_indices.add(anno_polygon.index)
+            else:
+                anno_polygon.index = None # found by ID, so index is ignored
 
             anno_polygon.name = obj_tag.find("name").text
             if anno_polygon.name == "":
@@ -332,20 +368,24 @@ def process_annotation_xml(request, root):
                     anno_polygon.points.extend((x, y))
             except:
                 raise Exception("bad points")
+            # packed up for quick comparison with the database
+            anno_polygon.packed_points = pack_points(anno_polygon.points)
 
             anno_polygons.append(anno_polygon)
         except Exception as e:
             raise SuspiciousOperation("invalid polygon") from e
 
-    # get the polygons attached to this annotation that we would have shown
-    polygons = annotation.polygons.filter(deleted=False)
+    # get the polygons attached to this annotation that we would have shown.
+    # we compare their points using the packed version so we don't need the
+    # unpacked ones.
+    polygons = annotation.polygons.filter(deleted=False).defer("points")
     # and map them by their ID
     polygons_by_id = {p.pk: p for p in polygons}
     # plus index in the file
     polygons_by_index = {p.anno_index: p
         for p in polygons_by_id.values() if p.anno_index is not None}
+    labels = get_labels()
     # accumulate score as we process the polygons
-    object_scores = load_object_scores()
     total_score = 0
     with transaction.atomic():
         # reload the annotation, this time while selected for update. this
@@ -359,6 +399,9 @@ def process_annotation_xml(request, root):
         if annotation.edit_version >= edit_version:
             # if we don't, just stop processing. not an error.
             return
+        # and that a delta still directly follows the database's version
+        if is_delta and annotation.edit_version != edit_version-1:
+            raise NeedFullDocument("delta version gap")
         # the edit key and version can't be changed until the transaction
         # finishes, ensuring that any changes are in the database before a new
         # edit can happen.
@@ -366,6 +409,16 @@ def process_annotation_xml(request, root):
         # re-verify the permissions for the same reason
         require_anno_perms(request.when, request.user, annotation, "edit")
 
+        # look up the labels the polygons have. any the tool made up get added,
+        # now that we know the document will be stored.
+        anno_labels = get_or_add_labels(
+            set(anno_poly.name for anno_poly in anno_polygons))
+
+        # a delta doesn't mention the polygons that didn't change, so they
+        # would be left out of the score. keep track of the ones it does mention
+        # so we can count the rest afterwards.
+        touched_polys = set()
+
         for anno_poly in anno_polygons:
             # measure if anything changed in the polygon so we can update its
             # last edited time.
@@ -395,20 +448,24 @@ def process_annotation_xml(request, root):
                             annotation=annotation, anno_index=anno_poly.index)
                         polygon_changed = True
 
+            touched_polys.add(poly.pk)
+
+            label = anno_labels[anno_poly.name]
             if not anno_poly.deleted:
-                # labels not on the list get a score of 0
-                total_score += object_scores.get(anno_poly.name, 0)
+                total_score += label.score
 
             if polygon_changed == True: pass
-            elif poly.label_as_str != anno_poly.name: polygon_changed = True
+            elif poly.label_id != label.pk: polygon_changed = True
             elif poly.notes != anno_poly.attributes: polygon_changed = True
             elif poly.occluded != anno_poly.occluded: polygon_changed = True
-            elif poly.points != anno_poly.points: polygon_changed = True
+            elif poly.packed_points is None: polygon_changed = True
+            elif bytes(poly.packed_points) != anno_poly.packed_points:
+                polygon_changed = True
             elif poly.deleted != anno_poly.deleted: polygon_changed = True
             if polygon_changed: print("poly changed!!")
 
             if polygon_changed:
-                poly.label_as_str = anno_poly.name
+                poly.label = label
                 poly.notes = anno_poly.attributes
                 poly.occluded = anno_poly.occluded
                 poly.points = anno_poly.points
@@ -418,6 +475,14 @@ def process_annotation_xml(request, root):
                 # polygon gets changed per request
                 poly.save()
 
+        if is_delta:
+            # the rest of the polygons are unchanged and still count
+            for poly in polygons_by_id.values():
+                if poly.pk not in touched_polys:
+                    total_score += labels.get(poly.label_id).score
+
+        # keep the annotator's points up to date
+        change_anno_score(annotation, total_score)
         annotation.score = total_score
         annotation.last_edit_time = request.when
         annotation.edit_version = edit_version
@@ -437,7 +502,7 @@ def parse_annotation_xml(request):
 
     try:
         process_annotation_xml(request, xml)
-    except SuspiciousOperation:
+    except (SuspiciousOperation, NeedFullDocument):
         raise
     except Exception as e:
         raise SuspiciousOperation("xml process failed") from e
@@ -448,6 +513,10 @@ def parse_annotation_xml(request):
 def post_annotation_xml(request):
     try:
         parse_annotation_xml(request)
+    except NeedFullDocument:
+        # not an error, the tool just needs to send the whole thing instead of
+        # a delta
+        return HttpResponse("<resend_full/>", content_type="text/xml")
     except Exception:
         import traceback
         traceback.print_exc()
@@ -462,39 +531,93 @@ def post_annotation_xml(request):
 def tool(request):
     # the content type must be xhtml or the SVGs will not render!
     return render(request, "label_app/tool.html",
+        {"object_choices": get_labels().choices},
         content_type="application/xhtml+xml")
 
+# the tool's next and previous buttons step through the user's annotations in
+# the same state as the one they're on (locked if they're viewing) in pk order,
+# wrapping around at the ends. the (annotator, locked, finished, deleted, pk)
+# index on annotations makes each step a quick index lookup.
+
+# to make switching annotations feel quick, each step also tells the tool (and
+# the browser, with Link: rel=preload headers) about the annotation after the
+# one it's stepping to, so its image can be loaded before it's asked for. the
+# XML documents are only preloaded when viewing; getting one for editing resets
+# the edit key, which would mess up anyone editing it.
+
+# what we need to know about each annotation to step to it and preload it
+NAV_FIELDS = ("pk", "image_id")
+
+def nav_annotations(user, view):
+    return Annotation.objects.filter(annotator=user, locked=view,
+        finished=False, deleted=False, image__deleted=False)
+
+# return the (up to) count annotations after the one with the given pk (or
+# before it if backwards), wrapping around at the end. each is a tuple of
+# NAV_FIELDS. usually just one query.
+def step_annotations(annotations, anno_id, count, backwards=False):
+    if backwards:
+        order = "-pk"
+        rest = annotations.filter(pk__lt=anno_id)
+    else:
+        order = "pk"
+        rest = annotations.filter(pk__gt=anno_id)
+    found = list(rest.order_by(order).values_list(*NAV_FIELDS)[:count])
+    if len(found) < count:
+        # we hit the end of the loop, so keep going from the other end
+        found.extend(annotations.order_by(order).values_list(
+            *NAV_FIELDS)[:count-len(found)])
+    return found
+
+def nav_filename(nav, view):
+    return encode_filename(image_id=nav[1], anno_id=nav[0], view=view)
+
+# Link header values to preload what the tool will need for the annotation: its
+# image, and its document if viewing. the URLs have to be exactly the ones the
+# tool asks for or the browser won't use what it preloaded.
+def preload_links(nav, view):
+    filename = nav_filename(nav, view)
+    links = ["<{}>; rel=preload; as=image".format(
+        reverse("label_app:label_image", args=(filename,)))]
+    if view:
+        # the tool gets the document with a same-origin XHR, which sends
+        # credentials but isn't in "include" mode, so it only matches a plain
+        # crossorigin (anonymous) preload
+        links.append("<{}>; rel=preload; as=fetch; crossorigin".format(
+            reverse("label_app:anno_xml", args=(filename,))))
+    return links
+
+# tell the tool to go to the annotation dest. prev_nav and next_nav are the
+# ones on either side of it, and ahead (one of them) is the one after it in the
+# direction the user is going, which gets preloaded.
+def nav_response(dest, prev_nav, next_nav, ahead, view):
+    resp = HttpResponse(
+        "<out><dir>f</dir><file>{}.jpg</file>"
+        "<c_prev>{}.jpg</c_prev><c_next>{}.jpg</c_next></out>".format(
+            nav_filename(dest, view), nav_filename(prev_nav, view),
+            nav_filename(next_nav, view)), content_type="text/xml")
+    resp["Link"] = ", ".join(preload_links(ahead, view))
+    return resp
+
 # return the next annotation based on the filename given in the request
 def next_annotation(request):
     try:
         nd = decode_filename(request.GET["image"], anno_id=True)
     except Exception as e:
         raise SuspiciousOperation("invalid filename") from e
-    
-    # search for the next annotation: one that has a bigger primary key than
-    # current one. an arbitrary but consistent ordering.
-    try:
-        next_annotation = Annotation.objects.filter(
-            pk__gt=nd.anno_id, annotator=request.user, image__deleted=False,
-            locked=nd.view,
-            deleted=False, finished=False).order_by("pk")[0:1].get()
-    except Annotation.DoesNotExist:
-        # we must be at the end of the loop. get the first annotation instead
-        try:
-            next_annotation = Annotation.objects.filter(
-                annotator=request.user, image__deleted=False, locked=nd.view,
-                deleted=False, finished=False).order_by("pk")[0:1].get()
-        except Annotation.DoesNotExist:
-            # the user doesn't have any in this category? just give back the
-            # file they're currently working on
-            return HttpResponse(
-                "<out><dir>f</dir><file>{}</file></out>".format(
-                    request.GET["image"]), content_type="text/xml")
-
-    return HttpResponse(
-        "<out><dir>f</dir><file>{}.jpg</file></out>".format(encode_filename(
-            image_id=next_annotation.image.pk, anno_id=next_annotation.pk,
-            view=nd.view)), content_type="text/xml")
+    current = (nd.anno_id, nd.image_id)
+
+    # get the next one and the one after it in one go
+    found = step_annotations(nav_annotations(request.user, nd.view),
+        nd.anno_id, 2)
+    if len(found) == 0:
+        # the user doesn't have any in this category? just give back the
+        # file they're currently working on
+        return HttpResponse(
+            "<out><dir>f</dir><file>{}.jpg</file></out>".format(
+                encode_filename(**nd._asdict())), content_type="text/xml")
+
+    return nav_response(found[0], current, found[-1], found[-1], nd.view)
 
 # return the previous annotation based on the filename given in the request
 def prev_annotation(request):
@@ -502,43 +625,16 @@ def prev_annotation(request):
         nd = decode_filename(request.GET["image"], anno_id=True)
     except Exception as e:
         raise SuspiciousOperation("invalid filename") from e
-    
-    # search for the previous annotation: one that has a smaller primary key
-    # than current one. an arbitrary but consistent ordering.
-    try:
-        prev_annotation = Annotation.objects.filter(
-            pk__lt=nd.anno_id, annotator=request.user, image__deleted=False,
-            locked=nd.view,
-            deleted=False, finished=False).order_by("-pk")[0:1].get()
-    except Annotation.DoesNotExist:
-        # we must be at the start of the loop. get the first annotation instead
-        try:
-            prev_annotation = Annotation.objects.filter(
-                annotator=request.user, image__deleted=False, locked=nd.view,
-                deleted=False, finished=False).order_by("-pk")[0:1].get()
-        except Annotation.DoesNotExist:
-            # the user doesn't have any in this category? just give back the
-            # file they're currently working on
-            return HttpResponse(
-                "<out><dir>f</dir><file>{}</file></out>".format(
-                    request.GET["image"]), content_type="text/xml")
-
-    return HttpResponse(
-        "<out><dir>f</dir><file>{}.jpg</file></out>".format(encode_filename(
-            image_id=prev_annotation.image.pk, anno_id=prev_annotation.pk,
-            view=nd.view)), content_type="text/xml")
-
-# give an object's outline a color based on its name. taken from the JS so we
-# can give the same colors
-object_colors = \
-    ["#009900","#00ff00","#ccff00","#ffff00","#ffcc00","#ff9999","#cc0033",
-    "#ff33cc","#9933ff","#990099","#000099","#006699","#00ccff","#999900"]
-def calculate_object_color(name):
-    # might not give the same color for non-ascii chars but those aren't very
-    # likely and it doesn't matter much anyway
-    name_hash = sum(name.upper().encode("utf8"))
-    color_idx = (((name_hash + 567) * 1048797) % len(object_colors))
-    return object_colors[color_idx]
+    current = (nd.anno_id, nd.image_id)
+
+    found = step_annotations(nav_annotations(request.user, nd.view),
+        nd.anno_id, 2, backwards=True)
+    if len(found) == 0:
+        return HttpResponse(
+            "<out><dir>f</dir><file>{}.jpg</file></out>".format(
+                encode_filename(**nd._asdict())), content_type="text/xml")
+
+    return nav_response(found[0], found[-1], current, found[-1], nd.view)
 
 def find_annotation_for_svg(request, filename):
     try:
@@ -565,48 +661,54 @@ def get_annotation_svg(request, filename):
 
     # there's no real advantage to templating the svg, so we build it manually
     svg = ['<svg xmlns="http://www.w3.org/2000/svg" ']
-    # we need to make the SVG the same size as the thumbnail, and scale the
-    # polygon coordinates appropriately
+    # we need to make the SVG the same size as the thumbnail
     image = annotation.image
-    image_size = image.image_size
-    thumb_size = image.thumb_size
-    svg.append('width="{}px" height="{}px">'.format(*thumb_size))
-    x_scale = thumb_size[0]/image_size[0]
-    y_scale = thumb_size[1]/image_size[1]
-    scale = min(x_scale, y_scale)
-    for polygon in annotation.polygons.filter(deleted=False).all():
-        svg.append('<polygon fill="none" points="')
-        points = polygon.points
-        for pi in range(0, len(points), 2):
-            svg.append('{:.2f},{:.2f} '.format(
-                points[pi]*scale, points[pi+1]*scale))
-        svg.append('" style="stroke:{}; stroke-width:2;"/>'.format(
-            calculate_object_color(polygon.label_as_str)))
+    svg.append('width="{}px" height="{}px">'.format(*image.thumb_size))
+    svg.extend(svg_polygons(image,
+        annotation.polygons.filter(deleted=False).defer("points")))
     svg.append('</svg>')
 
     return HttpResponse(svg, content_type="image/svg+xml")
 
-# manage the list of objects and their scores. since they aren't in the
-# database, we have to load them from the file every so often so admins can
-# update the scores in a timely manner.
-object_scores_cache = None
-object_last_loaded = -float("inf")
-def load_object_scores():
-    global object_scores_cache, object_last_loaded
-    # were the labels loaded in the last 5 minutes?
-    now = time.monotonic()
-    if object_last_loaded >= now-300:
-        # just return the cached ones
-        return object_scores_cache
-    object_scores = {}
-    with open(script_dir/"label_priorities.txt", "r") as priorities:
-        for obj in priorities.readlines():
-            if obj == "" or obj == "\n": continue
-            if obj.endswith("\n"): obj = obj[:-1]
-            score, name = obj.split(",", 1)
-            score = float(score)
-            object_scores[name] = score
-
-    object_scores_cache = object_scores
-    object_last_loaded = now
-    return object_scores_cache
+# return one SVG containing the overlays of many annotations at once. each
+# overlay is a <symbol> with the id a<anno id>, so a page can show them with
+# <use href="...#a123"/>. the browser only fetches the sprite once, so a browse
+# page with lots of annotations only needs one request for all the overlays.
+def get_annotation_sprite(request):
+    try:
+        anno_ids = [int(i) for i in request.GET["ids"].split(",") if i != ""]
+        if len(anno_ids) > MAX_SPRITE_ANNOS:
+            raise Exception("too many annotations")
+    except Exception as e:
+        raise SuspiciousOperation("invalid annotation list") from e
+
+    annotations = Annotation.objects.filter(pk__in=anno_ids,
+        deleted=False, image__deleted=False).select_related("image").only(
+            "pk", "image", "image__image_x", "image__image_y",
+            "image__thumb_x", "image__thumb_y")
+    # reviewers can view any annotation, everybody else only their own. this
+    # is the same as the view permissions in require_anno_perms.
+    if not request.user.has_perm("browser.reviewer"):
+        annotations = annotations.filter(annotator=request.user)
+    annotations = {anno.pk: anno for anno in annotations}
+
+    # get all the polygons in one go, then split them up by annotation
+    anno_polygons = {anno_id: [] for anno_id in annotations.keys()}
+    polygons = Polygon.objects.filter(annotation__in=list(annotations.keys()),
+        deleted=False).only("annotation", "label", "packed_points")
+    for polygon in polygons:
+        anno_polygons[polygon.annotation_id].append(polygon)
+
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg">']
+    for anno_id, annotation in annotations.items():
+        svg.append('<symbol id="a{}" viewBox="0 0 {} {}">'.format(
+            anno_id, *annotation.image.thumb_size))
+        svg.extend(svg_polygons(annotation.image, anno_polygons[anno_id]))
+        svg.append('</symbol>')
+    svg.append('</svg>')
+
+    resp = HttpResponse(svg, content_type="image/svg+xml")
+    # the URL changes whenever any of the annotations or labels does, so the
+    # sprite can be cached for as long as the browser likes
+    resp["Cache-Control"] = "private, max-age=31536000"
+    return resp
@@ -24,9 +24,15 @@ DATABASES = {
 import pathlib
 L_IMAGE_PATH = pathlib.Path(
     "").resolve(strict=True)
+# where the cache is stored. should be on a tmpfs like /dev/shm and only
+# accessible to the user running the server.
+L_CACHE_PATH = pathlib.Path("/dev/shm/labelous_cache")
 # path to the mozjpeg jpegtran tool
 L_JPEGTRAN_PATH = pathlib.Path(
     "").resolve(strict=True)
 # if True, serve images through nginx X-Accel-Redirect
 L_IMAGE_ACCEL = not DEBUG
+# if True, cut uploaded images into tiles so the tool can load zoomed in parts
+# of the image without loading the whole thing
+L_IMAGE_TILES = False
 
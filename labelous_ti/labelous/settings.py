@@ -104,6 +104,39 @@ LOGIN_URL = "/"
 LOGIN_REDIRECT_URL = "/browse/in_progress/"
 LOGOUT_REDIRECT_URL = "/"
 
+# users and their permissions are cached so each request doesn't have to look
+# them up again. the cache signals in browser/apps.py keep them up to date.
+AUTHENTICATION_BACKENDS = ["browser.auth_backend.CachedModelBackend"]
+
+# sessions are read on every request too, so keep them in the cache as well. the
+# database still has them so nobody gets logged out if the cache is cleared.
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = "auth"
+
+# the cache has to be shared between all the uwsgi processes or they won't see
+# each other's invalidations. a file based cache does that without needing
+# another service, and when it's kept on a tmpfs like /dev/shm it's just shared
+# memory. every write to a file based cache looks through all the files in its
+# directory, so the small, frequently used sessions, users and permissions get
+# their own cache that's kept small instead of sharing one with the big rendered
+# documents.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': str(L_CACHE_PATH/"default"),
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': str(L_CACHE_PATH/"auth"),
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/